@@ -1,8 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, TypeVar
 import asyncio
+import functools
+import logging
 import math
+import threading
 from itertools import combinations
+import numpy as np
 
 
 from models.models import (
@@ -12,11 +17,38 @@ from models.models import (
     Query,
     QueryResult,
     QueryWithEmbedding,
+    SourceCursor,
 )
 from services.chunks import get_document_chunks
+from services.file import PAGE_BREAK
+from services.metrics import STAGE_DURATION
 from services.openai import get_embeddings
-from services.dynamodb import save_question_to_db, query_question_embeddings, scan_topics, get_source_last_line_processed, edit_source_last_line_processed
+from services.tracing import span
+from services.dynamodb import save_question_to_db, query_question_embeddings, scan_topics, get_source_cursor, edit_source_cursor
 from services.extract_questions import extract_topic_id
+from services.quantization import QuantizedIndex, ScalarQuantizer, normalize
+from services.ingestion import ProgressCallback
+from services.source_cursor import (
+    SourceCursorMismatch,
+    accepts_tail,
+    checksum,
+    has_enough_new_content,
+    processed_end,
+    resume_offset,
+)
+
+logger = logging.getLogger(__name__)
+
+# Questions whose cosine similarity with an existing question is above this are considered duplicates
+QUESTION_SIMILARITY_THRESHOLD = 0.9
+QUESTION_INDEX_BATCH_SIZE = 256  # The number of new questions of an upsert quantized into the question index at once
+SOURCE_CURSOR_CONCURRENCY = 16  # The number of source cursors of an upsert read or saved at a time
+
+T = TypeVar("T")
+
+# Upserts to the same chain chunk their documents concurrently, but deduplicate their questions one at a time,
+# so that each one sees the questions saved by the others
+_question_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
 
 def cosine_similarity(v1,v2) -> float:
     "compute cosine similarity of v1 to v2: (v1 dot v2)/{||v1||*||v2||)"
@@ -28,13 +60,74 @@ def cosine_similarity(v1,v2) -> float:
         sumxy += x*y
     return sumxy/math.sqrt(sumxx*sumyy)
 
+async def gather_in_threads(calls: List[Callable[[], T]]) -> List[T]:
+    """
+    Run blocking calls in threads, SOURCE_CURSOR_CONCURRENCY at a time, and return their results in order.
+    """
+    semaphore = asyncio.Semaphore(SOURCE_CURSOR_CONCURRENCY)
+
+    async def run(call: Callable[[], T]) -> T:
+        async with semaphore:
+            return await asyncio.to_thread(call)
+
+    return await asyncio.gather(*[run(call) for call in calls])
+
+class QuestionIndex:
+    """
+    The question embeddings of a chain, normalized and held as int8 codes, against which new questions are
+    deduplicated. The questions added are scored exactly until QUESTION_INDEX_BATCH_SIZE of them are
+    quantized into the index at once. The int8 ranges are learned from the first questions indexed.
+    """
+
+    def __init__(self, embeddings: List[List[float]]):
+        self._index: Optional[QuantizedIndex] = None
+        self._pending: List[np.ndarray] = []
+        if len(embeddings) > 0:
+            self._add_to_index(normalize(np.array(embeddings, dtype=np.float32)))
+
+    def is_duplicate(self, embedding: List[float]) -> bool:
+        """
+        Check whether a question embedding is too similar to any question in the index.
+        The int8 scores are used as they are, without keeping float32 copies of the questions to rerank them.
+        """
+        query = normalize(embedding)
+        if self._pending and float((np.stack(self._pending) @ query).max()) > QUESTION_SIMILARITY_THRESHOLD:
+            return True
+        if self._index is None:
+            return False
+        matches = self._index.search(query, top_k=1, rerank=False)
+        return len(matches) > 0 and matches[0][1] > QUESTION_SIMILARITY_THRESHOLD
+
+    def add(self, embedding: List[float]):
+        self._pending.append(normalize(embedding))
+        if len(self._pending) >= QUESTION_INDEX_BATCH_SIZE:
+            self._add_to_index(np.stack(self._pending))
+            self._pending = []
+
+    def _add_to_index(self, vectors: np.ndarray):
+        if self._index is None:
+            self._index = QuantizedIndex(ScalarQuantizer().fit(vectors), keep_vectors=False)
+        self._index.add(vectors)
+
 class DataStore(ABC):
     async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None, chain: str = ""
+        self,
+        documents: List[Document],
+        chunk_token_size: Optional[int] = None,
+        chain: str = "",
+        progress: Optional[ProgressCallback] = None,
+        appending: bool = False,
+        sync_sources: bool = True,
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
-        First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
+        Documents with an id are sources that are synced repeatedly: only the text after the byte offset
+        their cursor was saved at is processed, unless the bytes before it changed, in which case the
+        existing vectors of the document are deleted and it is processed again from the start.
+        With appending, the sources are synced by appending lines to them, and a partial last line is left
+        for the next sync. Without sync_sources, documents are processed whole and no cursor is read or
+        saved, e.g. for bulk imports that give their documents ids only to retry their batches.
+        Optionally reports the progress of each stage to the progress callback.
         Return a list of document ids.
         """
         # Delete any existing vectors for documents with the input document ids
@@ -53,74 +146,218 @@ class DataStore(ABC):
         )
         """
         
-        print('Get topics from db')
-        topics = scan_topics()
-        topic_names = [t.topic for t in topics]
-        topic_ids = [t.topic_id for t in topics]
-
-        print('Remove lines that have already been processed')
-        last_lines_processed = []
-        for i, doc in enumerate(documents):
-            last_line_processed = get_source_last_line_processed(chain=chain, source_id=doc.id)
-            print(f"Last line processed is {last_line_processed}")
-            last_lines_processed.append(last_line_processed)
-            doc.text = doc.text.split("\n",last_lines_processed[i])[last_lines_processed[i]]
-
-        if doc.text.count('\n') < 100:
-            print('No new content found')
+        logger.debug('Remove content that has already been processed')
+        synced_ids = list({doc.id: None for doc in documents if doc.id and sync_sources})
+        saved_cursors = dict(
+            zip(
+                synced_ids,
+                await gather_in_threads(
+                    [functools.partial(get_source_cursor, chain=chain, source_id=id) for id in synced_ids]
+                ),
+            )
+        )
+        new_documents: List[Document] = []
+        cursors: List[SourceCursor] = []
+        for doc in documents:
+            if not doc.id or not sync_sources:
+                # Documents without an id have no cursor and are always processed whole
+                new_documents.append(doc)
+                cursors.append(SourceCursor())
+                continue
+
+            cursor = saved_cursors[doc.id]
+            data = doc.text.encode("utf-8")
+            start = resume_offset(data, cursor)
+            if start == 0 and (cursor.byte_offset or cursor.line):
+                logger.info("Already processed content of %s changed, processing it again", doc.id)
+                await self.delete(
+                    filter=DocumentMetadataFilter(document_id=doc.id), delete_all=False, chain=chain
+                )
+                cursor = SourceCursor()
+            logger.debug("Resuming %s at byte %d", doc.id, start)
+
+            end = processed_end(data, start, appending)
+            text = data[start:end].decode("utf-8")
+            line = cursor.line + text.count("\n")
+            if not has_enough_new_content(text, resumed=start > 0):
+                logger.info("No new content found for %s", doc.id)
+                continue
+            # The pages before the resumed text are counted, so that its chunks cite the pages of the whole file
+            new_documents.append(
+                Document(
+                    id=doc.id,
+                    text=text,
+                    metadata=doc.metadata,
+                    mimetype=doc.mimetype,
+                    first_page=doc.first_page + data[:start].count(PAGE_BREAK.encode("utf-8")),
+                )
+            )
+            cursors.append(SourceCursor(byte_offset=end, checksum=checksum(data[:end]), line=line))
+
+        if not new_documents:
+            logger.info('No new content found')
             return []
 
-        print('Convert the document to chunks')
-        chunks = get_document_chunks(documents, chunk_token_size, chain)
+        with span("DataStore.upsert", chain=chain, documents=len(new_documents)):
+            result = await self._process(new_documents, chunk_token_size, chain, progress)
 
-        print('Get a list of current question embeddings for this chain')
-        old_question_embeddings: List[List[float]] = query_question_embeddings(chain)
-        new_question_embeddings: List[List[float]] = []
-        
-        print('Loop through the dict items')
-        for doc_id, chunk_list in chunks.items():
-            print(f"Saving questions for document_id: {doc_id}")
-            for chunk in chunk_list:
-
-                print('Iterate over all questions generated for this text chunk')
-                for question in chunk.questions:
-                    if question.embedding == None:
-                        continue
-                    print('Compare this question with all old questions')
-                    already_extracted = False
-                    print('Compare it with all new questions that were just added')
-                    for new_question in new_question_embeddings:
-                        similarity = cosine_similarity(new_question, question.embedding)
-                        if similarity > 0.9:
-                            already_extracted = True
-                            break
-                    if already_extracted:
-                        continue
-                    for old_question in old_question_embeddings:
-                        similarity = cosine_similarity(old_question, question.embedding)
-                        if similarity > 0.9:
-                            already_extracted = True
-                            break
-                    if already_extracted:
-                        continue
-                    
-                    print('Save question to database')
-                    topic_id = extract_topic_id(text=question.text, topic_names=topic_names, topic_ids=topic_ids)
-                    chunk.topic_id = topic_id
-                    vector = ','.join([str(x) for x in question.embedding])
-                    save_question_to_db(chain=chain, question=question.text, embedding=vector, topic_id=topic_id)
-                    new_question_embeddings.append(question.embedding)
-
-        print('Save chunks to vector db')
-        result = await self._upsert(chunks=chunks, chain=chain)
-
-        print('Updating last lines processed in db')
-        for i, doc in enumerate(documents):
-            last_line_processed = last_lines_processed[i] + doc.text.count("\n")
-            edit_source_last_line_processed(chain=chain, source_id=doc.id, line=last_line_processed)
+        logger.debug('Updating source cursors in db')
+        await gather_in_threads(
+            [
+                functools.partial(edit_source_cursor, chain=chain, source_id=doc.id, cursor=cursor)
+                for doc, cursor in zip(new_documents, cursors)
+                if doc.id and sync_sources
+            ]
+        )
 
         return result
 
+    async def upsert_tail(
+        self,
+        document: Document,
+        offset: int,
+        prefix_checksum: Optional[str],
+        new_checksum: str,
+        chunk_token_size: Optional[int] = None,
+        chain: str = "",
+        progress: Optional[ProgressCallback] = None,
+    ) -> List[str]:
+        """
+        Takes in the bytes appended to a source since it was last processed, as the text of a document
+        with the source id, and inserts them into the database.
+        The tail must start at the byte offset the source was processed up to, and prefix_checksum must be
+        the sha256 of the bytes before it, otherwise SourceCursorMismatch is raised and the whole source has
+        to be upserted again. new_checksum is the sha256 of the source up to the end of the tail.
+        The tail must end with a newline, a partial last line is sent with the next tail.
+        Return a list of document ids.
+        """
+        if not document.id:
+            raise ValueError("A tail upload needs the id of its source document")
+        if document.text and not document.text.endswith("\n"):
+            raise ValueError("A tail upload must end with a newline")
+
+        cursor = await asyncio.to_thread(get_source_cursor, chain=chain, source_id=document.id)
+        if not accepts_tail(cursor, offset, prefix_checksum):
+            raise SourceCursorMismatch(cursor)
+
+        # The same rules as for whole sources, a tail at offset 0 is a new source
+        if not has_enough_new_content(document.text, resumed=offset > 0):
+            logger.info("No new content found for %s", document.id)
+            return []
+        new_lines = document.text.count("\n")
+
+        with span("DataStore.upsert_tail", chain=chain, documents=1):
+            result = await self._process([document], chunk_token_size, chain, progress)
+
+        logger.debug('Updating source cursor in db')
+        await asyncio.to_thread(
+            edit_source_cursor,
+            chain=chain,
+            source_id=document.id,
+            cursor=SourceCursor(
+                byte_offset=offset + len(document.text.encode("utf-8")),
+                checksum=new_checksum,
+                line=cursor.line + new_lines,
+            ),
+        )
+        return result
+
+    async def _process(
+        self,
+        documents: List[Document],
+        chunk_token_size: Optional[int],
+        chain: str,
+        progress: Optional[ProgressCallback],
+    ) -> List[str]:
+        """
+        Chunks the documents, saves the new questions of their chunks and inserts the chunks into the database.
+        The chunking and the deduplication call the OpenAI and DynamoDB clients, which block, so they run in
+        a thread to keep the event loop free for concurrent upserts and requests.
+        Return a list of document ids.
+        """
+        logger.debug('Convert the document to chunks')
+        with span("chunking", chain=chain) as current, STAGE_DURATION.time(stage="chunking"):
+            chunks = await asyncio.to_thread(get_document_chunks, documents, chunk_token_size, chain, progress)
+            current.set_attribute("chunks", sum(len(chunk_list) for chunk_list in chunks.values()))
+
+        question_lock = _question_locks[chain]
+        with STAGE_DURATION.time(stage="deduplicating"):
+            num_new_questions = await asyncio.to_thread(
+                self._save_new_questions, chunks, chain, question_lock, progress
+            )
+
+        logger.debug('Save chunks to vector db')
+        num_chunks = sum(len(chunk_list) for chunk_list in chunks.values())
+        if progress is not None:
+            progress("upserting", 0, num_chunks)
+        with span(f"{type(self).__name__}._upsert", chain=chain, chunks=num_chunks), \
+                STAGE_DURATION.time(stage="vector_upsert"):
+            result = await self._upsert(chunks=chunks, chain=chain)
+        if progress is not None:
+            progress("upserting", num_chunks, num_chunks)
+
+        logger.info(
+            "Upserted %d chunks of %d documents, with %d new questions",
+            num_chunks,
+            len(documents),
+            num_new_questions,
+            extra={"chain": chain},
+        )
+        return result
+
+    @staticmethod
+    def _save_new_questions(
+        chunks: Dict[str, List[DocumentChunk]],
+        chain: str,
+        question_lock: threading.Lock,
+        progress: Optional[ProgressCallback],
+    ) -> int:
+        """
+        Saves the questions of the chunks that are not similar to a question already saved for the chain,
+        and tags the chunks with the topic of their questions.
+        Return the number of questions saved.
+        """
+        with question_lock:
+            logger.debug('Get topics from db')
+            topics = scan_topics()
+            topic_names = [t.topic for t in topics]
+            topic_ids = [t.topic_id for t in topics]
+
+            logger.debug('Get a list of current question embeddings for this chain')
+            question_index = QuestionIndex(query_question_embeddings(chain))
+            num_questions_saved = 0
+
+            logger.debug('Loop through the dict items')
+            num_chunks = sum(len(chunk_list) for chunk_list in chunks.values())
+            num_chunks_done = 0
+            for doc_id, chunk_list in chunks.items():
+                logger.debug("Saving questions for document_id: %s", doc_id)
+                for chunk in chunk_list:
+
+                    logger.debug('Iterate over all questions generated for this text chunk')
+                    for question in chunk.questions:
+                        if question.embedding == None:
+                            continue
+                        logger.debug('Compare this question with all old questions and the new ones just added')
+                        if question_index.is_duplicate(question.embedding):
+                            continue
+
+                        logger.debug('Save question to database')
+                        topic_id = extract_topic_id(text=question.text, topic_names=topic_names, topic_ids=topic_ids)
+                        chunk.topic_id = topic_id
+                        vector = ','.join([str(x) for x in question.embedding])
+                        save_question_to_db(
+                            chain=chain, question=question.text, embedding=vector, topic_id=topic_id, document_id=doc_id
+                        )
+                        question_index.add(question.embedding)
+                        num_questions_saved += 1
+
+                    num_chunks_done += 1
+                    if progress is not None:
+                        progress("deduplicating", num_chunks_done, num_chunks)
+
+        return num_questions_saved
+
     @abstractmethod
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
         """
@@ -134,17 +371,21 @@ class DataStore(ABC):
         """
         Takes in a list of queries and filters and returns a list of query results with matching document chunks and scores.
         """
-        # get a list of of just the queries from the Query list
-        query_texts = [f"This is regarding {chain}.\n{query.query}" for query in queries]
-        print('Getting embeddings')
-        query_embeddings = get_embeddings(query_texts)
-        # hydrate the queries with embeddings
-        queries_with_embeddings = [
-            QueryWithEmbedding(**query.dict(), embedding=embedding)
-            for query, embedding in zip(queries, query_embeddings)
-        ]
-        print('Querying embeddings')
-        return await self._query(queries=queries_with_embeddings, chain=chain)
+        top_k = max((query.top_k or 0 for query in queries), default=0)
+        with span("DataStore.query", chain=chain, queries=len(queries), top_k=top_k):
+            # get a list of of just the queries from the Query list
+            query_texts = [f"This is regarding {chain}.\n{query.query}" for query in queries]
+            logger.debug('Getting embeddings')
+            query_embeddings = get_embeddings(query_texts)
+            # hydrate the queries with embeddings
+            queries_with_embeddings = [
+                QueryWithEmbedding(**query.dict(), embedding=embedding)
+                for query, embedding in zip(queries, query_embeddings)
+            ]
+            logger.debug('Querying embeddings')
+            with span(f"{type(self).__name__}._query", chain=chain, queries=len(queries), top_k=top_k), \
+                    STAGE_DURATION.time(stage="vector_query"):
+                return await self._query(queries=queries_with_embeddings, chain=chain)
 
     @abstractmethod
     async def _query(self, queries: List[QueryWithEmbedding], chain: str) -> List[QueryResult]:
@@ -159,10 +400,12 @@ class DataStore(ABC):
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """
         Removes vectors by ids, filter, or everything in the datastore.
-        Multiple parameters can be used at once.
+        Multiple parameters can be used at once. With a chain, only the vectors upserted for that chain
+        are removed, otherwise those of every chain.
         Returns whether the operation was successful.
         """
         raise NotImplementedError
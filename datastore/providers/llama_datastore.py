@@ -1,7 +1,10 @@
+import asyncio
 import json
+import logging
 import os
-from typing import Dict, List, Optional, Type
-from loguru import logger
+from typing import Dict, List, Optional, Set, Type
+
+import numpy as np
 from datastore.datastore import DataStore
 from models.models import DocumentChunk, DocumentChunkMetadata, DocumentChunkWithScore, DocumentMetadataFilter, Query, QueryResult, QueryWithEmbedding
 
@@ -10,14 +13,28 @@ from llama_index.indices.vector_store.base import GPTVectorStoreIndex
 from llama_index.indices.query.schema import QueryBundle
 from llama_index.response.schema import Response
 from llama_index.data_structs.node_v2 import Node, DocumentRelationship, NodeWithScore
+from llama_index.data_structs.data_structs_v2 import IndexDict
 from llama_index.indices.registry import INDEX_STRUCT_TYPE_TO_INDEX_CLASS
 from llama_index.data_structs.struct_type import IndexStructType
 from llama_index.indices.response.builder import ResponseMode
 
+from services.date import to_unix_timestamp
+
+logger = logging.getLogger(__name__)
+
 INDEX_STRUCT_TYPE_STR = os.environ.get('LLAMA_INDEX_TYPE', IndexStructType.SIMPLE_DICT.value)
 INDEX_JSON_PATH = os.environ.get('LLAMA_INDEX_JSON_PATH', None)
 QUERY_KWARGS_JSON_PATH = os.environ.get('LLAMA_QUERY_KWARGS_JSON_PATH', None)
 RESPONSE_MODE = os.environ.get('LLAMA_RESPONSE_MODE', ResponseMode.NO_TEXT.value)
+# Append-only log of the changes made since the index json was last written, next to it by default
+INDEX_LOG_PATH = os.environ.get(
+    'LLAMA_INDEX_LOG_PATH', f'{INDEX_JSON_PATH}.log' if INDEX_JSON_PATH else None
+)
+# The number of logged changes after which the index json is rewritten and the log truncated
+INDEX_COMPACT_THRESHOLD = int(os.environ.get('LLAMA_INDEX_COMPACT_THRESHOLD', 1000))
+
+# Metadata fields that filters match exactly
+FILTER_EQUALITY_FIELDS = ['document_id', 'source', 'source_id', 'author']
 
 EXTERNAL_VECTOR_STORE_INDEX_STRUCT_TYPES = [
     IndexStructType.DICT,
@@ -46,7 +63,7 @@ def _create_or_load_index(
         raise ValueError('Please use vector store directly.')
 
     index_cls = index_type_to_index_cls[index_type]
-    if index_json_path is None:
+    if index_json_path is None or not os.path.exists(index_json_path):
         return index_cls(nodes=[])  # Create empty index
     else:
         return index_cls.load_from_disk(index_json_path) # Load index from disk
@@ -56,18 +73,18 @@ def _create_or_load_query_kwargs(query_kwargs_json_path: Optional[str] = None) -
     query_kwargs_json_path= query_kwargs_json_path or QUERY_KWARGS_JSON_PATH
     query_kargs: Optional[dict] = None
     if  query_kwargs_json_path is not None:
-        with open(INDEX_JSON_PATH, 'r') as f:
+        with open(query_kwargs_json_path, 'r') as f:
             query_kargs = json.load(f)
     return query_kargs
 
 
-def _doc_chunk_to_node(doc_chunk: DocumentChunk, source_doc_id: str) -> Node:
+def _doc_chunk_to_node(doc_chunk: DocumentChunk, source_doc_id: str, chain: str = "") -> Node:
     """Convert document chunk to Node"""
     return Node(
         doc_id=doc_chunk.id,
         text=doc_chunk.text,
         embedding=doc_chunk.embedding,
-        extra_info=doc_chunk.metadata.dict(),
+        extra_info={**doc_chunk.metadata.dict(), 'chain': chain},
         relationships={
             DocumentRelationship.SOURCE: source_doc_id
         }
@@ -79,10 +96,51 @@ def _query_with_embedding_to_query_bundle(query: QueryWithEmbedding) -> QueryBun
         embedding=query.embedding,
     )
 
+def _node_matches_filter(
+    node: Node, metadata_filter: Optional[DocumentMetadataFilter], chain: str = ""
+) -> bool:
+    """Check whether the metadata of a node satisfies the filter and belongs to the chain."""
+    extra_info = node.extra_info or {}
+    if chain and extra_info.get('chain', '') != chain:
+        return False
+    if metadata_filter is None:
+        return True
+
+    for field in FILTER_EQUALITY_FIELDS:
+        value = getattr(metadata_filter, field)
+        if value is not None and extra_info.get(field) != value:
+            return False
+
+    # Date filters compare timestamps, so that any date string format works
+    if metadata_filter.start_date or metadata_filter.end_date:
+        created_at = extra_info.get('created_at')
+        if created_at is None:
+            return False
+        timestamp = to_unix_timestamp(created_at)
+        if metadata_filter.start_date and timestamp < to_unix_timestamp(metadata_filter.start_date):
+            return False
+        if metadata_filter.end_date and timestamp > to_unix_timestamp(metadata_filter.end_date):
+            return False
+    return True
+
+def _top_k_cosine(query_embedding: List[float], embeddings: List[List[float]], top_k: int) -> List[tuple]:
+    """Return (position, similarity) pairs of the top_k embeddings by cosine similarity."""
+    if not embeddings or top_k <= 0:
+        return []
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = 1.0
+    similarities = matrix @ query / norms
+    top = np.argsort(-similarities)[:top_k]
+    return [(int(i), float(similarities[i])) for i in top]
+
 def _source_node_to_doc_chunk_with_score(node_with_score: NodeWithScore) -> DocumentChunkWithScore:
     node = node_with_score.node
     if node.extra_info is not None:
-        metadata = DocumentChunkMetadata(**node.extra_info)
+        # The chain is stored next to the metadata, but is not part of it
+        extra_info = {key: value for key, value in node.extra_info.items() if key != 'chain'}
+        metadata = DocumentChunkMetadata(**extra_info)
     else:
         metadata = DocumentChunkMetadata()
 
@@ -98,84 +156,255 @@ def _response_to_query_result(response: Response, query: QueryWithEmbedding) ->
     return QueryResult(query=query.query, results=results,)
 
 class LlamaDataStore(DataStore):
-    def __init__(self, index: Optional[BaseGPTIndex] = None, query_kwargs: Optional[dict] = None):
-        self._index = index or _create_or_load_index()
+    def __init__(
+        self,
+        index: Optional[BaseGPTIndex] = None,
+        query_kwargs: Optional[dict] = None,
+        index_json_path: Optional[str] = None,
+        index_log_path: Optional[str] = None,
+    ):
+        """
+        Args:
+            index: The index to use, created or loaded from index_json_path if not given.
+            query_kwargs: Extra keyword arguments passed to the index queries.
+            index_json_path: Where the full index is saved, defaults to LLAMA_INDEX_JSON_PATH.
+            index_log_path: Where changes are appended between two saves of the full index,
+                defaults to LLAMA_INDEX_LOG_PATH. Without either path the index is only kept in memory.
+        """
+        self._index_json_path = index_json_path or INDEX_JSON_PATH
+        self._index_log_path = index_log_path or INDEX_LOG_PATH
+        if self._index_log_path is None and self._index_json_path is not None:
+            self._index_log_path = f'{self._index_json_path}.log'
+        self._index = index or _create_or_load_index(index_json_path=self._index_json_path)
         self._query_kwargs = query_kwargs or _create_or_load_query_kwargs()
+        self._log_size = 0
+
+        # Changes logged after the index json was last written are replayed on top of it
+        if self._index_log_path is not None and os.path.exists(self._index_log_path):
+            self._replay_log()
 
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]], chain: str = "") -> List[str]:
         """
         Takes in a list of list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
         doc_ids = []
         for doc_id, doc_chunks in chunks.items():
-            logger.debug(f"Upserting {doc_id} with {len(doc_chunks)} chunks")
-
-            nodes = [
-                _doc_chunk_to_node(doc_chunk=doc_chunk, source_doc_id=doc_id)
-                for doc_chunk in doc_chunks
-            ]
-                
-            self._index.insert_nodes(nodes)
+            self._insert_document(doc_id, doc_chunks, chain)
+            self._append_to_log(
+                {
+                    'op': 'upsert',
+                    'document_id': doc_id,
+                    'chain': chain,
+                    'chunks': [doc_chunk.dict() for doc_chunk in doc_chunks],
+                }
+            )
             doc_ids.append(doc_id)
+        self._compact_if_needed()
         return doc_ids
 
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
+        chain: str = "",
     ) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and
         returns a list of query results with matching document chunks and scores.
         """
-        query_result_all = []
-        for query in queries:
-            if query.filter is not None:
-                logger.warning('Filters are not supported yet, ignoring for now.')
-
-            query_bundle = _query_with_embedding_to_query_bundle(query)
-
-            # Setup query kwargs
-            if self._query_kwargs is not None:
-                query_kwargs = self._query_kwargs
-            else:
-                query_kwargs = {}
-            # TODO: support top_k for other indices
-            if isinstance(self._index, GPTVectorStoreIndex):
-                query_kwargs['similarity_top_k'] = query.top_k
-
-            response = await self._index.aquery(query_bundle, response_mode=RESPONSE_MODE, **query_kwargs)
-            
-            query_result = _response_to_query_result(response, query)
-            query_result_all.append(query_result)
-        
-        return query_result_all
+        return await asyncio.gather(*[self._query_one(query, chain) for query in queries])
+
+    async def _query_one(self, query: QueryWithEmbedding, chain: str = "") -> QueryResult:
+        # Vector indices are pre-filtered on the node metadata, so that top_k counts matching nodes only
+        if isinstance(self._index, GPTVectorStoreIndex) and (query.filter is not None or chain):
+            return await self._query_filtered(query, chain)
+
+        query_bundle = _query_with_embedding_to_query_bundle(query)
+
+        # Setup query kwargs, copied since queries run concurrently
+        query_kwargs = dict(self._query_kwargs) if self._query_kwargs is not None else {}
+        # TODO: support top_k for other indices
+        if isinstance(self._index, GPTVectorStoreIndex):
+            query_kwargs['similarity_top_k'] = query.top_k
+
+        response = await self._index.aquery(query_bundle, response_mode=RESPONSE_MODE, **query_kwargs)
+        query_result = _response_to_query_result(response, query)
+
+        # Other indices can only filter the nodes they returned
+        if query.filter is not None or chain:
+            query_result.results = [
+                result for result, node in zip(query_result.results, response.source_nodes)
+                if _node_matches_filter(node.node, query.filter, chain)
+            ]
+        return query_result
+
+    async def _query_filtered(self, query: QueryWithEmbedding, chain: str = "") -> QueryResult:
+        """
+        Rank the nodes of a vector index that match the query filter by cosine similarity.
+        """
+        # Collect the candidates on the event loop, as upserts change the index in between awaits
+        node_ids = list(self._index.index_struct.nodes_dict.values())
+        candidates = [
+            node for node in self._index.docstore.get_nodes(node_ids)
+            if node.embedding is not None and _node_matches_filter(node, query.filter, chain)
+        ]
+        embeddings = [node.embedding for node in candidates]
+
+        # Scoring releases the GIL in numpy, so concurrent queries overlap
+        top = await asyncio.to_thread(_top_k_cosine, query.embedding, embeddings, query.top_k or 0)
+        results = [
+            _source_node_to_doc_chunk_with_score(NodeWithScore(node=candidates[position], score=score))
+            for position, score in top
+        ]
+        return QueryResult(query=query.query, results=results)
 
     async def delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """
         Removes vectors by ids, filter, or everything in the datastore.
+        With a chain, only the documents of that chain are removed.
         Returns whether the operation was successful.
         """
-        if delete_all:
-            logger.warning('Delete all not supported yet.')
-            return False
-        
-        if filter is not None:
-            logger.warning('Filters are not supported yet.')
-            return False
+        if delete_all and not chain:
+            self._reset_index()
+            self._append_to_log({'op': 'delete_all'})
+            # Nothing is left to replay, start over from an empty index json
+            self._save_index()
+            return True
+
+        doc_ids = set(ids or [])
+        if chain and doc_ids:
+            doc_ids &= self._get_document_ids(None, chain)
+        if filter is not None or delete_all:
+            doc_ids |= self._get_document_ids(filter, chain)
+
+        for doc_id in doc_ids:
+            try:
+                self._delete_document(doc_id)
+            except NotImplementedError:
+                # NOTE: some indices does not support delete yet.
+                logger.warning(f'{type(self._index)} does not support delete yet.')
+                return False
+
+        if doc_ids:
+            self._append_to_log({'op': 'delete', 'document_ids': sorted(doc_ids)})
+            self._compact_if_needed()
+        return True
+
+    def _get_document_ids(
+        self, metadata_filter: Optional[DocumentMetadataFilter], chain: str = ""
+    ) -> Set[str]:
+        """
+        Find the ids of the documents of the chain with chunks matching the filter. Filters only cover
+        document level metadata, so every chunk of these documents matches.
+        """
+        return {
+            node.ref_doc_id
+            for node in self._index.docstore.docs.values()
+            if isinstance(node, Node) and node.ref_doc_id is not None
+            and _node_matches_filter(node, metadata_filter, chain)
+        }
+
+    def _insert_document(self, doc_id: str, doc_chunks: List[DocumentChunk], chain: str = ""):
+        logger.debug("Upserting %s with %d chunks", doc_id, len(doc_chunks))
+
+        # Replace the previous chunks of the document, which also keeps replaying the log idempotent
+        try:
+            self._delete_document(doc_id)
+        except NotImplementedError:
+            logger.warning(f'{type(self._index)} does not support delete, {doc_id} is not replaced.')
 
-        if ids is not None:
-            for id_ in ids:
+        nodes = [
+            _doc_chunk_to_node(doc_chunk=doc_chunk, source_doc_id=doc_id, chain=chain)
+            for doc_chunk in doc_chunks
+        ]
+        self._index.insert_nodes(nodes)
+
+    def _reset_index(self):
+        self._index = type(self._index)(nodes=[], service_context=self._index.service_context)
+
+    def _delete_document(self, doc_id: str):
+        """
+        Delete the chunks of a document from the index and the docstore, if it has any.
+        """
+        index_struct = self._index.index_struct
+        if isinstance(index_struct, IndexDict):
+            if doc_id not in index_struct.doc_id_dict:
+                return
+            node_ids = [
+                index_struct.nodes_dict[vector_id]
+                for vector_id in index_struct.doc_id_dict[doc_id]
+                if vector_id in index_struct.nodes_dict
+            ]
+        else:
+            node_ids = [
+                node_id for node_id, node in self._index.docstore.docs.items()
+                if isinstance(node, Node) and node.ref_doc_id == doc_id
+            ]
+            if not node_ids:
+                return
+
+        self._index.delete(doc_id)
+
+        # The index leaves the nodes in the docstore and, for vector indices, the document
+        # in doc_id_dict, which would make inserting the document again fail
+        if isinstance(index_struct, IndexDict):
+            index_struct.doc_id_dict.pop(doc_id, None)
+        for node_id in node_ids:
+            self._index.docstore.delete_document(node_id, raise_error=False)
+
+    def _append_to_log(self, record: dict):
+        """
+        Persist a change by appending it to the log, instead of rewriting the whole index json.
+        """
+        if self._index_log_path is None:
+            return
+        with open(self._index_log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_size += 1
+
+    def _replay_log(self):
+        with open(self._index_log_path, 'r') as f:  # type: ignore
+            for line in f:
+                # A crash might have cut the last record short
                 try:
-                    self._index.delete(id_)
-                except NotImplementedError:
-                    # NOTE: some indices does not support delete yet.
-                    logger.warning(f'{type(self._index)} does not support delete yet.')
-                    return False
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'Skipping a truncated record in {self._index_log_path}')
+                    continue
+
+                if record['op'] == 'upsert':
+                    doc_chunks = [DocumentChunk(**doc_chunk) for doc_chunk in record['chunks']]
+                    self._insert_document(record['document_id'], doc_chunks, record.get('chain', ''))
+                elif record['op'] == 'delete':
+                    for doc_id in record['document_ids']:
+                        self._delete_document(doc_id)
+                elif record['op'] == 'delete_all':
+                    self._reset_index()
+                self._log_size += 1
+        logger.info(f'Replayed {self._log_size} changes from {self._index_log_path}')
 
-        return True
\ No newline at end of file
+    def _compact_if_needed(self):
+        if self._log_size >= INDEX_COMPACT_THRESHOLD > 0:
+            self._save_index()
+
+    def _save_index(self):
+        """
+        Write the whole index json and truncate the log of the changes it now contains.
+        """
+        if self._index_json_path is None:
+            return
+        # Write to a temporary file first, so that a crash never leaves a partial index json behind
+        tmp_path = f'{self._index_json_path}.tmp'
+        self._index.save_to_disk(tmp_path)
+        os.replace(tmp_path, self._index_json_path)
+        if self._index_log_path is not None:
+            open(self._index_log_path, 'w').close()
+        self._log_size = 0
@@ -1,8 +1,13 @@
 import json
+import logging
 import os
+import re
+import time
 import asyncio
+import hashlib
 
-from typing import Dict, List, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from pymilvus import (
     Collection,
     connections,
@@ -27,6 +32,8 @@ from models.models import (
     DocumentChunkWithScore,
 )
 
+logger = logging.getLogger(__name__)
+
 MILVUS_COLLECTION = os.environ.get("MILVUS_COLLECTION") or "c" + uuid4().hex
 MILVUS_HOST = os.environ.get("MILVUS_HOST") or "localhost"
 MILVUS_PORT = os.environ.get("MILVUS_PORT") or 19530
@@ -37,6 +44,12 @@ MILVUS_USE_SECURITY = False if MILVUS_PASSWORD is None else True
 MILVUS_INDEX_PARAMS = os.environ.get("MILVUS_INDEX_PARAMS")
 MILVUS_SEARCH_PARAMS = os.environ.get("MILVUS_SEARCH_PARAMS")
 MILVUS_CONSISTENCY_LEVEL = os.environ.get("MILVUS_CONSISTENCY_LEVEL")
+# The number of chain partitions kept loaded on the query nodes at once
+MILVUS_MAX_LOADED_PARTITIONS = int(os.environ.get("MILVUS_MAX_LOADED_PARTITIONS", 8))
+# Comma separated chains that are loaded at startup and never released
+MILVUS_WARM_CHAINS = [
+    chain.strip() for chain in os.environ.get("MILVUS_WARM_CHAINS", "").split(",") if chain.strip()
+]
 
 UPSERT_BATCH_SIZE = 100
 OUTPUT_DIM = 1536
@@ -113,9 +126,18 @@ SCHEMA_V2 = SCHEMA_V1[1:]
 SCHEMA_V2[4][1].is_primary = True
 
 
-class MilvusDataStore(DataStore):
+def _partition_name(chain: str) -> str:
+    """Map a chain to a Milvus partition name.
+
+    Milvus only accepts letters, numbers and underscores, so other characters are replaced and a short
+    hash of the chain keeps chains that differ only in those characters apart.
+    """
+    name = re.sub(r"[^0-9a-zA-Z_]", "_", chain)[:200]
+    digest = hashlib.sha1(chain.encode("utf-8")).hexdigest()[:8]
+    return f"chain_{name}_{digest}"
 
-    partition_tags = []
+
+class MilvusDataStore(DataStore):
 
     def __init__(
         self,
@@ -136,16 +158,16 @@ class MilvusDataStore(DataStore):
         self._consistency_level = MILVUS_CONSISTENCY_LEVEL or consistency_level
         self._create_connection()
 
+        self._init_partitions(load_on_demand=True)
         self._create_collection(MILVUS_COLLECTION, create_new)  # type: ignore
         self._create_index()
+        self._warm_up_partitions(MILVUS_WARM_CHAINS)
 
     def _print_info(self, msg):
-        # TODO: logger
-        print(msg)
+        logger.info(msg)
 
     def _print_err(self, msg):
-        # TODO: logger
-        print(msg)
+        logger.error(msg)
 
     def _get_schema(self):
         return SCHEMA_V1 if self._schema_ver == "V1" else SCHEMA_V2
@@ -179,22 +201,153 @@ class MilvusDataStore(DataStore):
             self._print_err("Failed to create connection to Milvus server '{}:{}', error: {}"
                             .format(MILVUS_HOST, MILVUS_PORT, e))
             
-    def _create_partition(self, partition_tag) -> None:
-
-        if self.partition_tags.count == 0:
-            partitions = self.col.list_partitions(MILVUS_COLLECTION)
-            self.partition_tags = [partition.partition_tag for partition in partitions]
-                    
-        if partition_tag not in self.partition_tags:
-            # Step 3: Create the partition if it doesn't exist
-            status = self.col.create_partition(MILVUS_COLLECTION, partition_tag)
-            if status.code == 0:
-                self.partition_tags.append(partition_tag)
-                print(f"Partition {partition_tag} created successfully!")
-            else:
-                print(f"Failed to create partition {partition_tag}. Reason: {status.message}")
+    def _init_partitions(self, load_on_demand: bool):
+        """Set up the bookkeeping of chain partitions.
+
+        Args:
+            load_on_demand (bool): Whether partitions are loaded when first searched and released when cold.
+                                    If False, the whole collection is expected to be loaded.
+        """
+        self._load_on_demand = load_on_demand
+        # Partitions known to exist in the collection
+        self._partition_names: set = set()
+        # Loaded partitions, least recently used first
+        self._loaded_partitions: OrderedDict = OrderedDict()
+        # Partitions with searches in flight, which must not be released
+        self._partitions_in_use: Dict[str, int] = {}
+        # Partitions of the warm chains, which are never released
+        self._pinned_partitions: set = set()
+        self._partition_lock = asyncio.Lock()
+        self.partition_stats = {
+            "loads": 0,
+            "releases": 0,
+            "load_seconds": 0.0,
+            "release_seconds": 0.0,
+            "last_load_seconds": 0.0,
+            "last_release_seconds": 0.0,
+        }
+
+    def get_partition_stats(self) -> Dict:
+        """Return the partition load/release counters and latencies, and the currently loaded partitions."""
+        return {
+            **self.partition_stats,
+            "loaded_partitions": list(self._loaded_partitions.keys()),
+            "max_loaded_partitions": MILVUS_MAX_LOADED_PARTITIONS,
+        }
+
+    def _has_partition(self, partition: str) -> bool:
+        if partition not in self._partition_names and self.col.has_partition(partition):
+            self._partition_names.add(partition)
+        return partition in self._partition_names
+
+    def _create_partition(self, chain: str) -> str:
+        """Create the partition of a chain if it doesn't exist.
+
+        Args:
+            chain (str): The chain whose chunks are stored in the partition.
+
+        Returns:
+            str: The partition name.
+        """
+        partition = _partition_name(chain)
+        if not self._has_partition(partition):
+            self.col.create_partition(partition)
+            self._partition_names.add(partition)
+            self._print_info("Partition {} created for chain '{}'".format(partition, chain))
+        return partition
+
+    def _load_partition(self, partition: str):
+        start = time.perf_counter()
+        self.col.partition(partition).load()
+        elapsed = time.perf_counter() - start
+        self.partition_stats["loads"] += 1
+        self.partition_stats["load_seconds"] += elapsed
+        self.partition_stats["last_load_seconds"] = elapsed
+        self._print_info("Loaded partition {} in {:.3f}s".format(partition, elapsed))
+
+    def _release_partition(self, partition: str):
+        start = time.perf_counter()
+        self.col.partition(partition).release()
+        elapsed = time.perf_counter() - start
+        self.partition_stats["releases"] += 1
+        self.partition_stats["release_seconds"] += elapsed
+        self.partition_stats["last_release_seconds"] = elapsed
+        self._print_info("Released partition {} in {:.3f}s".format(partition, elapsed))
+
+    async def _acquire_partition(self, partition: str):
+        """Make sure a partition is loaded and mark it in use until _free_partition is called.
+
+        Cold partitions are released, least recently used first, to stay within MILVUS_MAX_LOADED_PARTITIONS.
+        Partitions that are pinned or in use are never released, so the budget can be exceeded temporarily.
+        """
+        async with self._partition_lock:
+            self._partitions_in_use[partition] = self._partitions_in_use.get(partition, 0) + 1
+            if not self._load_on_demand:
+                return
+            if partition in self._loaded_partitions:
+                self._loaded_partitions.move_to_end(partition)
+                return
+            try:
+                # The pymilvus client blocks, keep it off the event loop
+                await asyncio.to_thread(self._load_partition, partition)
+            except Exception:
+                self._partitions_in_use[partition] -= 1
+                raise
+            self._loaded_partitions[partition] = True
+            await self._evict_partitions()
+
+    async def _evict_partitions(self):
+        for cold in list(self._loaded_partitions.keys()):
+            if len(self._loaded_partitions) <= MILVUS_MAX_LOADED_PARTITIONS:
+                break
+            if cold in self._pinned_partitions or self._partitions_in_use.get(cold, 0) > 0:
+                continue
+            await asyncio.to_thread(self._release_partition, cold)
+            del self._loaded_partitions[cold]
+
+    async def _free_partition(self, partition: str):
+        async with self._partition_lock:
+            self._partitions_in_use[partition] -= 1
+            if self._partitions_in_use[partition] == 0:
+                del self._partitions_in_use[partition]
+
+    def _warm_up_partitions(self, chains: List[str]):
+        """Load and pin the partitions of the hot chains."""
+        if not self._load_on_demand:
+            return
+        for chain in chains:
+            try:
+                partition = self._create_partition(chain)
+                if partition not in self._loaded_partitions:
+                    self._load_partition(partition)
+                    self._loaded_partitions[partition] = True
+                self._pinned_partitions.add(partition)
+            except Exception as e:
+                self._print_err("Failed to warm up chain '{}', error: {}".format(chain, e))
+
+    async def _query_collection(self, expr: str, chain: str = "") -> List[dict]:
+        """Run a scalar query over the partition of a chain, or over every partition of the collection.
+
+        With on-demand loading only some partitions are in memory, so each one is acquired in turn.
+        """
+        if chain:
+            partition = _partition_name(chain)
+            # The pymilvus client blocks, keep it off the event loop
+            partitions = [partition] if await asyncio.to_thread(self._has_partition, partition) else []
         else:
-            print(f"Partition {partition_tag} already exists!")
+            partitions = await asyncio.to_thread(lambda: [p.name for p in self.col.partitions])
+        if not self._load_on_demand:
+            return self.col.query(expr, partition_names=partitions) if partitions else []  # type: ignore
+        entries = []
+        for partition in partitions:
+            await self._acquire_partition(partition)
+            try:
+                entries.extend(
+                    await asyncio.to_thread(self.col.query, expr, partition_names=[partition])
+                )
+            finally:
+                await self._free_partition(partition)
+        return entries
 
     def _create_collection(self, collection_name, create_new: bool) -> None:
         """Create a collection based on environment and passed in variables.
@@ -280,7 +433,7 @@ class MilvusDataStore(DataStore):
                         self.index_params = idx['index_param']
                         break
 
-            self.col.load()
+            # Partitions are loaded on demand by _acquire_partition, not the whole collection
 
             if self.search_params is not None:
                 # Convert the string format to JSON format parameters passed by MILVUS_SEARCH_PARAMS
@@ -321,7 +474,7 @@ class MilvusDataStore(DataStore):
             List[str]: The document_id's that were inserted.
         """
         try:
-            self._create_partition(chain)
+            partition = await asyncio.to_thread(self._create_partition, chain)
             # The doc id's to return for the upsert
             doc_ids: List[str] = []
             # List to collect all the insert data, skip the "pk" for schema V1
@@ -357,9 +510,9 @@ class MilvusDataStore(DataStore):
             for batch in batches:
                 if len(batch[0]) != 0:
                     try:
-                        self._print_info(f"Upserting batch of size {len(batch[0])}")
-                        self.col.insert(batch)
-                        self._print_info(f"Upserted batch successfully")
+                        logger.debug("Upserting batch of size %d", len(batch[0]))
+                        self.col.insert(batch, partition_name=partition)
+                        logger.debug("Upserted batch successfully")
                     except Exception as e:
                         self._print_err(f"Failed to insert batch records, error: {e}")
                         raise e
@@ -407,7 +560,7 @@ class MilvusDataStore(DataStore):
             x = values.get(key) or default
             # If one of our required fields is missing, ignore the entire entry
             if x is Required:
-                self._print_info("Chunk " + values["id"] + " missing " + key + " skipping")
+                logger.debug("Chunk %s missing %s skipping", values["id"], key)
                 return None
             # Add the corresponding value if it passes the tests
             ret.append(x)
@@ -420,48 +573,93 @@ class MilvusDataStore(DataStore):
     ) -> List[QueryResult]:
         """Query the QueryWithEmbedding against the MilvusDocumentSearch
 
-        Search the embedding and its filter in the collection.
+        Search the embedding and its filter in the collection. Queries that share the same filter and top_k
+        are sent as one multi-vector search, which runs off the event loop.
 
         Args:
             queries (List[QueryWithEmbedding]): The list of searches to perform.
 
         Returns:
-            List[QueryResult]: Results for each search.
+            List[QueryResult]: Results for each search, in the order of the queries.
         """
-        # Async to perform the query, adapted from pinecone implementation
-        async def _single_query(query: QueryWithEmbedding) -> QueryResult:
-            try:
-                # self.col.load([chain], replica_number=1)
-                
-                filter = None
-                # Set the filter to expression that is valid for Milvus
-                if query.filter is not None:
-                    # Either a valid filter or None will be returned
-                    filter = self._get_filter(query.filter)
-
-                # Perform our search
-                return_from = 2 if self._schema_ver == "V1" else 1
-                res = self.col.search(
-                    data=[query.embedding],
-                    anns_field=EMBEDDING_FIELD,
-                    param=self.search_params,
-                    limit=query.top_k,
-                    expr=filter,
-                    output_fields=[
-                        field[0] for field in self._get_schema()[return_from:]
-                    ],  # Ignoring pk, embedding
-                    partition_tags=[chain]
-                )
+        partition = _partition_name(chain)
+        if not await asyncio.to_thread(self._has_partition, partition):
+            # Nothing was ever upserted for this chain
+            return [QueryResult(query=query.query, results=[]) for query in queries]
+
+        # Group the query positions by everything a single search call must share
+        groups: Dict[Tuple[Optional[str], int], List[int]] = {}
+        for i, query in enumerate(queries):
+            # Set the filter to expression that is valid for Milvus, either a valid filter or None will be returned
+            filter = self._get_filter(query.filter) if query.filter is not None else None
+            groups.setdefault((filter or None, query.top_k), []).append(i)  # type: ignore
+
+        results: List[QueryResult] = [QueryResult(query=query.query, results=[]) for query in queries]
+        try:
+            await self._acquire_partition(partition)
+        except Exception as e:
+            self._print_err("Failed to load partition {}, error: {}".format(partition, e))
+            return results
+        try:
+            grouped_results = await asyncio.gather(
+                *[
+                    self._batch_query([queries[i] for i in positions], filter, top_k, partition)
+                    for (filter, top_k), positions in groups.items()
+                ]
+            )
+        finally:
+            await self._free_partition(partition)
+        # Split the batched results back onto the original query positions
+        for positions, batch_results in zip(groups.values(), grouped_results):
+            for i, query_results in zip(positions, batch_results):
+                results[i] = query_results
+        return results
+
+    async def _batch_query(
+        self,
+        queries: List[QueryWithEmbedding],
+        filter: Optional[str],
+        top_k: int,
+        partition: str,
+    ) -> List[QueryResult]:
+        """Run one multi-vector search for queries sharing a filter and top_k.
+
+        Args:
+            queries (List[QueryWithEmbedding]): The queries of the batch.
+            filter (Optional[str]): The Milvus expression shared by the batch.
+            top_k (int): The number of results per query.
+            partition (str): The partition to search.
+
+        Returns:
+            List[QueryResult]: Results for each query of the batch, empty if the search failed.
+        """
+        try:
+            return_from = 2 if self._schema_ver == "V1" else 1
+            output_fields = [field[0] for field in self._get_schema()[return_from:]]  # Ignoring pk, embedding
+            # The pymilvus client blocks, keep it off the event loop
+            res = await asyncio.to_thread(
+                self.col.search,
+                data=[query.embedding for query in queries],
+                anns_field=EMBEDDING_FIELD,
+                param=self.search_params,
+                limit=top_k,
+                expr=filter,
+                output_fields=output_fields,
+                partition_names=[partition],
+            )
+            batch_results = []
+            # One list of hits per query vector, in the order of the data
+            for query, hits in zip(queries, res):  # type: ignore
                 # Results that will hold our DocumentChunkWithScores
                 results = []
                 # Parse every result for our search
-                for hit in res[0]:  # type: ignore
+                for hit in hits:
                     # The distance score for the search result, falls under DocumentChunkWithScore
                     score = hit.score
                     # Our metadata info, falls under DocumentChunkMetadata
                     metadata = {}
                     # Grab the values that correspond to our fields, ignore pk and embedding.
-                    for x in [field[0] for field in self._get_schema()[return_from:]]:
+                    for x in output_fields:
                         metadata[x] = hit.entity.get(x)
                     # If the source isn't valid, convert to None
                     if metadata["source"] not in Source.__members__:
@@ -477,24 +675,21 @@ class MilvusDataStore(DataStore):
                         metadata=DocumentChunkMetadata(**metadata),
                     )
                     results.append(chunk)
+                batch_results.append(QueryResult(query=query.query, results=results))
 
-                # TODO: decide on doing queries to grab the embedding itself, slows down performance as double query occurs
+            # TODO: decide on doing queries to grab the embedding itself, slows down performance as double query occurs
 
-                return QueryResult(query=query.query, results=results)
-            except Exception as e:
-                self._print_err("Failed to query, error: {}".format(e))
-                return QueryResult(query=query.query, results=[])
-
-        results: List[QueryResult] = await asyncio.gather(
-            *[_single_query(query) for query in queries]
-        )
-        return results
+            return batch_results
+        except Exception as e:
+            self._print_err("Failed to query, error: {}".format(e))
+            return [QueryResult(query=query.query, results=[]) for query in queries]
 
     async def delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """Delete the entities based either on the chunk_id of the vector,
 
@@ -502,9 +697,10 @@ class MilvusDataStore(DataStore):
             ids (Optional[List[str]], optional): The document_ids to delete. Defaults to None.
             filter (Optional[DocumentMetadataFilter], optional): The filter to delete by. Defaults to None.
             delete_all (Optional[bool], optional): Whether to drop the collection and recreate it. Defaults to None.
+            chain (str, optional): Only delete from the partition of this chain. Defaults to every partition.
         """
         # If deleting all, drop and create the new collection
-        if delete_all:
+        if delete_all and not chain:
             coll_name = self.col.name
             self._print_info("Delete the entire collection {} and create new one".format(coll_name))
             # Release the collection from memory
@@ -512,14 +708,24 @@ class MilvusDataStore(DataStore):
             # Drop the collection
             self.col.drop()
             # Recreate the new collection
+            self._init_partitions(self._load_on_demand)
             self._create_collection(coll_name, True)
             self._create_index()
+            self._warm_up_partitions(MILVUS_WARM_CHAINS)
             return True
 
         # Keep track of how many we have deleted for later printing
         delete_count = 0
-        batch_size = 100
         pk_name = "pk" if self._schema_ver == "V1" else "id"
+
+        # Deleting all of a chain deletes every entity of its partition
+        if delete_all:
+            try:
+                all_expr = f"{pk_name} >= 0" if self._schema_ver == "V1" else f'{pk_name} != ""'
+                delete_count += await self._delete_matching(all_expr, chain)
+            except Exception as e:
+                self._print_err("Failed to delete chain {}, error: {}".format(chain, e))
+
         try:
             # According to the api design, the ids is a list of document_id,
             # document_id is not primary key, use query+delete to workaround,
@@ -527,23 +733,7 @@ class MilvusDataStore(DataStore):
             if (ids is not None) and len(ids) > 0:
                 # Add quotation marks around the string format id
                 ids = ['"' + str(id) + '"' for id in ids]
-                # Query for the pk's of entries that match id's
-                ids = self.col.query(f"document_id in [{','.join(ids)}]")
-                # Convert to list of pks
-                pks = [str(entry[pk_name]) for entry in ids]  # type: ignore
-                # for schema V2, the "id" is varchar, rewrite the expression
-                if self._schema_ver != "V1":
-                    pks = ['"' + pk + '"' for pk in pks]
-
-                # Delete by ids batch by batch(avoid too long expression)
-                self._print_info("Apply {:d} deletions to schema {:s}".format(len(pks), self._schema_ver))
-                while len(pks) > 0:
-                    batch_pks = pks[:batch_size]
-                    pks = pks[batch_size:]
-                    # Delete the entries batch by batch
-                    res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")
-                    # Increment our deleted count
-                    delete_count += int(res.delete_count)  # type: ignore
+                delete_count += await self._delete_matching(f"document_id in [{','.join(ids)}]", chain)
         except Exception as e:
             self._print_err("Failed to delete by ids, error: {}".format(e))
 
@@ -554,21 +744,7 @@ class MilvusDataStore(DataStore):
                 filter = self._get_filter(filter)  # type: ignore
                 # Check if there is anything to filter
                 if len(filter) != 0:  # type: ignore
-                    # Query for the pk's of entries that match filter
-                    res = self.col.query(filter)  # type: ignore
-                    # Convert to list of pks
-                    pks = [str(entry[pk_name]) for entry in res]  # type: ignore
-                    # for schema V2, the "id" is varchar, rewrite the expression
-                    if self._schema_ver != "V1":
-                        pks = ['"' + pk + '"' for pk in pks]
-                    # Check to see if there are valid pk's to delete, delete batch by batch(avoid too long expression)
-                    while len(pks) > 0:  # type: ignore
-                        batch_pks = pks[:batch_size]
-                        pks = pks[batch_size:]
-                        # Delete the entries batch by batch
-                        res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]")  # type: ignore
-                        # Increment our delete count
-                        delete_count += int(res.delete_count)  # type: ignore
+                    delete_count += await self._delete_matching(filter, chain)  # type: ignore
         except Exception as e:
             self._print_err("Failed to delete by filter, error: {}".format(e))
 
@@ -579,6 +755,35 @@ class MilvusDataStore(DataStore):
 
         return True
 
+    async def _delete_matching(self, expr: str, chain: str = "") -> int:
+        """Delete the entities matching an expression, in the partition of a chain or in every partition.
+
+        Returns:
+            int: The number of entities deleted.
+        """
+        delete_count = 0
+        batch_size = 100
+        pk_name = "pk" if self._schema_ver == "V1" else "id"
+        # Query for the pk's of entries that match the expression
+        res = await self._query_collection(expr, chain)
+        # Convert to list of pks
+        pks = [str(entry[pk_name]) for entry in res]
+        # for schema V2, the "id" is varchar, rewrite the expression
+        if self._schema_ver != "V1":
+            pks = ['"' + pk + '"' for pk in pks]
+        partition = {"partition_name": _partition_name(chain)} if chain else {}
+
+        # Delete by ids batch by batch(avoid too long expression)
+        self._print_info("Apply {:d} deletions to schema {:s}".format(len(pks), self._schema_ver))
+        while len(pks) > 0:
+            batch_pks = pks[:batch_size]
+            pks = pks[batch_size:]
+            # Delete the entries batch by batch
+            res = self.col.delete(f"{pk_name} in [{','.join(batch_pks)}]", **partition)
+            # Increment our deleted count
+            delete_count += int(res.delete_count)  # type: ignore
+        return delete_count
+
     def _get_filter(self, filter: DocumentMetadataFilter) -> Optional[str]:
         """Converts a DocumentMetdataFilter to the expression that Milvus takes.
 
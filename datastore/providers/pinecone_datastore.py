@@ -1,5 +1,7 @@
+import logging
 import os
-from typing import Any, Dict, List, Optional
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
 import pinecone
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 import asyncio
@@ -16,6 +18,8 @@ from models.models import (
 )
 from services.date import to_unix_timestamp
 
+logger = logging.getLogger(__name__)
+
 # Read environment variables for Pinecone configuration
 PINECONE_API_KEY = os.environ.get("PINECONE_API_KEY")
 PINECONE_ENVIRONMENT = os.environ.get("PINECONE_ENVIRONMENT")
@@ -29,20 +33,29 @@ pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
 
 # Set the batch size for upserting vectors to Pinecone
 UPSERT_BATCH_SIZE = 100
+# How long the list of namespaces that deletes go through is cached, in seconds. Other processes may add
+# topic namespaces in the meantime
+PINECONE_NAMESPACES_TTL = float(os.environ.get("PINECONE_NAMESPACES_TTL", 60))
+# Whether to tag the topic vectors upserted before they carried their chain on init, so that deletes reach them
+PINECONE_BACKFILL_CHAINS = os.environ.get("PINECONE_BACKFILL_CHAINS", "true").lower() == "true"
+PINECONE_BACKFILL_BATCH_SIZE = 100  # The number of vectors tagged at a time
 
 
 class PineconeDataStore(DataStore):
     def __init__(self):
+        # The namespaces of the index and when they were listed
+        self._namespaces: Set[str] = set()
+        self._namespaces_listed_at: Optional[float] = None
         # Check if the index name is specified and exists in Pinecone
         if PINECONE_INDEX and PINECONE_INDEX not in pinecone.list_indexes():
 
-            # Get all fields in the metadata object in a list
-            fields_to_index = list(DocumentChunkMetadata.__fields__.keys())
+            # Get all fields in the metadata object in a list, and the chain that deletes are scoped to
+            fields_to_index = list(DocumentChunkMetadata.__fields__.keys()) + ["chain"]
 
             # Create a new index with the specified name, dimension, and metadata configuration
             try:
-                print(
-                    f"Creating index {PINECONE_INDEX} with metadata config {fields_to_index}"
+                logger.info(
+                    "Creating index %s with metadata config %s", PINECONE_INDEX, fields_to_index
                 )
                 pinecone.create_index(
                     PINECONE_INDEX,
@@ -50,19 +63,21 @@ class PineconeDataStore(DataStore):
                     metadata_config={"indexed": fields_to_index},
                 )
                 self.index = pinecone.Index(PINECONE_INDEX)
-                print(f"Index {PINECONE_INDEX} created successfully")
+                logger.info("Index %s created successfully", PINECONE_INDEX)
             except Exception as e:
-                print(f"Error creating index {PINECONE_INDEX}: {e}")
+                logger.error("Error creating index %s: %s", PINECONE_INDEX, e)
                 raise e
         elif PINECONE_INDEX and PINECONE_INDEX in pinecone.list_indexes():
             # Connect to an existing index with the specified name
             try:
-                print(f"Connecting to existing index {PINECONE_INDEX}")
+                logger.info("Connecting to existing index %s", PINECONE_INDEX)
                 self.index = pinecone.Index(PINECONE_INDEX)
-                print(f"Connected to index {PINECONE_INDEX} successfully")
+                logger.info("Connected to index %s successfully", PINECONE_INDEX)
             except Exception as e:
-                print(f"Error connecting to index {PINECONE_INDEX}: {e}")
+                logger.error("Error connecting to index %s: %s", PINECONE_INDEX, e)
                 raise e
+            if PINECONE_BACKFILL_CHAINS:
+                self.backfill_chains()
 
     @retry(wait=wait_random_exponential(min=20, max=60), stop=stop_after_attempt(30))
     async def _upsert(self, chunks: Dict[str, List[DocumentChunk]], chain: str) -> List[str]:
@@ -79,7 +94,7 @@ class PineconeDataStore(DataStore):
         for doc_id, chunk_list in chunks.items():
             # Append the id to the ids list
             doc_ids.append(doc_id)
-            print(f"Upserting document_id: {doc_id}")
+            logger.debug("Upserting document_id: %s", doc_id)
             for chunk in chunk_list:
                 topic_id = chunk.topic_id if chunk.topic_id != None else 'other'
                 topic_ids.add(topic_id)
@@ -92,6 +107,8 @@ class PineconeDataStore(DataStore):
                 pinecone_metadata["text"] = chunk.text
                 pinecone_metadata["document_id"] = doc_id
                 pinecone_metadata["topic_id"] = topic_id
+                # The topic namespaces are shared by all chains
+                pinecone_metadata["chain"] = chain
                 vector = (chunk.id, chunk.embedding, pinecone_metadata)
                 vectors.append(vector)
 
@@ -103,16 +120,17 @@ class PineconeDataStore(DataStore):
         # Upsert each batch to Pinecone
         for batch in batches:
             try:
-                print(f"Upserting chain batch of size {len(batch)}")
+                logger.debug("Upserting chain batch of size %s", len(batch))
                 self.index.upsert(vectors=batch, namespace=f"chain_{chain}")
-                print("Upserted chain batch successfully")
+                self._namespaces.add(f"chain_{chain}")
+                logger.debug("Upserted chain batch successfully")
             except Exception as e:
-                print(f"Error upserting chain batch: {e}")
+                logger.error("Error upserting chain batch: %s", e)
                 raise e
         
         # Iterate through the set and create chunk batches
         for topic_id in topic_ids:
-            print(f"topic_id: {topic_id}")
+            logger.debug("topic_id: %s", topic_id)
             vectors_filtered = [v for v in vectors if v[2]["topic_id"] == topic_id]
             topic_batches = [
                 vectors_filtered[i : i + UPSERT_BATCH_SIZE]
@@ -121,11 +139,12 @@ class PineconeDataStore(DataStore):
             # Upsert each batch to Pinecone
             for batch in topic_batches:
                 try:
-                    print(f"Upserting topic batch of size {len(batch)}")
+                    logger.debug("Upserting topic batch of size %s", len(batch))
                     self.index.upsert(vectors=batch, namespace=f"topic_{topic_id}")
-                    print("Upserted topic batch successfully")
+                    self._namespaces.add(f"topic_{topic_id}")
+                    logger.debug("Upserted topic batch successfully")
                 except Exception as e:
-                    print(f"Error upserting topic batch: {e}")
+                    logger.error("Error upserting topic batch: %s", e)
                     raise e
 
         return doc_ids
@@ -141,7 +160,7 @@ class PineconeDataStore(DataStore):
         """
         # Define a helper coroutine that performs a single query and returns a QueryResult
         async def _single_query(query: QueryWithEmbedding) -> QueryResult:
-            print(f"Query: {query.query}")
+            logger.debug("Query: %s", query.query)
 
             # Convert the metadata filter object to a dict with pinecone filter expressions
             pinecone_filter = self._get_pinecone_filter(query.filter)
@@ -156,7 +175,7 @@ class PineconeDataStore(DataStore):
                     include_metadata=True,
                 )
             except Exception as e:
-                print(f"Error querying index: {e}")
+                logger.error("Error querying index: %s", e)
                 raise e
 
             query_results: List[DocumentChunkWithScore] = []
@@ -200,19 +219,26 @@ class PineconeDataStore(DataStore):
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """
-        Removes vectors by ids, filter, or everything from the index.
+        Removes vectors by ids, filter, or everything from the namespaces of a chain, or of every chain.
         """
-        # Delete all vectors from the index if delete_all is True
+        namespaces = self._get_namespaces(chain)
+
+        # Delete all vectors of the chain, or of the index, if delete_all is True
         if delete_all:
             try:
-                print(f"Deleting all vectors from index")
-                self.index.delete(delete_all=True)
-                print(f"Deleted all vectors successfully")
+                logger.info("Deleting all vectors of chain %s", chain or "*")
+                for namespace, chain_filter in namespaces:
+                    if chain_filter:
+                        self.index.delete(filter=chain_filter, namespace=namespace)
+                    else:
+                        self.index.delete(delete_all=True, namespace=namespace)
+                logger.info("Deleted all vectors successfully")
                 return True
             except Exception as e:
-                print(f"Error deleting all vectors: {e}")
+                logger.error("Error deleting all vectors: %s", e)
                 raise e
 
         # Convert the metadata filter object to a dict with pinecone filter expressions
@@ -220,25 +246,90 @@ class PineconeDataStore(DataStore):
         # Delete vectors that match the filter from the index if the filter is not empty
         if pinecone_filter != {}:
             try:
-                print(f"Deleting vectors with filter {pinecone_filter}")
-                self.index.delete(filter=pinecone_filter)
-                print(f"Deleted vectors with filter successfully")
+                logger.info("Deleting vectors with filter %s", pinecone_filter)
+                for namespace, chain_filter in namespaces:
+                    self.index.delete(filter={**pinecone_filter, **chain_filter}, namespace=namespace)
+                logger.info("Deleted vectors with filter successfully")
             except Exception as e:
-                print(f"Error deleting vectors with filter: {e}")
+                logger.error("Error deleting vectors with filter: %s", e)
                 raise e
 
         # Delete vectors that match the document ids from the index if the ids list is not empty
         if ids is not None and len(ids) > 0:
             try:
-                print(f"Deleting vectors with ids {ids}")
+                logger.info("Deleting vectors with ids %s", ids)
                 pinecone_filter = {"document_id": {"$in": ids}}
-                self.index.delete(filter=pinecone_filter)  # type: ignore
-                print(f"Deleted vectors with ids successfully")
+                for namespace, chain_filter in namespaces:
+                    self.index.delete(filter={**pinecone_filter, **chain_filter}, namespace=namespace)  # type: ignore
+                logger.info("Deleted vectors with ids successfully")
             except Exception as e:
-                print(f"Error deleting vectors with ids: {e}")
+                logger.error("Error deleting vectors with ids: %s", e)
                 raise e
 
         return True
+
+    def _get_namespaces(self, chain: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Return the namespaces holding the vectors of a chain, with the filter selecting them in each one:
+        the namespace of the chain as a whole, and the vectors of the chain in the topic namespaces shared
+        by all chains. Without a chain, every namespace of the index as a whole.
+        """
+        if (
+            self._namespaces_listed_at is None
+            or time.monotonic() - self._namespaces_listed_at > PINECONE_NAMESPACES_TTL
+        ):
+            self._namespaces = set(self.index.describe_index_stats().namespaces)
+            self._namespaces_listed_at = time.monotonic()
+        namespaces = sorted(self._namespaces)
+        if not chain:
+            return [(namespace, {}) for namespace in namespaces]
+        return [(f"chain_{chain}", {})] + [
+            (namespace, {"chain": chain}) for namespace in namespaces if namespace.startswith("topic_")
+        ]
+
+    def backfill_chains(self) -> int:
+        """
+        Tag the vectors of the topic namespaces upserted before they carried their chain with the chain
+        namespace holding the same chunk id, in batches of PINECONE_BACKFILL_BATCH_SIZE. Topic vectors that
+        no chain namespace holds anymore are stale copies, and are deleted. Runs on init, where finding
+        nothing to tag costs one query per topic namespace.
+
+        Returns:
+            int: Number of vectors tagged.
+        """
+        stats = self.index.describe_index_stats()
+        chain_namespaces = [namespace for namespace in stats.namespaces if namespace.startswith("chain_")]
+        # Any vector finds the matches of the filter
+        probe = [1.0] + [0.0] * (stats.dimension - 1)
+        tagged = 0
+        deleted = 0
+        for namespace in [namespace for namespace in stats.namespaces if namespace.startswith("topic_")]:
+            while True:
+                matches = self.index.query(
+                    namespace=namespace,
+                    vector=probe,
+                    top_k=PINECONE_BACKFILL_BATCH_SIZE,
+                    filter={"chain": {"$exists": False}},
+                ).matches
+                if not matches:
+                    break
+                ids = [match.id for match in matches]
+                chains: Dict[str, str] = {}
+                for chain_namespace in chain_namespaces:
+                    for id in self.index.fetch(ids=ids, namespace=chain_namespace).vectors:
+                        chains.setdefault(id, chain_namespace[len("chain_") :])
+                for id in ids:
+                    if id in chains:
+                        self.index.update(id=id, set_metadata={"chain": chains[id]}, namespace=namespace)
+                        tagged += 1
+                stale = [id for id in ids if id not in chains]
+                if stale:
+                    self.index.delete(ids=stale, namespace=namespace)
+                    deleted += len(stale)
+        if tagged or deleted:
+            logger.info("Tagged %d topic vectors with their chain, deleted %d stale ones", tagged, deleted)
+        return tagged
+
     def _get_pinecone_filter(
         self, filter: Optional[DocumentMetadataFilter] = None
     ) -> Dict[str, Any]:
@@ -1,5 +1,6 @@
 import os
 import uuid
+import asyncio
 from typing import Dict, List, Optional
 
 from grpc._channel import _InactiveRpcError
@@ -25,6 +26,51 @@ QDRANT_PORT = os.environ.get("QDRANT_PORT", "6333")
 QDRANT_GRPC_PORT = os.environ.get("QDRANT_GRPC_PORT", "6334")
 QDRANT_API_KEY = os.environ.get("QDRANT_API_KEY")
 QDRANT_COLLECTION = os.environ.get("QDRANT_COLLECTION", "document_chunks")
+# The number of points sent per upsert request, keeping gRPC messages well under their size limit
+QDRANT_UPSERT_BATCH_SIZE = int(os.environ.get("QDRANT_UPSERT_BATCH_SIZE", 100))
+# The number of upsert requests in flight at once
+QDRANT_UPSERT_PARALLELISM = int(os.environ.get("QDRANT_UPSERT_PARALLELISM", 4))
+# Whether each upsert waits for the points to be indexed, or returns once Qdrant acknowledged them
+QDRANT_UPSERT_WAIT = os.environ.get("QDRANT_UPSERT_WAIT", "true").lower() == "true"
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+# Vector compression, one of "none", "scalar" (int8, 4x smaller) or "product" (up to 64x smaller)
+QDRANT_QUANTIZATION = os.environ.get("QDRANT_QUANTIZATION", "none").lower()
+# Values outside this quantile are clipped by scalar quantization, so outliers don't waste the int8 range
+QDRANT_QUANTIZATION_QUANTILE = float(os.environ.get("QDRANT_QUANTIZATION_QUANTILE", 0.99))
+# Keep the quantized vectors in RAM even when the original vectors live on disk
+QDRANT_QUANTIZATION_ALWAYS_RAM = (
+    os.environ.get("QDRANT_QUANTIZATION_ALWAYS_RAM", "true").lower() == "true"
+)
+# The compression ratio of product quantization, one of x4, x8, x16, x32 or x64
+QDRANT_PRODUCT_COMPRESSION = os.environ.get("QDRANT_PRODUCT_COMPRESSION", "x16").lower()
+# Store the original vectors in memmapped segments on disk instead of RAM
+QDRANT_ON_DISK_VECTORS = os.environ.get("QDRANT_ON_DISK_VECTORS", "false").lower() == "true"
+# Segments larger than this many kilobytes are memmapped when the vectors are on disk
+QDRANT_MEMMAP_THRESHOLD_KB = int(os.environ.get("QDRANT_MEMMAP_THRESHOLD_KB", 20000))
+# HNSW graph settings, unset values use the Qdrant defaults (m=16, ef_construct=100)
+QDRANT_HNSW_M = _optional_int("QDRANT_HNSW_M")
+QDRANT_HNSW_EF_CONSTRUCT = _optional_int("QDRANT_HNSW_EF_CONSTRUCT")
+QDRANT_HNSW_ON_DISK = os.environ.get("QDRANT_HNSW_ON_DISK", "false").lower() == "true"
+# The search beam size, larger values trade latency for recall
+QDRANT_SEARCH_HNSW_EF = _optional_int("QDRANT_SEARCH_HNSW_EF")
+# Rescore the quantized candidates with the original vectors
+QDRANT_SEARCH_RESCORE = os.environ.get("QDRANT_SEARCH_RESCORE", "true").lower() == "true"
+
+# Payload fields indexed so that filtered searches and deletes don't scan the collection
+PAYLOAD_INDEXES = {
+    "metadata.document_id": PayloadSchemaType.KEYWORD,
+    "metadata.source": PayloadSchemaType.KEYWORD,
+    "metadata.source_id": PayloadSchemaType.KEYWORD,
+    "created_at": PayloadSchemaType.INTEGER,
+    "chain": PayloadSchemaType.KEYWORD,
+    "topic_id": PayloadSchemaType.KEYWORD,
+}
 
 
 class QdrantDataStore(DataStore):
@@ -36,6 +82,9 @@ class QdrantDataStore(DataStore):
         vector_size: int = 1536,
         distance: str = "Cosine",
         recreate_collection: bool = False,
+        upsert_wait: bool = QDRANT_UPSERT_WAIT,
+        quantization: str = QDRANT_QUANTIZATION,
+        on_disk_vectors: bool = QDRANT_ON_DISK_VECTORS,
     ):
         """
         Args:
@@ -44,7 +93,21 @@ class QdrantDataStore(DataStore):
             distance:
                 Any of "Cosine" / "Euclid" / "Dot". Distance function to measure
                 similarity
+            upsert_wait: Whether upserts wait for the points to be indexed. If False,
+                upserts only wait for Qdrant to acknowledge each batch.
+            quantization: Any of "none" / "scalar" / "product". Compression of the
+                vectors used by the search, applied when the collection is created
+            on_disk_vectors: Whether the original vectors are memmapped from disk,
+                leaving only the quantized vectors and the HNSW graph in RAM
         """
+        if quantization not in ("none", "scalar", "product"):
+            raise ValueError(
+                f"Unsupported quantization '{quantization}', "
+                f"expected one of 'none', 'scalar' or 'product'."
+            )
+        self.upsert_wait = upsert_wait
+        self.quantization = quantization
+        self.on_disk_vectors = on_disk_vectors
         self.client = qdrant_client.QdrantClient(
             url=QDRANT_URL,
             port=int(QDRANT_PORT),
@@ -58,34 +121,59 @@ class QdrantDataStore(DataStore):
         # Set up the collection so the points might be inserted or queried
         self._set_up_collection(vector_size, distance, recreate_collection)
 
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]], chain: str = "") -> List[str]:
         """
         Takes in a list of document chunks and inserts them into the database.
         Return a list of document ids.
         """
         points = [
-            self._convert_document_chunk_to_point(chunk)
+            self._convert_document_chunk_to_point(chunk, chain)
             for _, chunks in chunks.items()
             for chunk in chunks
         ]
-        self.client.upsert(
-            collection_name=self.collection_name,
-            points=points,  # type: ignore
-            wait=True,
-        )
+        batches = [
+            points[i : i + QDRANT_UPSERT_BATCH_SIZE]
+            for i in range(0, len(points), QDRANT_UPSERT_BATCH_SIZE)
+        ]
+        semaphore = asyncio.Semaphore(QDRANT_UPSERT_PARALLELISM)
+
+        async def _upsert_batch(batch: List[rest.PointStruct]) -> rest.UpdateResult:
+            async with semaphore:
+                # The qdrant client blocks, keep it off the event loop
+                return await asyncio.to_thread(
+                    self.client.upsert,
+                    collection_name=self.collection_name,
+                    points=batch,  # type: ignore
+                    wait=self.upsert_wait,
+                )
+
+        results = await asyncio.gather(*[_upsert_batch(batch) for batch in batches])
+
+        # Without wait, a batch is confirmed as soon as Qdrant acknowledged it
+        for result in results:
+            if result.status not in (
+                rest.UpdateStatus.ACKNOWLEDGED,
+                rest.UpdateStatus.COMPLETED,
+            ):
+                raise Exception(
+                    f"Qdrant upsert operation {result.operation_id} returned status {result.status}"
+                )
         return list(chunks.keys())
 
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
+        chain: str = "",
     ) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
         """
         search_requests = [
-            self._convert_query_to_search_request(query) for query in queries
+            self._convert_query_to_search_request(query, chain) for query in queries
         ]
-        results = self.client.search_batch(
+        # The qdrant client blocks, keep it off the event loop
+        results = await asyncio.to_thread(
+            self.client.search_batch,
             collection_name=self.collection_name,
             requests=search_requests,
         )
@@ -105,9 +193,10 @@ class QdrantDataStore(DataStore):
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """
-        Removes vectors by ids, filter, or everything in the datastore.
+        Removes vectors by ids, filter, or everything in the datastore, only those of the chain if given.
         Returns whether the operation was successful.
         """
         if ids is None and filter is None and delete_all is None:
@@ -116,10 +205,10 @@ class QdrantDataStore(DataStore):
             )
 
         if delete_all:
-            points_selector = rest.Filter()
+            points_selector = self._convert_metadata_filter_to_qdrant_filter(chain=chain) or rest.Filter()
         else:
             points_selector = self._convert_metadata_filter_to_qdrant_filter(
-                filter, ids
+                filter, ids, chain
             )
 
         response = self.client.delete(
@@ -129,7 +218,7 @@ class QdrantDataStore(DataStore):
         return "COMPLETED" == response.status
 
     def _convert_document_chunk_to_point(
-        self, document_chunk: DocumentChunk
+        self, document_chunk: DocumentChunk, chain: str = ""
     ) -> rest.PointStruct:
         created_at = (
             to_unix_timestamp(document_chunk.metadata.created_at)
@@ -144,6 +233,8 @@ class QdrantDataStore(DataStore):
                 "text": document_chunk.text,
                 "metadata": document_chunk.metadata.dict(),
                 "created_at": created_at,
+                "chain": chain,
+                "topic_id": document_chunk.topic_id,
             },
         )
 
@@ -153,26 +244,47 @@ class QdrantDataStore(DataStore):
         return uuid.uuid5(self.UUID_NAMESPACE, external_id).hex
 
     def _convert_query_to_search_request(
-        self, query: QueryWithEmbedding
+        self, query: QueryWithEmbedding, chain: str = ""
     ) -> rest.SearchRequest:
         return rest.SearchRequest(
             vector=query.embedding,
-            filter=self._convert_metadata_filter_to_qdrant_filter(query.filter),
+            filter=self._convert_metadata_filter_to_qdrant_filter(query.filter, chain=chain),
             limit=query.top_k,  # type: ignore
             with_payload=True,
             with_vector=False,
+            params=self._search_params(),
+        )
+
+    def _search_params(self) -> Optional[rest.SearchParams]:
+        quantization_params = (
+            rest.QuantizationSearchParams(rescore=QDRANT_SEARCH_RESCORE)
+            if self.quantization != "none"
+            else None
+        )
+        if QDRANT_SEARCH_HNSW_EF is None and quantization_params is None:
+            return None
+        return rest.SearchParams(
+            hnsw_ef=QDRANT_SEARCH_HNSW_EF,
+            quantization=quantization_params,
         )
 
     def _convert_metadata_filter_to_qdrant_filter(
         self,
         metadata_filter: Optional[DocumentMetadataFilter] = None,
         ids: Optional[List[str]] = None,
+        chain: str = "",
     ) -> Optional[rest.Filter]:
-        if metadata_filter is None and ids is None:
+        if metadata_filter is None and ids is None and not chain:
             return None
 
         must_conditions, should_conditions = [], []
 
+        # Scope searches to the chain the chunks were upserted for
+        if chain:
+            must_conditions.append(
+                rest.FieldCondition(key="chain", match=rest.MatchValue(value=chain))
+            )
+
         # Filtering by document ids
         if ids and len(ids) > 0:
             for document_id in ids:
@@ -268,6 +380,17 @@ class QdrantDataStore(DataStore):
                     f"If you want to use that collection, but with a different "
                     f"vector size, please set `recreate_collection=True` argument."
                 )
+
+            # Collections created by older versions miss some of the payload indexes
+            self._create_payload_indexes(collection_info.payload_schema or {})
+
+            # Quantization and HNSW settings are fixed when the collection is created,
+            # but the vectors might still be moved to disk
+            if self.on_disk_vectors:
+                self.client.update_collection(
+                    self.collection_name,
+                    optimizer_config=self._optimizers_config(),
+                )
         except (UnexpectedResponse, _InactiveRpcError):
             self._recreate_collection(distance, vector_size)
 
@@ -278,20 +401,62 @@ class QdrantDataStore(DataStore):
                 size=vector_size,
                 distance=distance,
             ),
+            hnsw_config=self._hnsw_config(),
+            optimizers_config=self._optimizers_config(),
+            quantization_config=self._quantization_config(),
         )
 
-        # Create the payload index for the document_id metadata attribute, as it is
-        # used to delete the document related entries
-        self.client.create_payload_index(
-            self.collection_name,
-            field_name="metadata.document_id",
-            field_type=PayloadSchemaType.KEYWORD,
-        )
+        self._create_payload_indexes({})
 
-        # Create the payload index for the created_at attribute, to make the lookup
-        # by range filters faster
-        self.client.create_payload_index(
-            self.collection_name,
-            field_name="created_at",
-            field_schema=PayloadSchemaType.INTEGER,
+    def _hnsw_config(self) -> Optional[rest.HnswConfigDiff]:
+        if QDRANT_HNSW_M is None and QDRANT_HNSW_EF_CONSTRUCT is None and not QDRANT_HNSW_ON_DISK:
+            return None
+        return rest.HnswConfigDiff(
+            m=QDRANT_HNSW_M,
+            ef_construct=QDRANT_HNSW_EF_CONSTRUCT,
+            on_disk=QDRANT_HNSW_ON_DISK or None,
         )
+
+    def _optimizers_config(self) -> Optional[rest.OptimizersConfigDiff]:
+        if not self.on_disk_vectors:
+            return None
+        return rest.OptimizersConfigDiff(memmap_threshold=QDRANT_MEMMAP_THRESHOLD_KB)
+
+    def _quantization_config(self) -> Optional[rest.QuantizationConfig]:
+        if self.quantization == "scalar":
+            return rest.ScalarQuantization(
+                scalar=rest.ScalarQuantizationConfig(
+                    type=rest.ScalarType.INT8,
+                    quantile=QDRANT_QUANTIZATION_QUANTILE,
+                    always_ram=QDRANT_QUANTIZATION_ALWAYS_RAM,
+                )
+            )
+        if self.quantization == "product":
+            # Product quantization is only available from qdrant-client 1.2 on
+            if not hasattr(rest, "ProductQuantization"):
+                raise ValueError(
+                    "Product quantization requires qdrant-client>=1.2, "
+                    "please upgrade it or set QDRANT_QUANTIZATION=scalar."
+                )
+            return rest.ProductQuantization(
+                product=rest.ProductQuantizationConfig(
+                    compression=rest.CompressionRatio(QDRANT_PRODUCT_COMPRESSION),
+                    always_ram=QDRANT_QUANTIZATION_ALWAYS_RAM,
+                )
+            )
+        return None
+
+    def _create_payload_indexes(self, existing_indexes: Dict):
+        """
+        Create the payload indexes that are missing from the collection. The document_id
+        index serves deletes, created_at range filters, and chain/topic/source the
+        filtered searches.
+        """
+        for field_name, field_schema in PAYLOAD_INDEXES.items():
+            if field_name in existing_indexes:
+                continue
+            self.client.create_payload_index(
+                self.collection_name,
+                field_name=field_name,
+                field_schema=field_schema,
+            )
@@ -2,7 +2,6 @@ import asyncio
 import logging
 import os
 import re
-import json
 import redis.asyncio as redis
 import numpy as np
 
@@ -26,6 +25,8 @@ from models.models import (
 )
 from services.date import to_unix_timestamp
 
+logger = logging.getLogger(__name__)
+
 # Read environment variables for Redis
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
@@ -35,6 +36,9 @@ REDIS_DOC_PREFIX = os.environ.get("REDIS_DOC_PREFIX", "doc")
 REDIS_DISTANCE_METRIC = os.environ.get("REDIS_DISTANCE_METRIC", "COSINE")
 REDIS_INDEX_TYPE = os.environ.get("REDIS_INDEX_TYPE", "FLAT")
 assert REDIS_INDEX_TYPE in ("FLAT", "HNSW")
+REDIS_VECTOR_TYPE = os.environ.get("REDIS_VECTOR_TYPE", "FLOAT32")
+assert REDIS_VECTOR_TYPE in ("FLOAT32", "FLOAT64")
+REDIS_MIGRATE_VECTOR_TYPE = os.environ.get("REDIS_MIGRATE_VECTOR_TYPE", "false").lower() == "true"
 
 # OpenAI Ada Embeddings Dimension
 VECTOR_DIMENSION = 1536
@@ -45,6 +49,27 @@ REDIS_REQUIRED_MODULES = [
     {"name": "ReJSON", "ver": 20404}
 ]
 REDIS_DEFAULT_ESCAPED_CHARS = re.compile(r"[,.<>{}\[\]\\\"\':;!@#$%^&*()\-+=~\/ ]")
+REDIS_VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT64": np.float64}
+# Indexes created before the vector type was configurable were always FLOAT64
+REDIS_LEGACY_VECTOR_TYPE = "FLOAT64"
+
+# Chunk fields returned by a search, read straight from the JSON paths instead of decoding the whole document
+REDIS_RETURN_FIELDS = {
+    "text": "$.text",
+    "document_id": "$.metadata.document_id",
+    "source": "$.metadata.source",
+    "source_id": "$.metadata.source_id",
+    "url": "$.metadata.url",
+    "created_at": "$.metadata.created_at",
+    "author": "$.metadata.author",
+    "page_start": "$.metadata.page_start",
+    "page_end": "$.metadata.page_end",
+}
+REDIS_NULL_VALUE = "_null_"
+# The number of chunk keys fetched per RediSearch call when deleting by metadata filter
+REDIS_DELETE_BATCH_SIZE = 1000
+# The number of chunk keys added to the document key sets per pipeline when backfilling them
+REDIS_BACKFILL_BATCH_SIZE = 1000
 
 # Helper functions
 def unpack_schema(d: dict):
@@ -62,18 +87,65 @@ async def _check_redis_module_exist(client: redis.Redis, modules: List[dict]):
         if module["name"] not in installed_modules or int(installed_modules[module["name"]]["ver"]) < int(module["ver"]):
             error_message =  "You must add the RediSearch (>= 2.6) and ReJSON (>= 2.4) modules from Redis Stack. " \
                 "Please refer to Redis Stack docs: https://redis.io/docs/stack/"
-            logging.error(error_message)
+            logger.error(error_message)
             raise AttributeError(error_message)
 
+def _vector_type_key() -> str:
+    """
+    Key of the marker that records the vector type the RediSearch index was created with.
+    """
+    return f"{REDIS_INDEX_NAME}:vector_type"
+
+def _document_key_sets_key() -> str:
+    """
+    Key of the marker that records that the document key sets were backfilled from the stored chunks.
+    """
+    return f"{REDIS_INDEX_NAME}:doc_keys_built"
+
+def _build_schema(dim: int, vector_type: str) -> dict:
+    return {
+        "document_id": TagField("$.document_id", as_name="document_id"),
+        "metadata": {
+            "source_id": TagField("$.metadata.source_id", as_name="source_id"),
+            "source": TagField("$.metadata.source", as_name="source"),
+            "author": TextField("$.metadata.author", as_name="author"),
+            "created_at": NumericField("$.metadata.created_at", as_name="created_at"),
+        },
+        "embedding": VectorField(
+            "$.embedding",
+            REDIS_INDEX_TYPE,
+            {
+                "TYPE": vector_type,
+                "DIM": dim,
+                "DISTANCE_METRIC": REDIS_DISTANCE_METRIC,
+            },
+            as_name="embedding",
+        ),
+    }
+
+async def _create_index(client: redis.Redis, redisearch_schema: dict, vector_type: str):
+    logger.info(f"Creating new RediSearch index {REDIS_INDEX_NAME}")
+    definition = IndexDefinition(
+        prefix=[REDIS_DOC_PREFIX], index_type=IndexType.JSON
+    )
+    fields = list(unpack_schema(redisearch_schema))
+    logger.info(f"Creating index with fields: {fields}")
+    await client.ft(REDIS_INDEX_NAME).create_index(
+        fields=fields, definition=definition
+    )
+    await client.set(_vector_type_key(), vector_type)
+
 
 
 class RedisDataStore(DataStore):
-    def __init__(self, client: redis.Redis, redisearch_schema):
+    def __init__(self, client: redis.Redis, redisearch_schema, vector_type: str = REDIS_VECTOR_TYPE):
         self.client = client
         self._schema = redisearch_schema
+        # Query vectors must be serialized with the same type the index stores
+        self._vector_dtype = REDIS_VECTOR_DTYPES[vector_type]
         # Init default metadata with sentinel values in case the document written has no metadata
         self._default_metadata = {
-            field: "_null_" for field in redisearch_schema["metadata"]
+            field: REDIS_NULL_VALUE for field in redisearch_schema["metadata"]
         }
 
     ### Redis Helper Methods ###
@@ -85,52 +157,50 @@ class RedisDataStore(DataStore):
         """
         try:
             # Connect to the Redis Client
-            logging.info("Connecting to Redis")
+            logger.info("Connecting to Redis")
             client = redis.Redis(
                 host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD
             )
         except Exception as e:
-            logging.error(f"Error setting up Redis: {e}")
+            logger.error(f"Error setting up Redis: {e}")
             raise e
 
         await _check_redis_module_exist(client, modules=REDIS_REQUIRED_MODULES)
        
         dim = kwargs.get("dim", VECTOR_DIMENSION)
-        redisearch_schema = {
-            "document_id": TagField("$.document_id", as_name="document_id"),
-            "metadata": {
-                "source_id": TagField("$.metadata.source_id", as_name="source_id"),
-                "source": TagField("$.metadata.source", as_name="source"),
-                "author": TextField("$.metadata.author", as_name="author"),
-                "created_at": NumericField("$.metadata.created_at", as_name="created_at"),
-            },
-            "embedding": VectorField(
-                "$.embedding",
-                REDIS_INDEX_TYPE,
-                {
-                    "TYPE": "FLOAT64",
-                    "DIM": dim,
-                    "DISTANCE_METRIC": REDIS_DISTANCE_METRIC,
-                },
-                as_name="embedding",
-            ),
-        }
+        vector_type = REDIS_VECTOR_TYPE
         try:
             # Check for existence of RediSearch Index
             await client.ft(REDIS_INDEX_NAME).info()
-            logging.info(f"RediSearch index {REDIS_INDEX_NAME} already exists")
+            index_exists = True
         except:
+            index_exists = False
+
+        if not index_exists:
             # Create the RediSearch Index
-            logging.info(f"Creating new RediSearch index {REDIS_INDEX_NAME}")
-            definition = IndexDefinition(
-                prefix=[REDIS_DOC_PREFIX], index_type=IndexType.JSON
-            )
-            fields = list(unpack_schema(redisearch_schema))
-            logging.info(f"Creating index with fields: {fields}")
-            await client.ft(REDIS_INDEX_NAME).create_index(
-                fields=fields, definition=definition
-            )
-        return cls(client, redisearch_schema)
+            await _create_index(client, _build_schema(dim, vector_type), vector_type)
+        else:
+            logger.info(f"RediSearch index {REDIS_INDEX_NAME} already exists")
+            existing_type = await client.get(_vector_type_key())
+            existing_type = existing_type.decode() if existing_type else REDIS_LEGACY_VECTOR_TYPE
+            if existing_type != vector_type:
+                if REDIS_MIGRATE_VECTOR_TYPE:
+                    # The chunks are JSON documents, so the index can be rebuilt with the new vector type
+                    # without rewriting them. RediSearch re-indexes the existing keys in the background.
+                    logger.info(f"Migrating RediSearch index {REDIS_INDEX_NAME} from {existing_type} to {vector_type}")
+                    await client.ft(REDIS_INDEX_NAME).dropindex(delete_documents=False)
+                    await _create_index(client, _build_schema(dim, vector_type), vector_type)
+                else:
+                    logger.warning(
+                        f"RediSearch index {REDIS_INDEX_NAME} stores {existing_type} vectors, not {vector_type}. "
+                        "Set REDIS_MIGRATE_VECTOR_TYPE=true to rebuild it."
+                    )
+                    vector_type = existing_type
+        datastore = cls(client, _build_schema(dim, vector_type), vector_type)
+        if not await client.exists(_document_key_sets_key()):
+            # Chunks written before the key sets were maintained on upsert would never be deleted by id
+            await datastore.rebuild_document_key_sets()
+        return datastore
 
     @staticmethod
     def _redis_key(document_id: str, chunk_id: str) -> str:
@@ -144,7 +214,27 @@ class RedisDataStore(DataStore):
         Returns:
             str: JSON key string.
         """
-        return f"doc:{document_id}:chunk:{chunk_id}"
+        return f"{REDIS_DOC_PREFIX}:{document_id}:chunk:{chunk_id}"
+
+    @staticmethod
+    def _redis_document_keys_key(document_id: str) -> str:
+        """
+        Create the key of the set that holds the chunk keys of a document.
+
+        Args:
+            document_id (str): Document Identifier
+
+        Returns:
+            str: Set key string.
+        """
+        return f"{REDIS_INDEX_NAME}:doc_keys:{document_id}"
+
+    @staticmethod
+    def _document_id_from_key(key: str) -> str:
+        """
+        Recover the document id from a chunk key created by _redis_key.
+        """
+        return key[len(REDIS_DOC_PREFIX) + 1 :].rsplit(":chunk:", 1)[0]
 
     @staticmethod
     def _escape(value: str) -> str:
@@ -202,6 +292,33 @@ class RedisDataStore(DataStore):
         Returns:
             RediSearchQuery: Query for RediSearch.
         """
+        filter_str = self._get_redis_filter(query.filter) if query.filter else "*"
+
+        # Prepare query string
+        query_str = (
+            f"({filter_str})=>[KNN {query.top_k} @embedding $embedding as score]"
+        )
+        redis_query = RediSearchQuery(query_str).return_field("score")
+        for field, path in REDIS_RETURN_FIELDS.items():
+            redis_query = redis_query.return_field(path, as_field=field)
+        return (
+            redis_query
+            .sort_by("score")
+            .paging(0, query.top_k)
+            .dialect(2)
+        )
+
+    def _get_redis_filter(self, filter: DocumentMetadataFilter, exclude: Optional[List[str]] = None) -> str:
+        """
+        Convert a DocumentMetadataFilter into a RediSearch filter string.
+
+        Args:
+            filter (DocumentMetadataFilter): Metadata filter.
+            exclude (Optional[List[str]]): Filter fields to leave out.
+
+        Returns:
+            str: Filter string for RediSearch, "*" if nothing is filtered.
+        """
         filter_str: str = ""
 
         # RediSearch field type to query string
@@ -214,57 +331,110 @@ class RedisDataStore(DataStore):
                 num = to_unix_timestamp(value)
                 match field:
                     case "start_date":
-                        return f"@{field}:[{num} +inf] "
+                        return f"@created_at:[{num} +inf] "
                     case "end_date":
-                        return f"@{field}:[-inf {num}] "
+                        return f"@created_at:[-inf {num}] "
 
         # Build filter
-        if query.filter:
-            redisearch_schema = self._schema
-            for field, value in query.filter.__dict__.items():
-                if not value:
-                    continue
-                if field in redisearch_schema:
-                    filter_str += _typ_to_str(redisearch_schema[field], field, value)
-                elif field in redisearch_schema["metadata"]:
-                    if field == "source":  # handle the enum
-                        value = value.value
-                    filter_str += _typ_to_str(
-                        redisearch_schema["metadata"][field], field, value
-                    )
-                elif field in ["start_date", "end_date"]:
-                    filter_str += _typ_to_str(
-                        redisearch_schema["metadata"]["created_at"], field, value
-                    )
+        redisearch_schema = self._schema
+        for field, value in filter.__dict__.items():
+            if not value or (exclude and field in exclude):
+                continue
+            if field in redisearch_schema:
+                filter_str += _typ_to_str(redisearch_schema[field], field, value)
+            elif field in redisearch_schema["metadata"]:
+                if field == "source":  # handle the enum
+                    value = value.value
+                filter_str += _typ_to_str(
+                    redisearch_schema["metadata"][field], field, value
+                )
+            elif field in ["start_date", "end_date"]:
+                filter_str += _typ_to_str(
+                    redisearch_schema["metadata"]["created_at"], field, value
+                )
 
         # Postprocess filter string
         filter_str = filter_str.strip()
-        filter_str = filter_str if filter_str else "*"
-
-        # Prepare query string
-        query_str = (
-            f"({filter_str})=>[KNN {query.top_k} @embedding $embedding as score]"
-        )
-        return (
-            RediSearchQuery(query_str)
-            .sort_by("score")
-            .paging(0, query.top_k)
-            .dialect(2)
-        )
+        return filter_str if filter_str else "*"
 
     async def _redis_delete(self, keys: List[str]):
         """
-        Delete a list of keys from Redis.
+        Delete a list of chunk keys from Redis and drop them from their document key sets.
 
         Args:
             keys (List[str]): List of keys to delete.
         """
-        # Delete the keys
-        await asyncio.gather(*[self.client.delete(key) for key in keys])
+        if not keys:
+            return
+        # Group the keys by document so that each set gets a single SREM
+        keys_by_document: Dict[str, List[str]] = {}
+        for key in keys:
+            keys_by_document.setdefault(self._document_id_from_key(key), []).append(key)
+
+        # A single UNLINK frees the keys in the background, all in one round trip
+        async with self.client.pipeline(transaction=False) as pipe:
+            await pipe.unlink(*keys)
+            for document_id, document_keys in keys_by_document.items():
+                await pipe.srem(self._redis_document_keys_key(document_id), *document_keys)
+            await pipe.execute()
+
+    async def _get_document_keys(self, document_ids: List[str]) -> List[str]:
+        """
+        Look up the chunk keys of documents from their key sets.
+
+        Args:
+            document_ids (List[str]): Document Identifiers.
+
+        Returns:
+            List[str]: Chunk keys of all the documents.
+        """
+        async with self.client.pipeline(transaction=False) as pipe:
+            for document_id in document_ids:
+                await pipe.smembers(self._redis_document_keys_key(document_id))
+            members = await pipe.execute()
+        return [key.decode() for document_keys in members for key in document_keys]
+
+    async def _search_keys(self, filter_str: str, offset: int, limit: int) -> List[str]:
+        """
+        Find chunk keys matching a RediSearch filter without fetching their content.
+        """
+        query = RediSearchQuery(filter_str).no_content().paging(offset, limit).dialect(2)
+        response = await self.client.ft(REDIS_INDEX_NAME).search(query)
+        return [doc.id for doc in response.docs]
+
+    async def rebuild_document_key_sets(self) -> int:
+        """
+        Populate the document key sets from the chunks already stored in Redis, in batches of
+        REDIS_BACKFILL_BATCH_SIZE keys. Runs once on init, for chunks written before the sets were
+        maintained on upsert, and records that it ran in a marker key.
+
+        Returns:
+            int: Number of chunk keys indexed.
+        """
+        count = 0
+        batch: List[str] = []
+
+        async def add_batch():
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key in batch:
+                    await pipe.sadd(self._redis_document_keys_key(self._document_id_from_key(key)), key)
+                await pipe.execute()
+            batch.clear()
+
+        async for key in self.client.scan_iter(f"{REDIS_DOC_PREFIX}:*:chunk:*", count=REDIS_BACKFILL_BATCH_SIZE):
+            batch.append(key.decode())
+            count += 1
+            if len(batch) >= REDIS_BACKFILL_BATCH_SIZE:
+                await add_batch()
+        if batch:
+            await add_batch()
+        await self.client.set(_document_key_sets_key(), 1)
+        logger.info("Indexed %d chunk keys into document key sets", count)
+        return count
 
     #######
 
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]], chain: str = "") -> List[str]:
         """
         Takes in a list of list of document chunks and inserts them into the database.
         Return a list of document ids.
@@ -280,10 +450,15 @@ class RedisDataStore(DataStore):
 
             # Write chunks in a pipelines
             async with self.client.pipeline(transaction=False) as pipe:
+                keys = []
                 for chunk in chunk_list:
                     key = self._redis_key(doc_id, chunk.id)
                     data = self._get_redis_chunk(chunk)
                     await pipe.json().set(key, "$", data)
+                    keys.append(key)
+                # Track the chunk keys of the document so that deletes never scan the keyspace
+                if keys:
+                    await pipe.sadd(self._redis_document_keys_key(doc_id), *keys)
                 await pipe.execute()
 
         return doc_ids
@@ -291,24 +466,20 @@ class RedisDataStore(DataStore):
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
+        chain: str = "",
     ) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and
         returns a list of query results with matching document chunks and scores.
         """
-        # Prepare query responses and results object
-        results: List[QueryResult] = []
-
-        # Gather query results in a pipeline
-        logging.info(f"Gathering {len(queries)} query results", flush=True)
-        for query in queries:
 
-            logging.info(f"Query: {query.query}")
+        async def _single_query(query: QueryWithEmbedding) -> QueryResult:
+            logger.debug("Query: %s", query.query)
             query_results: List[DocumentChunkWithScore] = []
 
             # Extract Redis query
             redis_query: RediSearchQuery = self._get_redis_query(query)
-            embedding = np.array(query.embedding, dtype=np.float64).tobytes()
+            embedding = np.array(query.embedding, dtype=self._vector_dtype).tobytes()
 
             # Perform vector search
             query_response = await self.client.ft(REDIS_INDEX_NAME).search(
@@ -317,76 +488,101 @@ class RedisDataStore(DataStore):
 
             # Iterate through the most similar documents
             for doc in query_response.docs:
-                # Load JSON data
-                doc_json = json.loads(doc.json)
+                metadata = {}
+                for field in REDIS_RETURN_FIELDS:
+                    if field == "text":
+                        continue
+                    value = getattr(doc, field, None)
+                    metadata[field] = None if value == REDIS_NULL_VALUE else value
                 # Create document chunk object with score
                 result = DocumentChunkWithScore(
-                    id=doc_json["metadata"]["document_id"],
+                    id=metadata["document_id"],
                     score=doc.score,
-                    text=doc_json["text"],
-                    metadata=doc_json["metadata"]
+                    text=doc.text,
+                    metadata=metadata,
                 )
                 query_results.append(result)
 
-            # Add to overall results
-            results.append(QueryResult(query=query.query, results=query_results))
+            return QueryResult(query=query.query, results=query_results)
 
-        return results
-
-    async def _find_keys(self, pattern: str) -> List[str]:
-        return [key async for key in self.client.scan_iter(pattern)]
+        # Run the searches concurrently over the client's connection pool
+        logger.debug("Gathering %d query results", len(queries))
+        return await asyncio.gather(*[_single_query(query) for query in queries])
 
     async def delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         """
         Removes vectors by ids, filter, or everything in the datastore.
+        Chains are not stored in Redis, so a chain does not narrow down deletes by ids or filter,
+        and deleting everything of a single chain is not supported.
         Returns whether the operation was successful.
         """
+        if delete_all and chain:
+            raise ValueError("Redis does not store the chain of vectors, delete the documents of the chain by id")
+
         # Delete all vectors from the index if delete_all is True
         if delete_all:
             try:
-                logging.info(f"Deleting all documents from index")
+                logger.info(f"Deleting all documents from index")
                 await self.client.ft(REDIS_INDEX_NAME).dropindex(True)
-                logging.info(f"Deleted all documents successfully")
+                # The document key sets are not covered by the index
+                set_keys = [key async for key in self.client.scan_iter(self._redis_document_keys_key("*"))]
+                if set_keys:
+                    await self.client.unlink(*set_keys)
+                logger.info(f"Deleted all documents successfully")
                 return True
             except Exception as e:
-                logging.info(f"Error deleting all documents: {e}")
+                logger.info(f"Error deleting all documents: {e}")
                 raise e
 
         # Delete by filter
         if filter:
-            # TODO - extend this to work with other metadata filters?
-            if filter.document_id:
-                try:
-                    keys = await self._find_keys(
-                        f"{REDIS_DOC_PREFIX}:{filter.document_id}:*"
+            try:
+                filter_str = self._get_redis_filter(filter, exclude=["document_id"])
+                if filter_str == "*":
+                    # Only the document id is filtered on, which the key sets answer directly
+                    if filter.document_id:
+                        keys = await self._get_document_keys([filter.document_id])
+                        await self._redis_delete(keys)
+                        logger.info(f"Deleted document {filter.document_id} successfully")
+                else:
+                    document_keys = (
+                        set(await self._get_document_keys([filter.document_id]))
+                        if filter.document_id
+                        else None
                     )
-                    await self._redis_delete(keys)
-                    logging.info(f"Deleted document {filter.document_id} successfully")
-                except Exception as e:
-                    logging.info(f"Error deleting document {filter.document_id}: {e}")
-                    raise e
+                    deleted = 0
+                    offset = 0
+                    while True:
+                        keys = await self._search_keys(filter_str, offset, REDIS_DELETE_BATCH_SIZE)
+                        if not keys:
+                            break
+                        matched = [key for key in keys if document_keys is None or key in document_keys]
+                        await self._redis_delete(matched)
+                        deleted += len(matched)
+                        # Deleted keys drop out of the index, the ones skipped for another document do not
+                        offset += len(keys) - len(matched)
+                    logger.info(f"Deleted {deleted} chunks matching filter {filter_str}")
+            except Exception as e:
+                logger.info(f"Error deleting by filter {filter}: {e}")
+                raise e
 
         # Delete by explicit ids (Redis keys)
         if ids:
             try:
-                logging.info(f"Deleting document ids {ids}")
-                keys = []
+                logger.info(f"Deleting document ids {ids}")
                 # find all keys associated with the document ids
-                for document_id in ids:
-                    doc_keys = await self._find_keys(
-                        pattern=f"{REDIS_DOC_PREFIX}:{document_id}:*"
-                    )
-                    keys.extend(doc_keys)
+                keys = await self._get_document_keys(ids)
                 # delete all keys
-                logging.info(f"Deleting {len(keys)} keys from Redis")
+                logger.info(f"Deleting {len(keys)} keys from Redis")
                 await self._redis_delete(keys)
             except Exception as e:
-                logging.info(f"Error deleting ids: {e}")
+                logger.info(f"Error deleting ids: {e}")
                 raise e
 
         return True
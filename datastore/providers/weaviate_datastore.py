@@ -1,7 +1,7 @@
 # TODO
 import asyncio
+import logging
 from typing import Dict, List, Optional
-from loguru import logger
 from weaviate import Client
 import weaviate
 import os
@@ -20,6 +20,7 @@ from models.models import (
     Source,
 )
 
+logger = logging.getLogger(__name__)
 
 WEAVIATE_HOST = os.environ.get("WEAVIATE_HOST", "http://127.0.0.1")
 WEAVIATE_PORT = os.environ.get("WEAVIATE_PORT", "8080")
@@ -33,6 +34,22 @@ WEAVIATE_BATCH_DYNAMIC = os.environ.get("WEAVIATE_BATCH_DYNAMIC", False)
 WEAVIATE_BATCH_TIMEOUT_RETRIES = int(os.environ.get("WEAVIATE_TIMEOUT_RETRIES", 3))
 WEAVIATE_BATCH_NUM_WORKERS = int(os.environ.get("WEAVIATE_BATCH_NUM_WORKERS", 1))
 
+# Whether query results carry the stored vectors, which the answer pipeline never uses
+WEAVIATE_RETURN_VECTORS = os.environ.get("WEAVIATE_RETURN_VECTORS", "false").lower() == "true"
+# Whether all queries of a request are sent as a single aliased GraphQL call
+WEAVIATE_BATCH_QUERIES = os.environ.get("WEAVIATE_BATCH_QUERIES", "true").lower() == "true"
+
+QUERY_PROPERTIES = [
+    "chunk_id",
+    "document_id",
+    "text",
+    "source",
+    "source_id",
+    "url",
+    "created_at",
+    "author",
+]
+
 SCHEMA = {
     "class": WEAVIATE_INDEX,
     "description": "The main class",
@@ -106,7 +123,18 @@ class WeaviateDataStore(DataStore):
 
         return error_messages
 
-    def __init__(self):
+    def __init__(
+        self,
+        return_vectors: bool = WEAVIATE_RETURN_VECTORS,
+        batch_queries: bool = WEAVIATE_BATCH_QUERIES,
+    ):
+        """
+        Args:
+            return_vectors: Whether query results include the stored chunk vectors.
+            batch_queries: Whether the queries of a request are combined into one aliased GraphQL call.
+        """
+        self.return_vectors = return_vectors
+        self.batch_queries = batch_queries
         auth_credentials = self._build_auth_credentials()
 
         url = f"{WEAVIATE_HOST}:{WEAVIATE_PORT}"
@@ -147,7 +175,7 @@ class WeaviateDataStore(DataStore):
         else:
             return None
 
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]], chain: str = "") -> List[str]:
         """
         Takes in a list of list of document chunks and inserts them into the database.
         Return a list of document ids.
@@ -156,7 +184,7 @@ class WeaviateDataStore(DataStore):
 
         with self.client.batch as batch:
             for doc_id, doc_chunks in chunks.items():
-                logger.debug(f"Upserting {doc_id} with {len(doc_chunks)} chunks")
+                logger.debug("Upserting %s with %d chunks", doc_id, len(doc_chunks))
                 for doc_chunk in doc_chunks:
                     # we generate a uuid regardless of the format of the document_id because
                     # weaviate needs a uuid to store each document chunk and
@@ -189,90 +217,102 @@ class WeaviateDataStore(DataStore):
     async def _query(
         self,
         queries: List[QueryWithEmbedding],
+        chain: str = "",
     ) -> List[QueryResult]:
         """
         Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
         """
+        if self.batch_queries and len(queries) > 1:
+            batched_query = self._build_batched_query([self._build_query(query) for query in queries])
+            if batched_query is not None:
+                logger.debug("Sending %d queries in one GraphQL request", len(queries))
+                # The weaviate client blocks, keep it off the event loop
+                result = await asyncio.to_thread(self.client.query.raw, batched_query)
+                if "errors" in result:
+                    raise Exception(result["errors"])
+                return [
+                    self._to_query_result(query, result["data"]["Get"][self._query_alias(i)])
+                    for i, query in enumerate(queries)
+                ]
 
         async def _single_query(query: QueryWithEmbedding) -> QueryResult:
-            logger.debug(f"Query: {query.query}")
-            if not hasattr(query, "filter") or not query.filter:
-                result = (
-                    self.client.query.get(
-                        WEAVIATE_INDEX,
-                        [
-                            "chunk_id",
-                            "document_id",
-                            "text",
-                            "source",
-                            "source_id",
-                            "url",
-                            "created_at",
-                            "author",
-                        ],
-                    )
-                    .with_hybrid(query=query.query, alpha=0.5, vector=query.embedding)
-                    .with_limit(query.top_k)  # type: ignore
-                    .with_additional(["score", "vector"])
-                    .do()
-                )
-            else:
-                filters_ = self.build_filters(query.filter)
-                result = (
-                    self.client.query.get(
-                        WEAVIATE_INDEX,
-                        [
-                            "chunk_id",
-                            "document_id",
-                            "text",
-                            "source",
-                            "source_id",
-                            "url",
-                            "created_at",
-                            "author",
-                        ],
-                    )
-                    .with_hybrid(query=query.query, alpha=0.5, vector=query.embedding)
-                    .with_where(filters_)
-                    .with_limit(query.top_k)  # type: ignore
-                    .with_additional(["score", "vector"])
-                    .do()
-                )
-
-            query_results: List[DocumentChunkWithScore] = []
-            response = result["data"]["Get"][WEAVIATE_INDEX]
-
-            for resp in response:
-                result = DocumentChunkWithScore(
-                    id=resp["chunk_id"],
-                    text=resp["text"],
-                    embedding=resp["_additional"]["vector"],
-                    score=resp["_additional"]["score"],
-                    metadata=DocumentChunkMetadata(
-                        document_id=resp["document_id"] if resp["document_id"] else "",
-                        source=Source(resp["source"]),
-                        source_id=resp["source_id"],
-                        url=resp["url"],
-                        created_at=resp["created_at"],
-                        author=resp["author"],
-                    ),
-                )
-                query_results.append(result)
-            return QueryResult(query=query.query, results=query_results)
+            logger.debug("Query: %s", query.query)
+            result = await asyncio.to_thread(self._build_query(query).do)
+            return self._to_query_result(query, result["data"]["Get"][WEAVIATE_INDEX])
 
         return await asyncio.gather(*[_single_query(query) for query in queries])
 
+    def _build_query(self, query: QueryWithEmbedding):
+        """
+        Build the GraphQL Get query of a single search, without running it.
+        """
+        builder = (
+            self.client.query.get(WEAVIATE_INDEX, QUERY_PROPERTIES)
+            .with_hybrid(query=query.query, alpha=0.5, vector=query.embedding)
+            .with_limit(query.top_k)  # type: ignore
+            .with_additional(["score", "vector"] if self.return_vectors else ["score"])
+        )
+        if hasattr(query, "filter") and query.filter:
+            builder = builder.with_where(self.build_filters(query.filter))
+        return builder
+
+    @staticmethod
+    def _query_alias(position: int) -> str:
+        return f"q{position}"
+
+    def _build_batched_query(self, builders) -> Optional[str]:
+        """
+        Combine Get queries into a single GraphQL request by aliasing each class lookup.
+
+        Every builder renders as "{Get{<Class>(...){...}}}"; the inner lookups are aliased q0, q1, ...
+        and placed under one Get. Returns None if a builder renders in an unexpected shape.
+        """
+        prefix, suffix = "{Get{", "}}"
+        lookups = []
+        for i, builder in enumerate(builders):
+            built = builder.build().strip()
+            if not (built.startswith(prefix + WEAVIATE_INDEX) and built.endswith(suffix)):
+                return None
+            lookups.append(f"{self._query_alias(i)}: {built[len(prefix):-len(suffix)]}")
+        return prefix + " ".join(lookups) + suffix
+
+    def _to_query_result(self, query: QueryWithEmbedding, response: List[dict]) -> QueryResult:
+        query_results: List[DocumentChunkWithScore] = []
+        for resp in response:
+            result = DocumentChunkWithScore(
+                id=resp["chunk_id"],
+                text=resp["text"],
+                embedding=resp["_additional"].get("vector"),
+                score=resp["_additional"]["score"],
+                metadata=DocumentChunkMetadata(
+                    document_id=resp["document_id"] if resp["document_id"] else "",
+                    source=Source(resp["source"]),
+                    source_id=resp["source_id"],
+                    url=resp["url"],
+                    created_at=resp["created_at"],
+                    author=resp["author"],
+                ),
+            )
+            query_results.append(result)
+        return QueryResult(query=query.query, results=query_results)
+
     async def delete(
         self,
         ids: Optional[List[str]] = None,
         filter: Optional[DocumentMetadataFilter] = None,
         delete_all: Optional[bool] = None,
+        chain: str = "",
     ) -> bool:
         # TODO
         """
         Removes vectors by ids, filter, or everything in the datastore.
+        Chains are not stored in Weaviate, so a chain does not narrow down deletes by ids or filter,
+        and deleting everything of a single chain is not supported.
         Returns whether the operation was successful.
         """
+        if delete_all and chain:
+            raise ValueError("Weaviate does not store the chain of vectors, delete the documents of the chain by id")
+
         if delete_all:
             logger.debug(f"Deleting all vectors in index {WEAVIATE_INDEX}")
             self.client.schema.delete_all()
@@ -32,6 +32,8 @@ class ZillizDataStore(MilvusDataStore):
         self._consistency_level = ZILLIZ_CONSISTENCY_LEVEL or "Bounded"
         self._create_connection()
 
+        # Zilliz Cloud keeps the whole collection loaded, partitions are only used to scope searches
+        self._init_partitions(load_on_demand=False)
         self._create_collection(ZILLIZ_COLLECTION, create_new)  # type: ignore
         self._create_index()
 
@@ -1,36 +1,315 @@
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import hashlib
+import random
+import time
 import requests
+import requests.adapters
 import os
 from secrets import DATABASE_INTERFACE_BEARER_TOKEN
 
 SEARCH_TOP_K = 6
+DATABASE_INTERFACE_URL = "http://18.193.64.199:8000"
+UPLOAD_CONCURRENCY = 4  # The number of files uploaded at a time
+UPLOAD_MAX_ATTEMPTS = 5  # The number of times a file is sent before giving up on it
+UPLOAD_RETRY_BASE_DELAY = 1  # The number of seconds that the maximum delay between attempts starts from
+UPLOAD_RETRY_MAX_DELAY = 60  # The number of seconds that the maximum delay between attempts doubles up to
+UPLOAD_BATCH_FILES = 100  # The number of files sent per request to /gpt/upsert-files
+JOB_POLL_INTERVAL = 5  # The number of seconds between polls of the status of the ingestion jobs
+JOB_WAIT_TIMEOUT = 6 * 3600  # The number of seconds the ingestion jobs are waited for before giving up on them
 
 
-def upsert_file(directory: str, chain: str):
+def _list_files(directory: str) -> List[str]:
+    return [
+        filename
+        for filename in sorted(os.listdir(directory))
+        if os.path.isfile(os.path.join(directory, filename))
+    ]
+
+
+def _upload_session(concurrency: int) -> requests.Session:
+    # A session whose connection pool has room for concurrency requests at a time
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Authorization"] = "Bearer " + DATABASE_INTERFACE_BEARER_TOKEN
+    return session
+
+
+def _backoff_delay(attempt: int) -> float:
+    # Full jitter, so that the requests failing together don't retry together
+    return random.uniform(0, min(UPLOAD_RETRY_MAX_DELAY, UPLOAD_RETRY_BASE_DELAY * 2**attempt))
+
+
+def _post_files(
+    session: requests.Session, url: str, params: dict, data: dict, file_paths: List[Tuple[str, str]]
+) -> Tuple[Optional[str], Optional[str]]:
     """
-    Upload all files under a directory to the vector database.
+    Post (field, path) files to the url, retrying connection errors, 429s and 5xx with jittered exponential
+    backoff.
+
+    Returns:
+        A tuple of (job_id, error): the id of the ingestion job queued for the files, or the error that made
+        the last attempt fail.
+    """
+    error = ""
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(_backoff_delay(attempt))
+        try:
+            # The files are streamed from disk, and reopened for each attempt
+            with ExitStack() as stack:
+                files = [
+                    (field, (os.path.basename(path), stack.enter_context(open(path, "rb")), "text/plain"))
+                    for field, path in file_paths
+                ]
+                response = session.post(url, params=params, data=data, files=files, timeout=600)
+        except requests.RequestException as e:
+            error = str(e)
+            continue
+        if response.status_code == 200:
+            return response.json()["job_id"], None
+        error = f"{response.status_code} {response.content!r}"
+        if response.status_code != 429 and response.status_code < 500:
+            break
+    return None, error
+
+
+def _wait_for_jobs(
+    session: requests.Session, jobs: Dict[str, str], on_done: Callable[[str, Optional[str]], None]
+) -> Dict[str, Optional[str]]:
     """
-    headers = {"Authorization": "Bearer " + DATABASE_INTERFACE_BEARER_TOKEN}
-    files = []
-    for filename in os.listdir(directory):
-        ## chain = os.path.basename(os.path.dirname(directory))
-        if os.path.isfile(os.path.join(directory, filename)):
-            file_path = os.path.join(directory, filename)
-            channel_id = os.path.splitext(os.path.basename(file_path))[0]
-            url = f"http://18.193.64.199:8000/gpt/upsert-file?chain={chain}&id={channel_id}"
-            print(f"Upserting {chain}\{channel_id}")
-            with open(file_path, "rb") as f:
-                file_content = f.read()
-                files.append(("file", (filename, file_content, "text/plain")))
-            response = requests.post(url,
-                                     headers=headers,
-                                     files=files)
-            if response.status_code == 200:
-                print(filename + " uploaded successfully.")
+    Poll the status of ingestion jobs until they are finished, or for at most JOB_WAIT_TIMEOUT seconds.
+    Failed polls are retried with the same jittered exponential backoff as the uploads.
+
+    Args:
+        jobs: The names of the uploads by the id of their job.
+        on_done: Called with the name and the error, None if the job succeeded, of each job as it finishes.
+
+    Returns:
+        The error of each upload by name, None for the jobs that succeeded.
+    """
+    errors: Dict[str, Optional[str]] = {}
+    pending = dict(jobs)
+    deadline = time.monotonic() + JOB_WAIT_TIMEOUT
+    failed_polls = 0
+    while pending:
+        for job_id, name in list(pending.items()):
+            try:
+                response = session.get(f"{DATABASE_INTERFACE_URL}/gpt/upsert-file/{job_id}", timeout=60)
+            except requests.RequestException:
+                failed_polls += 1
+                break
+            if response.status_code == 429 or response.status_code >= 500:
+                failed_polls += 1
+                break
+            failed_polls = 0
+            if response.status_code != 200:
+                error: Optional[str] = f"{response.status_code} {response.content!r}"
             else:
-                print(
-                    f"Error: {response.status_code} {response.content} for uploading "
-                    + filename)
+                job = response.json()
+                if job["status"] not in ("succeeded", "failed"):
+                    continue
+                error = None if job["status"] == "succeeded" else f"Ingestion failed: {job['error']}"
+            del pending[job_id]
+            errors[name] = error
+            on_done(name, error)
+        if not pending:
+            break
+        if time.monotonic() > deadline or failed_polls >= UPLOAD_MAX_ATTEMPTS:
+            for job_id, name in pending.items():
+                errors[name] = f"Gave up waiting for ingestion job {job_id}"
+                on_done(name, errors[name])
+            break
+        time.sleep(_backoff_delay(failed_polls) if failed_polls else JOB_POLL_INTERVAL)
+    return errors
+
+
+def upsert_file(directory: str, chain: str, concurrency: int = UPLOAD_CONCURRENCY) -> List[str]:
+    """
+    Upload all files under a directory to the vector database, one file per request, concurrently, and wait
+    for their ingestion jobs.
+
+    Requests share a pooled session, at most concurrency run at a time, and those that fail with a
+    connection error, a 429 or a 5xx are retried with jittered exponential backoff.
+
+    Returns:
+        The names of the files that couldn't be uploaded or whose ingestion failed.
+    """
+    filenames = _list_files(directory)
+    total_bytes = sum(os.path.getsize(os.path.join(directory, filename)) for filename in filenames)
+    session = _upload_session(concurrency)
+
+    def upload(filename: str) -> Tuple[Optional[str], Optional[str]]:
+        channel_id = os.path.splitext(filename)[0]
+        return _post_files(session,
+                           f"{DATABASE_INTERFACE_URL}/gpt/upsert-file",
+                           params={"chain": chain, "id": channel_id},
+                           data={},
+                           file_paths=[("file", os.path.join(directory, filename))])
+
+    print(f"Upserting {len(filenames)} files of {chain}, {total_bytes / 2**20:.1f} MiB")
+    started_at = time.monotonic()
+    failed = []
+    jobs = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload, filename): filename for filename in filenames}
+        for i, future in enumerate(as_completed(futures), start=1):
+            filename = futures[future]
+            job_id, error = future.result()
+            if job_id is not None:
+                jobs[job_id] = filename
+                print(f"[{i}/{len(filenames)}] {filename} queued for ingestion.")
+            else:
+                failed.append(filename)
+                print(f"[{i}/{len(filenames)}] Error: {error} for uploading {filename}")
+
+    ingested_bytes = 0
+    done = len(failed)
+
+    def on_done(filename: str, error: Optional[str]):
+        nonlocal ingested_bytes, done
+        done += 1
+        if error is None:
+            ingested_bytes += os.path.getsize(os.path.join(directory, filename))
+            print(f"[{done}/{len(filenames)}] {filename} ingested successfully.")
+        else:
+            failed.append(filename)
+            print(f"[{done}/{len(filenames)}] Error: {error} for ingesting {filename}")
+
+    _wait_for_jobs(session, jobs, on_done)
+    session.close()
+
+    elapsed = max(time.monotonic() - started_at, 1e-9)
+    print(
+        f"Ingested {len(filenames) - len(failed)}/{len(filenames)} files in {elapsed:.1f}s "
+        f"({ingested_bytes / 2**20 / elapsed:.2f} MiB/s), {len(failed)} failed"
+    )
+    return failed
+
+
+def upsert_file_batch(directory: str, chain: str, batch_size: int = UPLOAD_BATCH_FILES) -> List[str]:
+    """
+    Upload all files under a directory to the vector database with /gpt/upsert-files, batch_size files per
+    request, so that the server runs its pipeline once per batch instead of once per file, and wait for
+    the ingestion jobs of the batches.
+
+    Returns:
+        The names of the files that couldn't be uploaded or whose ingestion failed.
+    """
+    filenames = _list_files(directory)
+    session = _upload_session(1)
+    failed = []
+    jobs = {}
+    batches = {}
+    for i in range(0, len(filenames), batch_size):
+        batch = filenames[i : i + batch_size]
+        print(f"Upserting files {i + 1}-{i + len(batch)} of {len(filenames)} of {chain}")
+        job_id, error = _post_files(session,
+                                    f"{DATABASE_INTERFACE_URL}/gpt/upsert-files",
+                                    params={"chain": chain},
+                                    data={"ids": [os.path.splitext(filename)[0] for filename in batch]},
+                                    file_paths=[("files", os.path.join(directory, filename)) for filename in batch])
+        if job_id is not None:
+            jobs[job_id] = f"files {i + 1}-{i + len(batch)}"
+            batches[jobs[job_id]] = batch
+            print(f"{len(batch)} files queued for ingestion.")
+        else:
+            failed.extend(batch)
+            print(f"Error: {error} for uploading {len(batch)} files")
+
+    ingested = 0
+
+    def on_done(name: str, error: Optional[str]):
+        nonlocal ingested
+        if error is None:
+            ingested += len(batches[name])
+            print(f"[{ingested}/{len(filenames)}] {name} ingested successfully.")
+        else:
+            failed.extend(batches[name])
+            print(f"Error: {error} for ingesting {name}")
+
+    _wait_for_jobs(session, jobs, on_done)
+    session.close()
+    return failed
+
+
+def upsert_file_tail(file_path: str, chain: str, source_id: str) -> bool:
+    """
+    Upload only the bytes appended to a text file since it was last processed, or the whole file if its
+    already processed part changed, and wait for the ingestion job.
+
+    Returns:
+        Whether the new content was ingested, or there was none.
+    """
+    session = _upload_session(1)
+    base_url = DATABASE_INTERFACE_URL
+    response = session.get(f"{base_url}/gpt/sources/{source_id}/cursor",
+                           params={"chain": chain},
+                           timeout=600)
+    response.raise_for_status()
+    cursor = response.json()
+
+    # Hash the file once, checking the processed prefix on the way
+    offset = cursor["byte_offset"]
+    sha256 = hashlib.sha256()
+    prefix_checksum = None
+    with open(file_path, "rb") as f:
+        if offset is not None and offset <= os.path.getsize(file_path):
+            remaining = offset
+            while remaining > 0:
+                block = f.read(min(remaining, 1024 * 1024))
+                sha256.update(block)
+                remaining -= len(block)
+            prefix_checksum = sha256.hexdigest()
+            # Only complete lines are sent, a partial last line is sent with the next tail
+            tail = f.read()
+            tail = tail[: tail.rfind(b"\n") + 1]
+            sha256.update(tail)
+        else:
+            tail = b""
+
+    filename = os.path.basename(file_path)
+    if prefix_checksum is None or (offset > 0 and prefix_checksum != cursor["checksum"]):
+        # The processed part changed, or the source has no byte cursor yet
+        print(f"Upserting the whole of {chain}/{source_id}")
+        with open(file_path, "rb") as f:
+            response = session.post(f"{base_url}/gpt/upsert-file",
+                                    params={"chain": chain, "id": source_id, "append": True},
+                                    files=[("file", (filename, f, "text/plain"))],
+                                    timeout=600)
+    elif not tail:
+        print(f"No complete new lines in {chain}/{source_id}")
+        session.close()
+        return True
+    else:
+        print(f"Upserting {len(tail)} new bytes of {chain}/{source_id}")
+        response = session.post(f"{base_url}/gpt/upsert-tail",
+                                params={"chain": chain, "id": source_id},
+                                data={"offset": offset,
+                                      "prefix_checksum": prefix_checksum,
+                                      "checksum": sha256.hexdigest()},
+                                files=[("file", (filename, tail, "text/plain"))],
+                                timeout=600)
+
+    if response.status_code != 200:
+        print(
+            f"Error: {response.status_code} {response.content} for uploading "
+            + filename)
+        session.close()
+        return False
+
+    def on_done(name: str, error: Optional[str]):
+        if error is None:
+            print(name + " ingested successfully.")
+        else:
+            print(f"Error: {error} for ingesting {name}")
+
+    errors = _wait_for_jobs(session, {response.json()["job_id"]: filename}, on_done)
+    session.close()
+    return errors[filename] is None
 
 
 def upsert(id: str, content: str):
@@ -32,6 +32,32 @@ class UpsertRequest(BaseModel):
 class UpsertResponse(BaseModel):
     ids: List[str]
 
+class IngestionJobResponse(BaseModel):
+    job_id: str
+    status: str
+
+class IngestionJobStatus(BaseModel):
+    job_id: str
+    status: str
+    attempts: int
+    queue_position: Optional[int] = None  # The number of jobs queued ahead of this one
+    stage: Optional[str] = None
+    stage_done: int
+    stage_total: int
+    throughput: Optional[float] = None  # Items of the current stage processed per second
+    eta_seconds: Optional[float] = None  # Estimated time left in the current stage
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[List[str]] = None  # The ids of the upserted documents
+    error: Optional[str] = None
+
+class SourceCursorResponse(BaseModel):
+    source_id: str
+    chain: str
+    byte_offset: Optional[int] = None  # None if the source has to be uploaded whole once to get a byte cursor
+    checksum: Optional[str] = None  # The sha256 of the first byte_offset bytes of the source
+
 class AskResponse(BaseModel):
     answer: str
     request_id: str
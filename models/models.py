@@ -18,6 +18,9 @@ class DocumentMetadata(BaseModel):
 
 class DocumentChunkMetadata(DocumentMetadata):
     document_id: Optional[str] = None
+    # The first and last pages of the chunk, for documents extracted page by page such as PDFs
+    page_start: Optional[int] = None
+    page_end: Optional[int] = None
 
 class DocumentQuestion(BaseModel):
     text: str
@@ -40,6 +43,18 @@ class Document(BaseModel):
     id: Optional[str] = None
     text: str
     metadata: Optional[DocumentMetadata] = None
+    # The type of the file the text was extracted from, the chunks of paged files such as PDFs cite their pages
+    mimetype: Optional[str] = None
+    # The number of the page the text starts on, when it resumes a paged file after its first page
+    first_page: int = 1
+
+
+class FileDocument(Document):
+    """A document whose text is extracted from its file as it is chunked, instead of being held in memory."""
+
+    text: str = ""
+    file_path: str
+    mimetype: str
 
 
 class DocumentWithChunks(Document):
@@ -81,4 +96,10 @@ class QuestionAnswer(BaseModel):
 
 class QuestionTopic(BaseModel):
     topic_id: str
-    topic: str
\ No newline at end of file
+    topic: str
+class SourceCursor(BaseModel):
+    # How far a source has been processed: the number of bytes of its UTF-8 text and their sha256.
+    # Cursors saved before byte offsets were tracked only have the number of lines
+    byte_offset: Optional[int] = None
+    checksum: Optional[str] = None
+    line: int = 0
@@ -0,0 +1,73 @@
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+from typing import List
+
+from services.file import iter_text_from_filepath
+
+ROW = '{i},user{user},2023-03-{day:02d},"Message number {i}, about topic {topic}. Is it answered? Yes!"\n'
+
+
+def make_csv(path: str, size: int) -> int:
+    # Write rows until the file is about size bytes, returning the number of rows
+    rows = 0
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("id,author,date,message\n")
+        while written < size:
+            row = ROW.format(i=rows, user=rows % 97, day=rows % 28 + 1, topic=rows % 13)
+            f.write(row)
+            written += len(row)
+            rows += 1
+    return rows
+
+
+def consume(path: str, chunk: bool) -> int:
+    # Stream the text blocks, and optionally the chunks, without ever holding the whole text
+    blocks = iter_text_from_filepath(path, "text/csv")
+    if chunk:
+        from services.chunks import iter_text_chunks
+
+        return sum(1 for _ in iter_text_chunks(blocks, None, "", None))
+    return sum(len(block) for block in blocks)
+
+
+def benchmark(path: str, size: int, chunk: bool):
+    rows = make_csv(path, size)
+
+    start = time.perf_counter()
+    consume(path, chunk)
+    seconds = time.perf_counter() - start
+
+    # A second pass under tracemalloc, which slows the extraction down too much to time it
+    tracemalloc.start()
+    consume(path, chunk)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    megabytes = size / 2**20
+    print(
+        f"{megabytes:8.1f} MiB | {rows:9d} rows | {seconds:7.2f}s | {megabytes / seconds:7.1f} MiB/s "
+        f"| {seconds / megabytes * 1000:7.1f} ms/MiB | peak {peak / 2**20:7.2f} MiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max_mb", default=100, type=int, help="The size of the largest CSV in MiB")
+    parser.add_argument("--steps", default=4, type=int, help="The number of sizes, halving from max_mb")
+    parser.add_argument("--chunk", action="store_true", help="Also split the text into token chunks")
+    args = parser.parse_args()
+
+    sizes: List[int] = [args.max_mb * 2**20 // 2**step for step in reversed(range(args.steps))]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.csv")
+        print("CSV extraction" + (" and chunking" if args.chunk else ""))
+        for size in sizes:
+            benchmark(path, size, args.chunk)
+
+
+if __name__ == "__main__":
+    main()
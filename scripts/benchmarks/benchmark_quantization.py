@@ -0,0 +1,72 @@
+import time
+import argparse
+
+import numpy as np
+
+from services.quantization import (
+    ProductQuantizer,
+    QuantizedIndex,
+    ScalarQuantizer,
+    normalize,
+)
+
+
+def make_embeddings(count: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    # ada embeddings are far from uniform on the sphere, so draw them around a set of topic centers
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size=count)
+    noise = rng.normal(scale=0.6, size=(count, dim)).astype(np.float32)
+    return normalize(centers[assignments] + noise)
+
+
+def recall_at_k(index: QuantizedIndex, vectors: np.ndarray, queries: np.ndarray, k: int, rerank: bool) -> float:
+    hits = 0
+    for query in queries:
+        exact = set(np.argsort(-(vectors @ query))[:k].tolist())
+        found = {position for position, _ in index.search(query, top_k=k, rerank=rerank)}
+        hits += len(exact & found)
+    return hits / (k * len(queries))
+
+
+def benchmark(name: str, quantizer, vectors: np.ndarray, queries: np.ndarray, k: int):
+    start = time.perf_counter()
+    quantizer.fit(vectors)
+    index = QuantizedIndex(quantizer)
+    index.add(vectors)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approximate_recall = recall_at_k(index, vectors, queries, k, rerank=False)
+    query_seconds = (time.perf_counter() - start) / len(queries)
+    reranked_recall = recall_at_k(index, vectors, queries, k, rerank=True)
+
+    float32_bytes = vectors.astype(np.float32).nbytes
+    float64_bytes = vectors.astype(np.float64).nbytes
+    print(
+        f"{name:>8} | codes {index.nbytes / 2**20:8.2f} MiB "
+        f"| {float32_bytes / index.nbytes:5.1f}x vs float32, {float64_bytes / index.nbytes:5.1f}x vs float64 "
+        f"| recall@{k} {approximate_recall:.3f} (reranked {reranked_recall:.3f}) "
+        f"| build {build_seconds:6.2f}s | {query_seconds * 1000:6.2f} ms/query"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", default=20000, type=int, help="The number of stored embeddings")
+    parser.add_argument("--dim", default=1536, type=int, help="The embedding dimension")
+    parser.add_argument("--queries", default=100, type=int, help="The number of queries to evaluate")
+    parser.add_argument("--top_k", default=10, type=int, help="The k of recall@k")
+    parser.add_argument("--subvectors", default=96, type=int, help="The number of PQ sub-vectors")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_embeddings(args.count, args.dim, clusters=64, rng=rng)
+    queries = make_embeddings(args.queries, args.dim, clusters=64, rng=rng)
+
+    print(f"{args.count} vectors of dim {args.dim}, float32 size {vectors.nbytes / 2**20:.2f} MiB")
+    benchmark("int8", ScalarQuantizer(), vectors, queries, args.top_k)
+    benchmark("pq", ProductQuantizer(num_subvectors=args.subvectors), vectors, queries, args.top_k)
+
+
+if __name__ == "__main__":
+    main()
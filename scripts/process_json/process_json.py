@@ -2,33 +2,63 @@ import uuid
 import json
 import argparse
 import asyncio
+from typing import List, Optional, Tuple
 
 from models.models import Document, DocumentMetadata
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.pii_detection import screen_text_for_pii
+from services.enrichment import ENRICHMENT_CONCURRENCY, ENRICHMENT_REQUESTS_PER_MINUTE, DocumentEnricher
+from services.import_journal import (
+    ImportJournal,
+    get_dump_id,
+    roll_back_unfinished_batches,
+    stable_document_id,
+    upsert_batch,
+)
 
 DOCUMENT_UPSERT_BATCH_SIZE = 50
 
 
+async def enrich_document(
+    enricher: DocumentEnricher, document: Document, screen_for_pii: bool, extract_metadata: bool
+) -> Optional[Document]:
+    """Screen a document for PII and extract its metadata if requested, returns None if PII was detected."""
+    metadata = await enricher.enrich(
+        document.text, document.metadata, screen_for_pii, False and extract_metadata  # type: ignore
+    )
+    if metadata is None:
+        return None
+    document.metadata = metadata
+    return document
+
+
 async def process_json_dump(
     filepath: str,
     datastore: DataStore,
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    journal: Optional[ImportJournal] = None,
+    enricher: Optional[DocumentEnricher] = None,
 ):
+    # with a journal, skip the items finished by a previous run after rolling back its unfinished batches
+    if journal is not None:
+        await roll_back_unfinished_batches(datastore, journal)
+    dump_id = get_dump_id(filepath) if journal is not None else ""
+
     # load the json file as a list of dictionaries
     with open(filepath) as json_file:
         data = json.load(json_file)
 
-    documents = []
+    enricher = enricher or DocumentEnricher()
+    # (key, item, future of the enriched document) of the items to upsert, in dump order
+    pending = []
     skipped_items = []
     # iterate over the data and create document objects
-    for item in data:
-        if len(documents) % 20 == 0:
-            print(f"Processed {len(documents)} documents")
+    for index, item in enumerate(data):
+        key = str(index)
+        if journal is not None and journal.is_finished(key):
+            continue
 
         try:
             # get the id, text, source, source_id, url, created_at and author from the item
@@ -43,6 +73,8 @@ async def process_json_dump(
 
             if not text:
                 print("No document text, skipping...")
+                if journal is not None:
+                    journal.skip(key, "no text")
                 continue
 
             # create a metadata object with the source, source_id, url, created_at and author
@@ -56,48 +88,60 @@ async def process_json_dump(
             print("metadata: ", str(metadata))
 
             # update metadata with custom values
-            for key, value in custom_metadata.items():
-                if hasattr(metadata, key):
-                    setattr(metadata, key, value)
-
-            # screen for pii if requested
-            if screen_for_pii:
-                pii_detected = screen_text_for_pii(text)
-                # if pii detected, print a warning and skip the document
-                if pii_detected:
-                    print("PII detected in document, skipping")
-                    skipped_items.append(item)  # add the skipped item to the list
-                    continue
-
-            # extract metadata if requested
-            if False and extract_metadata:
-                # extract metadata from the document text
-                extracted_metadata = extract_metadata_from_document(
-                    f"Text: {text}; Metadata: {str(metadata)}"
-                )
-                # get a Metadata object from the extracted metadata
-                metadata = DocumentMetadata(**extracted_metadata)
-
-            # create a document object with the id or a random id, text and metadata
+            for metadata_key, value in custom_metadata.items():
+                if hasattr(metadata, metadata_key):
+                    setattr(metadata, metadata_key, value)
+
+            # create a document object with the id or a generated id, text and metadata. With a journal,
+            # the generated id is derived from the item, so that retrying its batch replaces its vectors
             document = Document(
-                id=id or str(uuid.uuid4()),
+                id=id or (stable_document_id(dump_id, key) if journal is not None else str(uuid.uuid4())),
                 text=text,
                 metadata=metadata,
             )
-            documents.append(document)
         except Exception as e:
             # log the error and continue with the next item
             print(f"Error processing {item}: {e}")
             skipped_items.append(item)  # add the skipped item to the list
+            continue
+
+        # screen for pii and extract metadata if requested, all the items are enriched concurrently
+        future = asyncio.ensure_future(enrich_document(enricher, document, screen_for_pii, extract_metadata))
+        pending.append((key, item, future))
+
+    # do this in batches as the documents are enriched, the upsert method already batches documents but
+    # this allows us to add more descriptive logging
+    batch: List[Tuple[str, Document]] = []
+    try:
+        for i, (key, item, future) in enumerate(pending):
+            if i % 20 == 0:
+                print(f"Processed {i} documents")
+            try:
+                document = await future
+            except Exception as e:
+                # log the error and continue with the next item
+                print(f"Error processing {item}: {e}")
+                skipped_items.append(item)  # add the skipped item to the list
+                continue
+
+            # if pii detected, print a warning and skip the document
+            if document is None:
+                print("PII detected in document, skipping")
+                skipped_items.append(item)  # add the skipped item to the list
+                if journal is not None:
+                    journal.skip(key, "PII detected")
+                continue
+
+            batch.append((key, document))
+            if len(batch) >= DOCUMENT_UPSERT_BATCH_SIZE:
+                await upsert_batch(datastore, batch, journal)
+                batch = []
 
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]
-        print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        print("documents: ", documents)
-        await datastore.upsert(batch_documents)
+        if batch:
+            await upsert_batch(datastore, batch, journal)
+    finally:
+        for _, _, future in pending:
+            future.cancel()
 
     # print the skipped items
     print(f"Skipped {len(skipped_items)} items due to errors or PII detection")
@@ -126,6 +170,28 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--enrichment_concurrency",
+        default=ENRICHMENT_CONCURRENCY,
+        type=int,
+        help="The number of PII screening and metadata extraction completions at a time",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        default=ENRICHMENT_REQUESTS_PER_MINUTE,
+        type=float,
+        help="The number of PII screening and metadata extraction completions started per minute, 0 for no limit",
+    )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help="The path of the checkpoint journal, defaults to the path of the dump with a .journal.sqlite suffix",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the documents upserted or skipped by a previous run with the same journal",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -134,11 +200,19 @@ async def main():
     screen_for_pii = args.screen_for_pii
     extract_metadata = args.extract_metadata
 
+    journal = ImportJournal(args.journal or f"{filepath}.journal.sqlite", resume=args.resume)
+
     # initialize the db instance once as a global variable
     datastore = await get_datastore()
     # process the json dump
     await process_json_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        journal,
+        enricher=DocumentEnricher(args.enrichment_concurrency, args.requests_per_minute),
     )
 
 
@@ -1,15 +1,128 @@
-import uuid
 import json
+import time
 import argparse
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Set, Tuple
 
 from models.models import Document, DocumentMetadata
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.pii_detection import screen_text_for_pii
+from services.enrichment import ENRICHMENT_CONCURRENCY, ENRICHMENT_REQUESTS_PER_MINUTE, DocumentEnricher
+from services.import_journal import (
+    ImportJournal,
+    get_dump_id,
+    roll_back_unfinished_batches,
+    stable_document_id,
+    upsert_batch,
+)
 
 DOCUMENT_UPSERT_BATCH_SIZE = 50
+PARSE_WORKERS = 8  # The number of threads parsing lines
+MAX_IN_FLIGHT_DOCUMENTS = 200  # The number of lines read ahead of the upserts, which bounds the memory use
+UPSERT_CONCURRENCY = 1  # The number of batches upserted at a time
+PROGRESS_INTERVAL = 10  # The number of seconds between progress reports
+
+
+def read_lines(filepath: str) -> Iterator[Tuple[int, str]]:
+    # read the jsonl file one line at a time, with 1-based line numbers
+    with open(filepath, encoding="utf-8") as jsonl_file:
+        for line_number, line in enumerate(jsonl_file, start=1):
+            if line.strip():
+                yield line_number, line
+
+
+def parse_line(line: str, custom_metadata: dict) -> Optional[Document]:
+    """
+    Parse a line of the dump into a document.
+    Returns None if the line has no text, and raises if the line can't be parsed.
+    """
+    item = json.loads(line)
+
+    # get the id, text, source, source_id, url, created_at and author from the item
+    # use default values if not specified
+    id = item.get("id", None)
+    text = item.get("text", None)
+    source = item.get("source", None)
+    source_id = item.get("source_id", None)
+    url = item.get("url", None)
+    created_at = item.get("created_at", None)
+    author = item.get("author", None)
+
+    if not text:
+        print("No document text, skipping...")
+        return None
+
+    # create a metadata object with the source, source_id, url, created_at and author
+    metadata = DocumentMetadata(
+        source=source,
+        source_id=source_id,
+        url=url,
+        created_at=created_at,
+        author=author,
+    )
+
+    # update metadata with custom values
+    for key, value in custom_metadata.items():
+        if hasattr(metadata, key):
+            setattr(metadata, key, value)
+
+    # create a document object with the id, text and metadata
+    return Document(
+        id=id,
+        text=text,
+        metadata=metadata,
+    )
+
+
+async def process_line(
+    line: str,
+    custom_metadata: dict,
+    screen_for_pii: bool,
+    extract_metadata: bool,
+    executor: ThreadPoolExecutor,
+    enricher: DocumentEnricher,
+) -> Optional[Document]:
+    """
+    Parse a line of the dump in the executor, and screen and extract metadata from its document if requested.
+    Returns None if the document is skipped, and raises if the line can't be processed.
+    """
+    document = await asyncio.get_running_loop().run_in_executor(executor, parse_line, line, custom_metadata)
+    if document is None:
+        return None
+    metadata = await enricher.enrich(
+        document.text, document.metadata, screen_for_pii, extract_metadata  # type: ignore
+    )
+    if metadata is None:
+        print("PII detected in document, skipping")
+        return None
+    document.metadata = metadata
+    return document
+
+
+class ProgressReporter:
+    """Counts the documents going through the pipeline, and prints the throughput every PROGRESS_INTERVAL seconds."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.reported_at = self.started_at
+        self.parsed = 0
+        self.skipped = 0
+        self.upserted = 0
+        self.resumed = 0
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.reported_at < PROGRESS_INTERVAL:
+            return
+        self.reported_at = now
+        elapsed = max(now - self.started_at, 1e-9)
+        print(
+            f"Parsed {self.parsed} documents ({self.parsed / elapsed:.1f} docs/s), "
+            f"upserted {self.upserted} ({self.upserted / elapsed:.1f} docs/s), skipped {self.skipped}, "
+            f"already done {self.resumed}"
+        )
 
 
 async def process_jsonl_dump(
@@ -18,89 +131,113 @@ async def process_jsonl_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    workers: int = PARSE_WORKERS,
+    max_in_flight: int = MAX_IN_FLIGHT_DOCUMENTS,
+    upsert_concurrency: int = UPSERT_CONCURRENCY,
+    journal: Optional[ImportJournal] = None,
+    enricher: Optional[DocumentEnricher] = None,
 ):
-    # open the jsonl file as a generator of dictionaries
-    with open(filepath) as jsonl_file:
-        data = [json.loads(line) for line in jsonl_file]
+    """
+    Stream a jsonl dump into the datastore with bounded memory.
 
-    documents = []
-    skipped_items = []
-    # iterate over the data and create document objects
-    for item in data:
-        if len(documents) % 20 == 0:
-            print(f"Processed {len(documents)} documents")
+    Lines are read one at a time and parsed by a pool of worker threads, then screened for PII and enriched
+    with metadata by concurrent completions if requested, at most max_in_flight lines ahead of the batching.
+    Documents are batched in file order, and at most upsert_concurrency batches are upserted at a time.
+    When the upserts fall behind, batching waits for them and reading pauses.
 
-        try:
-            # get the id, text, source, source_id, url, created_at and author from the item
-            # use default values if not specified
-            id = item.get("id", None)
-            text = item.get("text", None)
-            source = item.get("source", None)
-            source_id = item.get("source_id", None)
-            url = item.get("url", None)
-            created_at = item.get("created_at", None)
-            author = item.get("author", None)
-
-            if not text:
-                print("No document text, skipping...")
-                continue
+    With a journal, lines upserted or skipped by a previous run are not processed again, and the batches
+    that run didn't finish are rolled back first. Documents without an id get one derived from their line,
+    so that a retried batch replaces what it inserted before.
+    """
+    if journal is not None:
+        await roll_back_unfinished_batches(datastore, journal)
+    dump_id = get_dump_id(filepath) if journal is not None else ""
+    executor = ThreadPoolExecutor(max_workers=workers)
+    enricher = enricher or DocumentEnricher()
+    lines = read_lines(filepath)
+    # Lines being processed, in file order
+    in_flight: Deque[Tuple[int, asyncio.Future]] = deque()
+    upsert_slots = asyncio.Semaphore(upsert_concurrency)
+    upserts: Set[asyncio.Task] = set()
+    upsert_errors: List[Exception] = []
+    progress = ProgressReporter()
 
-            # create a metadata object with the source, source_id, url, created_at and author
-            metadata = DocumentMetadata(
-                source=source,
-                source_id=source_id,
-                url=url,
-                created_at=created_at,
-                author=author,
+    def read_ahead():
+        # Keep the window full, reading only as many lines as documents leave it
+        while len(in_flight) < max_in_flight:
+            entry = next(lines, None)
+            if entry is None:
+                return
+            line_number, line = entry
+            if journal is not None and journal.is_finished(str(line_number)):
+                progress.resumed += 1
+                continue
+            future = asyncio.ensure_future(
+                process_line(line, custom_metadata, screen_for_pii, extract_metadata, executor, enricher)
             )
+            in_flight.append((line_number, future))
 
-            # update metadata with custom values
-            for key, value in custom_metadata.items():
-                if hasattr(metadata, key):
-                    setattr(metadata, key, value)
-
-            # screen for pii if requested
-            if screen_for_pii:
-                pii_detected = screen_text_for_pii(text)
-                # if pii detected, print a warning and skip the document
-                if pii_detected:
-                    print("PII detected in document, skipping")
-                    skipped_items.append(item)  # add the skipped item to the list
-                    continue
-
-            # extract metadata if requested
-            if extract_metadata:
-                # extract metadata from the document text
-                extracted_metadata = extract_metadata_from_document(
-                    f"Text: {text}; Metadata: {str(metadata)}"
-                )
-                # get a Metadata object from the extracted metadata
-                metadata = DocumentMetadata(**extracted_metadata)
-
-            # create a document object with the id, text and metadata
-            document = Document(
-                id=id,
-                text=text,
-                metadata=metadata,
-            )
-            documents.append(document)
+    async def upsert_progress(batch: List[Tuple[str, Document]]):
+        try:
+            await upsert_batch(datastore, batch, journal)
+            progress.upserted += len(batch)
+            progress.report()
         except Exception as e:
-            # log the error and continue with the next item
-            print(f"Error processing {item}: {e}")
-            skipped_items.append(item)  # add the skipped item to the list
+            upsert_errors.append(e)
+        finally:
+            upsert_slots.release()
+
+    async def start_upsert(batch: List[Tuple[str, Document]]):
+        # Wait for a free slot, which holds back the batching and in turn the reading
+        await upsert_slots.acquire()
+        if upsert_errors:
+            upsert_slots.release()
+            raise upsert_errors[0]
+        task = asyncio.create_task(upsert_progress(batch))
+        upserts.add(task)
+        task.add_done_callback(upserts.discard)
+
+    try:
+        batch: List[Tuple[str, Document]] = []
+        read_ahead()
+        while in_flight:
+            line_number, future = in_flight.popleft()
+            try:
+                document = await future
+            except Exception as e:
+                # log the error and continue with the next line
+                print(f"Error processing line {line_number}: {e}")
+                document = None
+            read_ahead()
+            key = str(line_number)
+            if document is None:
+                progress.skipped += 1
+                if journal is not None and future.exception() is None:
+                    # Only deliberate skips are final, lines that failed are retried by the next run
+                    journal.skip(key, "no text or PII detected")
+                continue
 
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]
-        print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        await datastore.upsert(batch_documents)
+            progress.parsed += 1
+            if journal is not None and document.id is None:
+                document.id = stable_document_id(dump_id, key)
+            batch.append((key, document))
+            if len(batch) >= DOCUMENT_UPSERT_BATCH_SIZE:
+                await start_upsert(batch)
+                batch = []
+            progress.report()
 
-    # print the skipped items
-    print(f"Skipped {len(skipped_items)} items due to errors or PII detection")
-    for item in skipped_items:
-        print(item)
+        if batch:
+            await start_upsert(batch)
+        await asyncio.gather(*upserts)
+        if upsert_errors:
+            raise upsert_errors[0]
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    progress.report(force=True)
+    print(f"Skipped {progress.skipped} items due to errors or PII detection")
 
 
 async def main():
@@ -124,6 +261,46 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--workers",
+        default=PARSE_WORKERS,
+        type=int,
+        help="The number of threads parsing the documents",
+    )
+    parser.add_argument(
+        "--enrichment_concurrency",
+        default=ENRICHMENT_CONCURRENCY,
+        type=int,
+        help="The number of PII screening and metadata extraction completions at a time",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        default=ENRICHMENT_REQUESTS_PER_MINUTE,
+        type=float,
+        help="The number of PII screening and metadata extraction completions started per minute, 0 for no limit",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        default=MAX_IN_FLIGHT_DOCUMENTS,
+        type=int,
+        help="The number of documents read ahead of the upserts",
+    )
+    parser.add_argument(
+        "--upsert_concurrency",
+        default=UPSERT_CONCURRENCY,
+        type=int,
+        help="The number of batches upserted at a time",
+    )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help="The path of the checkpoint journal, defaults to the path of the dump with a .journal.sqlite suffix",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the documents upserted or skipped by a previous run with the same journal",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -132,11 +309,22 @@ async def main():
     screen_for_pii = args.screen_for_pii
     extract_metadata = args.extract_metadata
 
+    journal = ImportJournal(args.journal or f"{filepath}.journal.sqlite", resume=args.resume)
+
     # initialize the db instance once as a global variable
     datastore = await get_datastore()
     # process the jsonl dump
     await process_jsonl_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        upsert_concurrency=args.upsert_concurrency,
+        journal=journal,
+        enricher=DocumentEnricher(args.enrichment_concurrency, args.requests_per_minute),
     )
 
 
@@ -4,15 +4,47 @@ import os
 import json
 import argparse
 import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Deque, List, Optional, Tuple
 
 from models.models import Document, DocumentMetadata, Source
 from datastore.datastore import DataStore
 from datastore.factory import get_datastore
-from services.extract_metadata import extract_metadata_from_document
-from services.file import extract_text_from_filepath
-from services.pii_detection import screen_text_for_pii
+from services.enrichment import ENRICHMENT_CONCURRENCY, ENRICHMENT_REQUESTS_PER_MINUTE, DocumentEnricher
+import services.file as file_module
+from services.file import get_mimetype, iter_cached_text
+from services.import_journal import (
+    ImportJournal,
+    get_dump_id,
+    roll_back_unfinished_batches,
+    stable_document_id,
+    upsert_batch,
+)
 
 DOCUMENT_UPSERT_BATCH_SIZE = 50
+EXTRACTION_WORKERS = os.cpu_count() or 1  # The number of processes extracting text from the files of the zip
+MAX_IN_FLIGHT_FILES = 64  # The number of files extracted ahead of the upserts, which bounds the memory use
+
+# The zip file opened by each extraction worker process
+_worker_zip_file: Optional[zipfile.ZipFile] = None
+
+
+def init_extraction_worker(filepath: str):
+    global _worker_zip_file
+    _worker_zip_file = zipfile.ZipFile(filepath)
+    # Files are already extracted in parallel, so the pages of a PDF are extracted in its worker
+    file_module.PDF_EXTRACTION_WORKERS = 1
+
+
+def extract_member_text(name: str) -> str:
+    """Return the text content of a file of the zip, read in place without extracting it to disk."""
+    mimetype = get_mimetype(name)
+    with _worker_zip_file.open(name) as member:  # type: ignore
+        # The member is decompressed once into memory, as seeking backwards in a compressed member, to extract
+        # it after hashing it for the text cache or to parse a docx, pptx or pdf, decompresses it again
+        return "".join(iter_cached_text(BytesIO(member.read()), mimetype))  # type: ignore
 
 
 async def process_file_dump(
@@ -21,88 +53,120 @@ async def process_file_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    journal: Optional[ImportJournal] = None,
+    workers: int = EXTRACTION_WORKERS,
+    max_in_flight: int = MAX_IN_FLIGHT_FILES,
+    enricher: Optional[DocumentEnricher] = None,
 ):
-    # create a ZipFile object and extract all the files into a directory named 'dump'
+    """
+    Import the files of a zip dump into the datastore, reading them in place from the archive.
+
+    Files are extracted by a pool of worker processes, each with its own handle on the archive, at most
+    max_in_flight files ahead of the batching, then screened for PII and enriched with metadata by concurrent
+    completions if requested. Documents are batched in archive order.
+
+    With a journal, files upserted or skipped by a previous run are not extracted again, and the batches
+    that run didn't finish are rolled back first. Documents get ids derived from their path in the archive,
+    so that a retried batch replaces what it inserted before.
+    """
+    # with a journal, skip the files finished by a previous run after rolling back its unfinished batches
+    if journal is not None:
+        await roll_back_unfinished_batches(datastore, journal)
+    dump_id = get_dump_id(filepath) if journal is not None else ""
+
     with zipfile.ZipFile(filepath) as zip_file:
-        zip_file.extractall("dump")
+        names = [info.filename for info in zip_file.infolist() if not info.is_dir()]
+    if journal is not None:
+        names = [name for name in names if not journal.is_finished(name)]
+    pending = iter(names)
 
-    documents = []
-    skipped_files = []
-    # use os.walk to traverse the dump directory and its subdirectories
-    for root, dirs, files in os.walk("dump"):
-        for filename in files:
-            if len(documents) % 20 == 0:
-                print(f"Processed {len(documents)} documents")
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=init_extraction_worker, initargs=(filepath,)
+    )
+    enricher = enricher or DocumentEnricher()
+    # Files being extracted and enriched, in archive order
+    in_flight: Deque[Tuple[str, asyncio.Future]] = deque()
+
+    async def process_member(name: str) -> Tuple[str, Optional[DocumentMetadata]]:
+        extracted_text = await loop.run_in_executor(executor, extract_member_text, name)
+        print(f"extracted_text from {name}")
+
+        # create a metadata object with the source and source_id fields
+        metadata = DocumentMetadata(
+            source=Source.file,
+            source_id=os.path.basename(name),
+        )
+
+        # update metadata with custom values
+        for key, value in custom_metadata.items():
+            if hasattr(metadata, key):
+                setattr(metadata, key, value)
 
-            filepath = os.path.join(root, filename)
+        # screen for pii and extract metadata if requested, the metadata is None if pii was detected
+        return extracted_text, await enricher.enrich(  # type: ignore
+            extracted_text, metadata, screen_for_pii, extract_metadata
+        )
+
+    def read_ahead():
+        # Keep the window full, dispatching only as many files as documents leave it
+        while len(in_flight) < max_in_flight:
+            name = next(pending, None)
+            if name is None:
+                return
+            in_flight.append((name, asyncio.ensure_future(process_member(name))))
+
+    processed = 0
+    skipped_files = []
+    batch: List[Tuple[str, Document]] = []
+    try:
+        read_ahead()
+        while in_flight:
+            name, future = in_flight.popleft()
+            if processed % 20 == 0:
+                print(f"Processed {processed} documents")
+            processed += 1
 
             try:
-                extracted_text = extract_text_from_filepath(filepath)
-                print(f"extracted_text from {filepath}")
-
-                # create a metadata object with the source and source_id fields
-                metadata = DocumentMetadata(
-                    source=Source.file,
-                    source_id=filename,
-                )
-
-                # update metadata with custom values
-                for key, value in custom_metadata.items():
-                    if hasattr(metadata, key):
-                        setattr(metadata, key, value)
-
-                # screen for pii if requested
-                if screen_for_pii:
-                    pii_detected = screen_text_for_pii(extracted_text)
-                    # if pii detected, print a warning and skip the document
-                    if pii_detected:
-                        print("PII detected in document, skipping")
-                        skipped_files.append(
-                            filepath
-                        )  # add the skipped file to the list
-                        continue
-
-                # extract metadata if requested
-                if extract_metadata:
-                    # extract metadata from the document text
-                    extracted_metadata = extract_metadata_from_document(
-                        f"Text: {extracted_text}; Metadata: {str(metadata)}"
-                    )
-                    # get a Metadata object from the extracted metadata
-                    metadata = DocumentMetadata(**extracted_metadata)
-
-                # create a document object with a random id, text and metadata
-                document = Document(
-                    id=str(uuid.uuid4()),
-                    text=extracted_text,
-                    metadata=metadata,
-                )
-                documents.append(document)
+                extracted_text, metadata = await future
             except Exception as e:
                 # log the error and continue with the next file
-                print(f"Error processing {filepath}: {e}")
-                skipped_files.append(filepath)  # add the skipped file to the list
-
-    # do this in batches, the upsert method already batches documents but this allows
-    # us to add more descriptive logging
-    for i in range(0, len(documents), DOCUMENT_UPSERT_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_documents = [doc for doc in documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]]
-        print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
-        print("documents: ", documents)
-        await datastore.upsert(batch_documents)
-
-    # delete all files in the dump directory
-    for root, dirs, files in os.walk("dump", topdown=False):
-        for filename in files:
-            filepath = os.path.join(root, filename)
-            os.remove(filepath)
-        for dirname in dirs:
-            dirpath = os.path.join(root, dirname)
-            os.rmdir(dirpath)
-
-    # delete the dump directory
-    os.rmdir("dump")
+                print(f"Error processing {name}: {e}")
+                skipped_files.append(name)  # add the skipped file to the list
+                continue
+            finally:
+                read_ahead()
+
+            # if pii detected, print a warning and skip the document
+            if metadata is None:
+                print("PII detected in document, skipping")
+                skipped_files.append(name)  # add the skipped file to the list
+                if journal is not None:
+                    journal.skip(name, "PII detected")
+                continue
+
+            # create a document object with a generated id, text and metadata. With a journal, the id
+            # is derived from the file, so that retrying its batch replaces its vectors
+            document = Document(
+                id=stable_document_id(dump_id, name) if journal is not None else str(uuid.uuid4()),
+                text=extracted_text,
+                metadata=metadata,
+                mimetype=get_mimetype(name),
+            )
+
+            # upsert in batches as the files are extracted, the upsert method already batches documents
+            # but this allows us to add more descriptive logging
+            batch.append((name, document))
+            if len(batch) >= DOCUMENT_UPSERT_BATCH_SIZE:
+                await upsert_batch(datastore, batch, journal)
+                batch = []
+
+        if batch:
+            await upsert_batch(datastore, batch, journal)
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
 
     # print the skipped files
     print(f"Skipped {len(skipped_files)} files due to errors or PII detection")
@@ -131,6 +195,40 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--workers",
+        default=EXTRACTION_WORKERS,
+        type=int,
+        help="The number of processes extracting text from the files, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--max_in_flight",
+        default=MAX_IN_FLIGHT_FILES,
+        type=int,
+        help="The number of files extracted ahead of the upserts",
+    )
+    parser.add_argument(
+        "--enrichment_concurrency",
+        default=ENRICHMENT_CONCURRENCY,
+        type=int,
+        help="The number of PII screening and metadata extraction completions at a time",
+    )
+    parser.add_argument(
+        "--requests_per_minute",
+        default=ENRICHMENT_REQUESTS_PER_MINUTE,
+        type=float,
+        help="The number of PII screening and metadata extraction completions started per minute, 0 for no limit",
+    )
+    parser.add_argument(
+        "--journal",
+        default=None,
+        help="The path of the checkpoint journal, defaults to the path of the dump with a .journal.sqlite suffix",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the files upserted or skipped by a previous run with the same journal",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -139,11 +237,21 @@ async def main():
     screen_for_pii = args.screen_for_pii
     extract_metadata = args.extract_metadata
 
+    journal = ImportJournal(args.journal or f"{filepath}.journal.sqlite", resume=args.resume)
+
     # initialize the db instance once as a global variable
     datastore = await get_datastore()
     # process the file dump
     await process_file_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        journal,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        enricher=DocumentEnricher(args.enrichment_concurrency, args.requests_per_minute),
     )
 
 
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Optional
+
+from datastore.datastore import DataStore
+from datastore.factory import get_datastore
+from models.models import Document, DocumentMetadata, FileDocument
+from services.file import INCREMENTAL_MIMETYPES, extract_text_from_filepath, get_mimetype
+from services.ingestion import INGESTION_HEARTBEAT_INTERVAL, JobQueue, remove_uploads
+from services.log import configure_logging, correlation_id
+from services.metrics import start_metrics_server
+from services.tracing import span
+
+# How long an idle worker waits before looking for new jobs again, in seconds
+INGESTION_POLL_INTERVAL = float(os.environ.get("INGESTION_POLL_INTERVAL", 1.0))
+# The port serving the Prometheus metrics of the worker, 0 to disable. Set per worker by the app that starts them
+INGESTION_METRICS_PORT = int(os.environ.get("INGESTION_METRICS_PORT", 0))
+
+logger = logging.getLogger(__name__)
+
+
+async def run_job(datastore: DataStore, queue: JobQueue, job: dict) -> list:
+    """
+    Extract the text of an uploaded file, or of a batch of files, and run it through the ingestion pipeline.
+    Returns the ids of the upserted documents.
+    """
+    payload = job["payload"]
+    progress = queue.progress_callback(job["id"])
+
+    tail = payload.get("tail")
+    if tail is not None:
+        # Tails are raw UTF-8 text, appended to a source that was processed up to the tail's offset
+        text = await asyncio.to_thread(_read_text, payload["file_path"])
+        document = Document(
+            id=payload["document_id"], text=text, metadata=DocumentMetadata(**payload["metadata"])
+        )
+        return await datastore.upsert_tail(
+            document,
+            offset=tail["offset"],
+            prefix_checksum=tail["prefix_checksum"],
+            new_checksum=tail["checksum"],
+            chain=payload["chain"],
+            progress=progress,
+        )
+
+    files = payload.get("files")
+    if files is not None:
+        # A batch of files is extracted, then upserted at once, sharing the topics, the question index and
+        # the embedding calls of the chain
+        documents = []
+        for i, file in enumerate(files):
+            progress("extracting", i, len(files))
+            documents.append(
+                await _get_document(file["file_path"], file["mimetype"], file["document_id"], payload["metadata"])
+            )
+        progress("extracting", len(files), len(files))
+        return await datastore.upsert(documents=documents, chain=payload["chain"], progress=progress)
+
+    progress("extracting", 0, 1)
+    document = await _get_document(
+        payload["file_path"], payload["mimetype"], payload["document_id"], payload["metadata"]
+    )
+    progress("extracting", 1, 1)
+    return await datastore.upsert(
+        documents=[document], chain=payload["chain"], progress=progress, appending=payload.get("append", False)
+    )
+
+
+async def send_heartbeats(queue: JobQueue, job_id: str):
+    """
+    Keep a running job claimed while a stage runs without reporting progress, e.g. a long upsert
+    that the datastore client retries.
+    """
+    while True:
+        await asyncio.sleep(INGESTION_HEARTBEAT_INTERVAL)
+        queue.heartbeat(job_id)
+
+
+async def _get_document(file_path: str, mimetype: Optional[str], document_id: str, metadata: dict) -> Document:
+    """
+    Make the document of an uploaded file. Text files without a document id are chunked as they are read,
+    other documents are extracted whole, as the cursor of a synced source works on the full text.
+    """
+    mimetype = get_mimetype(file_path, mimetype)
+    if document_id == "" and mimetype in INCREMENTAL_MIMETYPES:
+        return FileDocument(file_path=file_path, mimetype=mimetype, metadata=DocumentMetadata(**metadata))
+
+    # Parsing is CPU bound, keep it off the event loop of the datastore clients
+    text = await asyncio.to_thread(extract_text_from_filepath, file_path, mimetype)
+    document = Document(text=text, metadata=DocumentMetadata(**metadata), mimetype=mimetype)
+    if document_id != "":
+        document.id = document_id
+    return document
+
+
+def _read_text(file_path: str) -> str:
+    # newline="" keeps the text byte for byte, so that the cursor offsets match the client's file
+    with open(file_path, encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+async def main():
+    datastore = await get_datastore()
+    queue = JobQueue()
+    configure_logging()
+    logger.info("Ingestion worker %d started", os.getpid())
+    if INGESTION_METRICS_PORT:
+        start_metrics_server(INGESTION_METRICS_PORT)
+        logger.info("Serving the metrics of the worker on port %d", INGESTION_METRICS_PORT)
+
+    # Stop on SIGTERM by cancelling the running job, which puts it back in the queue
+    main_task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)  # type: ignore
+
+    while True:
+        job = queue.claim()
+        if job is None:
+            await asyncio.sleep(INGESTION_POLL_INTERVAL)
+            continue
+
+        # Tag the log lines of the job with its id
+        correlation_id.set(job["id"])
+        logger.info("Running ingestion job %s", job["id"])
+        heartbeats = asyncio.create_task(send_heartbeats(queue, job["id"]))
+        try:
+            with span("ingestion_job", **{"job.id": job["id"], "chain": job["payload"].get("chain")}):
+                ids = await run_job(datastore, queue, job)
+            queue.succeed(job["id"], ids)
+        except asyncio.CancelledError:
+            logger.info("Putting ingestion job %s back in the queue", job["id"])
+            queue.requeue(job["id"])
+            raise
+        except Exception as e:
+            logger.exception("Error: %s", e)
+            queue.fail(job["id"], str(e))
+        finally:
+            heartbeats.cancel()
+
+        # The uploads are kept until the job is done, so that a crashed job can be picked up again
+        remove_uploads(job["payload"])
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass
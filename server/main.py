@@ -1,7 +1,11 @@
+import asyncio
+import logging
 import os
-from typing import Optional
+import sys
+import time
+from typing import List, Optional
 import uvicorn
-from fastapi import FastAPI, File, Form, HTTPException, Depends, Body, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Depends, Body, Request, Response, UploadFile
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
@@ -13,7 +17,9 @@ from models.api import (
     QueryRequest,
     QueryResponse,
     UpsertRequest,
-    UpsertResponse,
+    IngestionJobResponse,
+    IngestionJobStatus,
+    SourceCursorResponse,
     AskResponse,
     AskRequest,
     QAResponse,
@@ -24,16 +30,38 @@ from models.api import (
     TopicsResponse
 )
 from datastore.factory import get_datastore
-from services.file import get_document_from_file
+from services.file import save_form_file
+from services.ingestion import JobQueue, INGESTION_SPOOL_DIR, QUEUED, RUNNING, SUCCEEDED, FAILED
+from services.metrics import (
+    ASK_SESSIONS,
+    CONTENT_TYPE,
+    DATASTORE_STATS,
+    INGESTION_JOBS,
+    REGISTRY,
+    REQUEST_DURATION,
+)
+from services.log import configure_logging, correlation_id
+from services.tracing import span
 from services.openai import ask_with_chunks
-from services.dynamodb import get_question, scan_topics, query_questions, edit_question_answer,edit_question_edited, edit_question_archive, edit_question_topic_id
+from services.dynamodb import get_question, scan_topics, query_questions, edit_question_answer,edit_question_edited, edit_question_archive, edit_question_topic_id, get_source_cursor
+from services.source_cursor import SourceCursorMismatch, accepts_tail, ends_with_newline
 
 from models.models import DocumentMetadata, Source
 
+configure_logging()
+logger = logging.getLogger(__name__)
+
 bearer_scheme = HTTPBearer()
 BEARER_TOKEN = os.environ.get("BEARER_TOKEN")
 assert BEARER_TOKEN is not None
+# The number of ingestion worker processes started with the app, 0 to run them separately
+INGESTION_WORKERS = int(os.environ.get("INGESTION_WORKERS", 1))
+# The number of files accepted by one request to /gpt/upsert-files
+UPSERT_BATCH_MAX_FILES = int(os.environ.get("UPSERT_BATCH_MAX_FILES", 1000))
+# The port of the metrics of the first ingestion worker, the next workers use the following ports. 0 to disable
+INGESTION_METRICS_PORT = int(os.environ.get("INGESTION_METRICS_PORT", 0))
 message_requests = {}
+ingestion_workers = []
 
 def validate_token(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
     if credentials.scheme != "Bearer" or credentials.credentials != BEARER_TOKEN:
@@ -71,6 +99,47 @@ sub_app = FastAPI(
 )
 app.mount("/sub", sub_app)
 
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    # Tag the log lines of the request with the id given by the client, or a new one, which is returned to it
+    request_id = request.headers.get("X-Request-ID") or uuid4().hex
+    token = correlation_id.set(request_id)
+    with span(f"{request.method} {request.url.path}", **{"http.method": request.method}) as current:
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers["X-Request-ID"] = request_id
+            return response
+        finally:
+            correlation_id.reset(token)
+            # Label by route template rather than path, so that ids in paths don't make a series per request
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start, method=request.method, route=route, status=str(status)
+            )
+            current.update_name(f"{request.method} {route}")
+            current.set_attributes({"http.route": route, "http.status_code": status})
+
+
+@app.get(
+    "/metrics",
+    description="Prometheus metrics of the API: request latencies, pipeline stages, tokens, caches and queues.",
+)
+async def metrics():
+    # Gauges of state kept elsewhere are read at scrape time
+    counts = ingestion_queue.counts()
+    for status in (QUEUED, RUNNING, SUCCEEDED, FAILED):
+        INGESTION_JOBS.set(counts.get(status, 0), status=status)
+    ASK_SESSIONS.set(len(message_requests))
+    if hasattr(datastore, "get_partition_stats"):
+        for stat, value in datastore.get_partition_stats().items():
+            if isinstance(value, (int, float)):
+                DATASTORE_STATS.set(value, stat=stat)
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
 @app.post(
         "/questions/archive-edit",
         description='Change the archive status of a question. Admin can archive questions they want to ignore.'
@@ -85,7 +154,7 @@ async def archive_question(
             archived=request.archived
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
@@ -117,7 +186,7 @@ async def answer_question(
             topic_id=request.topic_id
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
     
 @app.post(
@@ -134,7 +203,7 @@ async def answer_question(
             topic_id=request.topic_id
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
@@ -155,7 +224,7 @@ async def get_qas(
             last_evaluated_key=last_evaluated_key
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 @app.get(
@@ -175,7 +244,7 @@ async def get_qa(
             qas=[qa]
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 @app.get(
@@ -189,7 +258,7 @@ async def get_topics():
             topics=topics
         )
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 
@@ -207,32 +276,168 @@ async def ask_question(
     request: AskRequest = Body(...)
 ):
     try:
-        print('Getting chunks')
+        logger.debug('Getting chunks')
         query_results = await datastore.query(queries=[Query(query=request.question)], chain=request.chain)
         chunks = [result.text for result in query_results[0].results]
 
-        print('Getting answer from chatgpt')
+        logger.debug('Getting answer from chatgpt')
         question = f"This is a question regarding {request.chain}.\n{request.question}"
         request_id = request.request_id if request.request_id is not None and request.request_id != '' else uuid4().hex
         prev_messages = message_requests.get(request.request_id, [])
-        print(f"Using {len(prev_messages)} previous messages")
+        logger.debug("Using %d previous messages", len(prev_messages))
         (answer, messages) = ask_with_chunks(question=question, chunks=chunks, prev_messages=prev_messages)
         message_requests[request_id] = messages
         return AskResponse(answer=answer, request_id=request_id)
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
 @app.post(
     "/gpt/upsert-file",
-    response_model=UpsertResponse,
+    response_model=IngestionJobResponse,
+    description="""
+    Queue a file for ingestion and return the id of the ingestion job. The file is extracted, chunked,
+    and upserted in the background; poll /gpt/upsert-file/{job_id} for its progress and result.
+    Set append for a source that is synced by appending lines to it, so that its partial last line is left
+    for the next sync.
+    """
 )
 async def upsert_file(
     file: UploadFile = File(...),
     metadata: Optional[str] = Form(None),
     chain: str = "a blockchain network",
+    id: str = "",
+    append: bool = False,
+):
+    try:
+        metadata_obj = (
+            DocumentMetadata.parse_raw(metadata)
+            if metadata
+            else DocumentMetadata(source=Source.file)
+        )
+    except:
+        metadata_obj = DocumentMetadata(source=Source.file)
+
+    try:
+        file_path = await save_form_file(file, INGESTION_SPOOL_DIR)
+        job_id = ingestion_queue.enqueue(
+            {
+                "file_path": file_path,
+                "mimetype": file.content_type,
+                "metadata": metadata_obj.dict(),
+                "chain": chain,
+                "document_id": id,
+                "append": append,
+            }
+        )
+        return IngestionJobResponse(job_id=job_id, status=QUEUED)
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.post(
+    "/gpt/upsert-files",
+    response_model=IngestionJobResponse,
+    description="""
+    Queue many files of a chain for ingestion as a single job, and return the id of the job. The files are
+    extracted and upserted together, so the topics, the question embeddings of the chain and the embedding
+    calls are shared by all of them. ids are the document ids of the files, in the same order, or empty
+    strings for files that aren't synced sources. Poll /gpt/upsert-file/{job_id} for the progress and result.
+    """
+)
+async def upsert_files(
+    files: List[UploadFile] = File(...),
+    ids: List[str] = Form([]),
+    metadata: Optional[str] = Form(None),
+    chain: str = "a blockchain network",
+):
+    if len(files) > UPSERT_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"A batch can have at most {UPSERT_BATCH_MAX_FILES} files")
+    if ids and len(ids) != len(files):
+        raise HTTPException(status_code=400, detail="ids must have one id per file")
+    # The cursor of a source is saved once per upsert, so a source can only be in a batch once
+    if len([id for id in ids if id]) != len({id for id in ids if id}):
+        raise HTTPException(status_code=400, detail="ids must be unique")
+    try:
+        metadata_obj = (
+            DocumentMetadata.parse_raw(metadata)
+            if metadata
+            else DocumentMetadata(source=Source.file)
+        )
+    except:
+        metadata_obj = DocumentMetadata(source=Source.file)
+
+    file_paths = []
+    try:
+        for file in files:
+            file_paths.append(await save_form_file(file, INGESTION_SPOOL_DIR))
+        job_id = ingestion_queue.enqueue(
+            {
+                "files": [
+                    {"file_path": file_path, "mimetype": file.content_type, "document_id": id}
+                    for file_path, file, id in zip(file_paths, files, ids or [""] * len(files))
+                ],
+                "metadata": metadata_obj.dict(),
+                "chain": chain,
+            }
+        )
+        return IngestionJobResponse(job_id=job_id, status=QUEUED)
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        # Nothing will process the files that were saved
+        for file_path in file_paths:
+            os.remove(file_path)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.get(
+    "/gpt/sources/{source_id}/cursor",
+    response_model=SourceCursorResponse,
+    description="""
+    Get how far a source document has been processed: the byte offset of its UTF-8 text and the sha256 of the
+    bytes before it. A client whose copy of the source still has this checksum only needs to send the bytes
+    after the offset to /gpt/upsert-tail.
+    """
+)
+async def get_source_cursor_endpoint(source_id: str, chain: str = "a blockchain network"):
+    try:
+        cursor = get_source_cursor(chain=chain, source_id=source_id)
+        # Sources synced before byte cursors existed have no offset until they are uploaded whole once
+        return SourceCursorResponse(
+            source_id=source_id,
+            chain=chain,
+            byte_offset=cursor.byte_offset if cursor.byte_offset is not None or cursor.line else 0,
+            checksum=cursor.checksum,
+        )
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        raise HTTPException(status_code=500, detail=f"str({e})")
+
+
+@app.post(
+    "/gpt/upsert-tail",
+    response_model=IngestionJobResponse,
+    description="""
+    Queue the bytes appended to a UTF-8 text source since it was last processed, and return the id of the
+    ingestion job. offset and prefix_checksum must match the cursor of /gpt/sources/{id}/cursor, and checksum
+    is the sha256 of the source up to the end of the uploaded bytes. The uploaded bytes must end with a newline,
+    a partial last line is sent with the next tail. If the cursor doesn't match, e.g. because the beginning of
+    the source changed, the request fails with 409 and the whole file has to be sent to /gpt/upsert-file with
+    append set, which processes it again from the start.
+    """
+)
+async def upsert_tail(
+    file: UploadFile = File(...),
+    offset: int = Form(...),
+    checksum: str = Form(...),
+    prefix_checksum: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    chain: str = "a blockchain network",
     id: str = ""
 ):
+    if id == "":
+        raise HTTPException(status_code=400, detail="A tail upload needs the id of its source document")
     try:
         metadata_obj = (
             DocumentMetadata.parse_raw(metadata)
@@ -242,17 +447,43 @@ async def upsert_file(
     except:
         metadata_obj = DocumentMetadata(source=Source.file)
 
-    document = await get_document_from_file(file, metadata_obj)
+    # Fail fast, the cursor is checked again when the job runs
+    cursor = get_source_cursor(chain=chain, source_id=id)
+    if not accepts_tail(cursor, offset, prefix_checksum):
+        raise HTTPException(status_code=409, detail=str(SourceCursorMismatch(cursor)))
 
+    file_path = await save_form_file(file, INGESTION_SPOOL_DIR)
+    if not ends_with_newline(file_path):
+        os.remove(file_path)
+        raise HTTPException(status_code=400, detail="A tail upload must end with a newline")
     try:
-        if id != '':
-            document.id = id
-        ids = await datastore.upsert(documents=[document], chain=chain)
-        return UpsertResponse(ids=ids)
+        job_id = ingestion_queue.enqueue(
+            {
+                "file_path": file_path,
+                "mimetype": "text/plain",
+                "metadata": metadata_obj.dict(),
+                "chain": chain,
+                "document_id": id,
+                "tail": {"offset": offset, "prefix_checksum": prefix_checksum, "checksum": checksum},
+            }
+        )
+        return IngestionJobResponse(job_id=job_id, status=QUEUED)
     except Exception as e:
-        print("Error:", e)
+        logger.exception("Error: %s", e)
         raise HTTPException(status_code=500, detail=f"str({e})")
 
+
+@app.get(
+    "/gpt/upsert-file/{job_id}",
+    response_model=IngestionJobStatus,
+    description="Get the status of an ingestion job, with the progress, throughput and ETA of its current stage."
+)
+async def get_upsert_file_status(job_id: str):
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return IngestionJobStatus(**job)
+
 """
 @app.post(
     "/upsert",
@@ -336,8 +567,29 @@ async def delete(
 
 @app.on_event("startup")
 async def startup():
-    global datastore
+    global datastore, ingestion_queue
     datastore = await get_datastore()
+    ingestion_queue = JobQueue()
+    # Workers run in their own processes, so that ingestion never blocks the API
+    for i in range(INGESTION_WORKERS):
+        env = dict(os.environ)
+        if INGESTION_METRICS_PORT:
+            env["INGESTION_METRICS_PORT"] = str(INGESTION_METRICS_PORT + i)
+        ingestion_workers.append(
+            await asyncio.create_subprocess_exec(sys.executable, "-m", "server.ingestion_worker", env=env)
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Workers put their running job back in the queue when terminated. A worker stuck in a blocking call
+    # is killed, and its job is picked up again once its heartbeat goes stale
+    for worker in ingestion_workers:
+        worker.terminate()
+        try:
+            await asyncio.wait_for(worker.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            worker.kill()
 
 
 def start():
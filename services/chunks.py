@@ -1,17 +1,24 @@
-from typing import Dict, List, Optional, Tuple
+from bisect import bisect_right
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import uuid
-from models.models import Document, DocumentChunk, DocumentChunkMetadata, DocumentQuestion
+from models.models import Document, DocumentChunk, DocumentChunkMetadata, DocumentQuestion, FileDocument
 from services.extract_questions import extract_questions_from_text, standardize_question
 
 import re
 import tiktoken
 
+from services.file import PAGE_BREAK, PAGED_MIMETYPES, iter_text_from_filepath
 from services.openai import get_embeddings
+from services.ingestion import ProgressCallback
+
+logger = logging.getLogger(__name__)
 
 # Global variables
 tokenizer = tiktoken.get_encoding(
     "cl100k_base"
 )  # The encoding scheme to use for tokenization
+NEWLINE_TOKEN = tokenizer.encode("\n")[0]  # Replaces the page breaks between the tokens of two pages
 
 # Constants
 CHUNK_SIZE = 500  # The target size of each text chunk in tokens
@@ -19,116 +26,244 @@ MIN_CHUNK_SIZE_CHARS = 350  # The minimum size of each text chunk in characters
 MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
 EMBEDDINGS_BATCH_SIZE = 128  # The number of embeddings to request at a time
 MAX_NUM_CHUNKS = 100000  # The maximum number of chunks to generate from a text
+MAX_PENDING_TEXT_CHARS = 1024 * 1024  # Text without a newline is tokenized anyway once it grows this long
+TAG_PATTERN = re.compile(r"\[.*?\]")  # Tags such as the date of a discussion, which never span lines
 
 
-def get_text_chunks(text: str, chunk_token_size: Optional[int], chain: str, date: str | None) -> List[str]:
+def get_text_chunks(
+    text: Union[str, Iterable[str]], chunk_token_size: Optional[int], chain: str, date: str | None
+) -> List[str]:
     """
     Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
 
     Args:
-        text: The text to split into chunks.
+        text: The text to split into chunks, or an iterable of consecutive blocks of text.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
     Returns:
         A list of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
     """
-    # Return an empty list if the text is empty or whitespace
-    if not text or text.isspace():
-        return []
+    return list(iter_text_chunks([text] if isinstance(text, str) else text, chunk_token_size, chain, date))
+
+
+def iter_text_chunks(
+    blocks: Iterable[str], chunk_token_size: Optional[int], chain: str, date: str | None
+) -> Iterator[str]:
+    """
+    Incrementally split consecutive blocks of text into chunks of ~CHUNK_SIZE tokens.
+
+    Blocks are tokenized up to their last newline as they arrive, and chunks are split off as soon as
+    a full chunk of tokens is buffered, so only about one block of text and tokens is held at a time.
+
+    Args:
+        blocks: The consecutive blocks of text to split into chunks, e.g. from a text file generator.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Returns:
+        A generator of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
+    """
+    for chunk_text, _, _ in iter_text_chunks_with_pages(blocks, chunk_token_size, chain, date):
+        yield chunk_text
+
 
-    # Tokenize the text
-    tokens = tokenizer.encode(text, disallowed_special=())
+def iter_text_chunks_with_pages(
+    blocks: Iterable[str], chunk_token_size: Optional[int], chain: str, date: str | None
+) -> Iterator[Tuple[str, int, int]]:
+    """
+    Like iter_text_chunks, but also yield the first and last page of each chunk.
 
-    # Initialize an empty list of chunks
-    chunks = []
+    Pages are separated by PAGE_BREAK characters, as in extracted PDF text, and numbered from 1.
+    Text without page breaks is a single page.
 
+    Returns:
+        A generator of (chunk_text, page_start, page_end) tuples.
+    """
     # Use the provided chunk token size or the default one
     chunk_size = chunk_token_size or CHUNK_SIZE
 
+    # Tokens not split into chunks yet start at offset, text not tokenized yet because its line is not complete
+    tokens: List[int] = []
+    offset = 0
+    pending_text = ""
+    # The number of tokens dropped from the buffer, and the absolute token position where each page after
+    # the first one starts
+    dropped = 0
+    page_starts: List[int] = []
+
     # Initialize a counter for the number of chunks
     num_chunks = 0
 
-    # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
-
-        # Decode the chunk into text
-        chunk_text = tokenizer.decode(chunk)
-        if chain != "":
-            if date != None:
-                chunk_text = f"{date}. Discussion excerpt regarding {chain}.\n{chunk_text}"
-            else:
-                chunk_text = f"Discussion excerpt regarding {chain}.\n{chunk_text}"
-        
-        # Skip the chunk if it is empty or whitespace
-        if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
-            # Continue to the next iteration of the loop
+    def split_chunks(min_tokens: int) -> Iterator[Tuple[str, int, int]]:
+        nonlocal offset, num_chunks
+        while len(tokens) - offset >= min_tokens and num_chunks < MAX_NUM_CHUNKS:
+            chunk_text, num_tokens = _split_chunk(tokens, offset, chunk_size, chain, date)
+            start = dropped + offset
+            offset += num_tokens
+            if chunk_text is not None:
+                num_chunks += 1
+                if len(chunk_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+                    yield (
+                        chunk_text,
+                        bisect_right(page_starts, start) + 1,
+                        bisect_right(page_starts, dropped + offset - 1) + 1,
+                    )
+
+    for block in blocks:
+        pending_text += block
+        # Tokenize complete lines and pages only, so that no token is split at a block boundary
+        cut = max(pending_text.rfind("\n"), pending_text.rfind(PAGE_BREAK)) + 1
+        if cut == 0 and len(pending_text) < MAX_PENDING_TEXT_CHARS:
             continue
+        # Drop the tokens already split into chunks before appending new ones
+        del tokens[:offset]
+        dropped += offset
+        offset = 0
+        # Pages are tokenized separately, with their break turned into a newline, to record where they start
+        for i, page_text in enumerate(pending_text[: cut or None].split(PAGE_BREAK)):
+            if i > 0:
+                tokens.append(NEWLINE_TOKEN)
+                page_starts.append(dropped + len(tokens))
+            tokens.extend(tokenizer.encode(page_text, disallowed_special=()))
+        pending_text = pending_text[cut:] if cut else ""
+
+        # Split off chunks while a full chunk of tokens is buffered
+        yield from split_chunks(chunk_size)
+
+        if num_chunks >= MAX_NUM_CHUNKS:
+            break
+
+    if pending_text and num_chunks < MAX_NUM_CHUNKS:
+        tokens.extend(tokenizer.encode(pending_text, disallowed_special=()))
 
-        # Find the last period or punctuation mark in the chunk
-        last_punctuation = max(
-            chunk_text.rfind("."),
-            chunk_text.rfind("?"),
-            chunk_text.rfind("!"),
-            chunk_text.rfind("\n"),
-        )
+    # Loop until all tokens are consumed
+    yield from split_chunks(1)
 
-        # If there is a punctuation mark, and the last punctuation index is before MIN_CHUNK_SIZE_CHARS
-        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
-            # Truncate the chunk text at the punctuation mark
-            chunk_text = chunk_text[: last_punctuation + 1]
+    # Handle the remaining tokens
+    if offset < len(tokens):
+        remaining_text = tokenizer.decode(tokens[offset:]).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            yield (
+                remaining_text,
+                bisect_right(page_starts, dropped + offset) + 1,
+                len(page_starts) + 1,
+            )
 
-        # Remove any newline characters and strip any leading or trailing whitespace
-        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
 
-        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
-            # Append the chunk text to the list of chunks
-            chunks.append(chunk_text_to_append)
+def _iter_complete_lines(blocks: Iterable[str]) -> Iterator[str]:
+    """
+    Regroup consecutive blocks of text so that each one ends at a newline, except the last one and
+    lines longer than MAX_PENDING_TEXT_CHARS, so that patterns within a line can be matched block by block.
+    """
+    pending_text = ""
+    for block in blocks:
+        pending_text += block
+        cut = pending_text.rfind("\n") + 1
+        if cut == 0 and len(pending_text) < MAX_PENDING_TEXT_CHARS:
+            continue
+        yield pending_text[: cut or None]
+        pending_text = pending_text[cut:] if cut else ""
+    if pending_text:
+        yield pending_text
 
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
 
-        # Increment the number of chunks
-        num_chunks += 1
+def _split_chunk(
+    tokens: List[int], offset: int, chunk_size: int, chain: str, date: str | None
+) -> Tuple[Optional[str], int]:
+    """
+    Split the next chunk off the tokens, starting at offset.
 
-    # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
-        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
-            chunks.append(remaining_text)
+    Returns:
+        A tuple of (chunk_text, num_tokens), where chunk_text is None if the chunk is empty or whitespace,
+        and num_tokens is the number of tokens the chunk consumed.
+    """
+    # Take the next chunk_size tokens as a chunk
+    chunk = tokens[offset : offset + chunk_size]
+
+    # Decode the chunk into text
+    chunk_text = tokenizer.decode(chunk)
+
+    # Skip the chunk if it is empty or whitespace
+    if not chunk_text or chunk_text.isspace():
+        return None, len(chunk)
+
+    prefix = ""
+    if chain != "":
+        if date != None:
+            prefix = f"{date}. Discussion excerpt regarding {chain}.\n"
+        else:
+            prefix = f"Discussion excerpt regarding {chain}.\n"
+    chunk_text = prefix + chunk_text
+
+    # Find the last period or punctuation mark in the chunk
+    last_punctuation = max(
+        chunk_text.rfind("."),
+        chunk_text.rfind("?"),
+        chunk_text.rfind("!"),
+        chunk_text.rfind("\n"),
+    )
 
-    return chunks
+    # If there is a punctuation mark, and the last punctuation index is before MIN_CHUNK_SIZE_CHARS
+    if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+        # Truncate the chunk text at the punctuation mark
+        chunk_text = chunk_text[: last_punctuation + 1]
+
+    # The tokens consumed are those of the text after the prefix
+    num_tokens = len(tokenizer.encode(chunk_text[len(prefix) :], disallowed_special=()))
+
+    # Remove any newline characters and strip any leading or trailing whitespace
+    return chunk_text.replace("\n", " ").strip(), max(num_tokens, 1)
 
 
 def create_document_chunks(
-    doc: Document, chunk_token_size: Optional[int], chain: str
+    doc: Document,
+    chunk_token_size: Optional[int],
+    chain: str,
+    progress: Optional[ProgressCallback] = None,
 ) -> Tuple[List[DocumentChunk], str]:
     """
     Create a list of document chunks from a document object and return the document id.
 
     Args:
         doc: The document object to create chunks from. It should have a text attribute and optionally an id and a metadata attribute.
+            The text of a FileDocument is extracted from its file block by block as it is chunked.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        progress: Optional callback reporting the number of chunks whose questions were extracted.
 
     Returns:
         A tuple of (doc_chunks, doc_id), where doc_chunks is a list of document chunks, each of which is a DocumentChunk object with an id, a document_id, a text, and a metadata attribute,
         and doc_id is the id of the document object, generated if not provided. The id of each chunk is generated from the document id and a sequential number, and the metadata is copied from the document object.
     """
-    # Check if the document text is empty or whitespace
-    if not doc.text or doc.text.isspace():
-        return [], doc.id or str(uuid.uuid4())
-
     # Generate a document id if not provided
     doc_id = doc.id or str(uuid.uuid4())
 
-    # Split the document text into chunks
-    match = re.search("\[.*?\]", doc.text)
-    text = re.sub("\[.*?\]","",doc.text)
-    print("match.group(0) " + match.group(0))
-    text_chunks = get_text_chunks(text, chunk_token_size, chain, match.group(0) if match is not None else None)
+    # Split the document text into chunks, with the first tag as the date and the tags removed.
+    # The text of a file document is extracted twice, to find its first tag and to chunk it
+    if isinstance(doc, FileDocument):
+        date = next(
+            (
+                match.group(0)
+                for block in _iter_complete_lines(iter_text_from_filepath(doc.file_path, doc.mimetype))
+                if (match := TAG_PATTERN.search(block)) is not None
+            ),
+            None,
+        )
+        blocks = (
+            TAG_PATTERN.sub("", block)
+            for block in _iter_complete_lines(iter_text_from_filepath(doc.file_path, doc.mimetype))
+        )
+    else:
+        # Check if the document text is empty or whitespace
+        if not doc.text or doc.text.isspace():
+            return [], doc_id
+        match = TAG_PATTERN.search(doc.text)
+        date = match.group(0) if match is not None else None
+        text = TAG_PATTERN.sub("", doc.text)
+        blocks = [text]
+    logger.debug("Document tag: %s", date)
+    text_chunks = list(iter_text_chunks_with_pages(blocks, chunk_token_size, chain, date))
+    # Only chunks of paged documents, such as PDFs, cite their pages, even when they have a single page
+    paged = doc.mimetype in PAGED_MIMETYPES
+    page_offset = doc.first_page - 1
 
     metadata = (
         DocumentChunkMetadata(**doc.metadata.__dict__)
@@ -142,14 +277,14 @@ def create_document_chunks(
     doc_chunks = []
 
     # Assign each chunk a sequential number and create a DocumentChunk object
-    for i, text_chunk in enumerate(text_chunks):
+    for i, (text_chunk, page_start, page_end) in enumerate(text_chunks):
         chunk_id = f"{doc_id}_{i}"
 
         # Initialize empty list of questions
         questions: List[DocumentQuestion] = []
 
         # Extract/write questions for the given text chunk
-        print(f"text_chunk: {text_chunk}")
+        logger.debug("text_chunk: %s", text_chunk)
         extracted_questions = extract_questions_from_text(text_chunk, 3)
         # extracted_questions = [standardize_question(q) for q in extracted_questions]
 
@@ -167,19 +302,29 @@ def create_document_chunks(
         doc_chunk = DocumentChunk(
             id=chunk_id,
             text=text_chunk,
-            metadata=metadata,
+            metadata=(
+                metadata.copy(update={"page_start": page_offset + page_start, "page_end": page_offset + page_end})
+                if paged
+                else metadata
+            ),
             questions=questions,
             topic_id='other'
         )
         # Append the chunk object to the list of chunks for this document
         doc_chunks.append(doc_chunk)
 
+        if progress is not None:
+            progress("chunking", i + 1, len(text_chunks))
+
     # Return the list of chunks and the document id
     return doc_chunks, doc_id
 
 
 def get_document_chunks(
-    documents: List[Document], chunk_token_size: Optional[int], chain: str
+    documents: List[Document],
+    chunk_token_size: Optional[int],
+    chain: str,
+    progress: Optional[ProgressCallback] = None,
 ) -> Dict[str, List[DocumentChunk]]:
     """
     Convert a list of documents into a dictionary from document id to list of document chunks.
@@ -187,6 +332,7 @@ def get_document_chunks(
     Args:
         documents: The list of documents to convert.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        progress: Optional callback reporting the chunking and embedding progress.
 
     Returns:
         A dictionary mapping each document id to a list of document chunks, each of which is a DocumentChunk object
@@ -200,7 +346,7 @@ def get_document_chunks(
 
     # Loop over each document and create chunks
     for doc in documents:
-        doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size, chain)
+        doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size, chain, progress)
 
         # Append the chunks for this document to the list of all chunks
         all_chunks.extend(doc_chunks)
@@ -227,6 +373,9 @@ def get_document_chunks(
         # Append the batch embeddings to the embeddings list
         embeddings.extend(batch_embeddings)
 
+        if progress is not None:
+            progress("embedding", len(embeddings), len(all_chunks))
+
     # Update the document chunk objects with the embeddings
     for i, chunk in enumerate(all_chunks):
         # Assign the embedding from the embeddings list to the chunk object
@@ -1,5 +1,9 @@
+import logging
+
 import arrow
 
+logger = logging.getLogger(__name__)
+
 
 def to_unix_timestamp(date_str: str) -> int:
     """
@@ -11,13 +15,13 @@ def to_unix_timestamp(date_str: str) -> int:
     Returns:
         The unix timestamp corresponding to the date string.
 
-    If the date string cannot be parsed as a valid date format, returns the current unix timestamp and prints a warning.
+    If the date string cannot be parsed as a valid date format, returns the current unix timestamp and logs a warning.
     """
     # Try to parse the date string using arrow, which supports many common date formats
     try:
         date_obj = arrow.get(date_str)
         return int(date_obj.timestamp())
     except arrow.parser.ParserError:
-        # If the parsing fails, return the current unix timestamp and print a warning
-        print(f"Invalid date format: {date_str}")
+        # If the parsing fails, return the current unix timestamp and log a warning
+        logger.warning("Invalid date format: %s", date_str)
         return int(arrow.now().timestamp())
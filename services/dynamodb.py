@@ -1,8 +1,11 @@
+import logging
 import os
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
-from typing import List
-from models.models import QuestionAnswer, QuestionTopic
+from typing import List, Optional
+from models.models import QuestionAnswer, QuestionTopic, SourceCursor
+from services.metrics import DYNAMODB_DURATION, timed
+from services.tracing import traced
 import unicodedata
 import re
 
@@ -11,6 +14,18 @@ table = dynamodb.Table('stakex-cms')
 table_topics = dynamodb.Table('stakex-cms-topics')
 table_sources = dynamodb.Table('stakex-cms-sources')
 
+logger = logging.getLogger(__name__)
+
+def instrumented(operation: str):
+    """Time and trace the calls of a DynamoDB operation."""
+    def decorator(function):
+        function = traced(
+            f"dynamodb.{operation}", arguments=("chain",), **{"db.system": "dynamodb", "db.operation": operation}
+        )(function)
+        return timed(DYNAMODB_DURATION, operation=operation)(function)
+    return decorator
+
+@instrumented("edit_question_archive")
 def edit_question_archive(chain: str, question: str, archived: bool):
     table.update_item(
         Key={
@@ -29,6 +44,7 @@ def edit_question_archive(chain: str, question: str, archived: bool):
         },
     )
 
+@instrumented("edit_question_topic_id")
 def edit_question_topic_id(chain: str, question: str, topic_id: str):
     table.update_item(
         Key={
@@ -47,6 +63,7 @@ def edit_question_topic_id(chain: str, question: str, topic_id: str):
         }
     )
 
+@instrumented("edit_question_edited")
 def edit_question_edited(chain: str, question: str, question_edited: str):
     table.update_item(
         Key={
@@ -65,6 +82,7 @@ def edit_question_edited(chain: str, question: str, question_edited: str):
         }
     )
 
+@instrumented("edit_question_answer")
 def edit_question_answer(chain: str, question: str, answer: str):
     table.update_item(
         Key={
@@ -83,16 +101,18 @@ def edit_question_answer(chain: str, question: str, answer: str):
         }
     )
 
+@instrumented("scan_topics")
 def scan_topics() -> List[QuestionTopic]:
     response = table_topics.scan()
-    print(response)
+    logger.debug("Topics scan response: %s", response)
     data = response['Items']
     while 'LastEvaluatedKey' in response:
         response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
         data.extend(response['Items'])
-    print(data)
+    logger.debug("Topics: %s", data)
     return [QuestionTopic(topic_id=t['topicId'], topic=t['topic']) for t in data]
 
+@instrumented("query_questions")
 def query_questions(chain: str, paginate: bool, key: str) : #-> List[QuestionAnswer]
     questions_answers: List[QuestionAnswer] = []
     last_evaluated_key = ''
@@ -147,6 +167,7 @@ def query_questions(chain: str, paginate: bool, key: str) : #-> List[QuestionAns
     return questions_answers, last_evaluated_key
 
 
+@instrumented("get_question")
 def get_question(chain:str, question: str) -> QuestionAnswer:
     try:
         response = table.get_item(
@@ -167,29 +188,41 @@ def get_question(chain:str, question: str) -> QuestionAnswer:
     except:
         return None
 
-def get_source_last_line_processed(chain: str, source_id: str) -> int:
+@instrumented("get_source_cursor")
+def get_source_cursor(chain: str, source_id: str) -> SourceCursor:
     try:
         response = table_sources.get_item(
             Key={'chain': chain, 'sourceId': source_id},
-            ProjectionExpression="lastLineProcessed"
+            ProjectionExpression="lastLineProcessed, byteOffset, prefixChecksum"
             )
     except:
-        return 0
+        return SourceCursor()
     else:
-        return int(response['Item']['lastLineProcessed']) if "Item" in response else 0
+        if "Item" not in response:
+            return SourceCursor()
+        item = response['Item']
+        return SourceCursor(
+            byte_offset=int(item['byteOffset']) if item.get('byteOffset') is not None else None,
+            checksum=item.get('prefixChecksum'),
+            line=int(item.get('lastLineProcessed', 0))
+        )
 
-def edit_source_last_line_processed(chain: str, source_id: str, line: int):
+@instrumented("edit_source_cursor")
+def edit_source_cursor(chain: str, source_id: str, cursor: SourceCursor):
     table_sources.update_item(
         Key={
             'chain': chain,
             'sourceId': source_id
         },
-        UpdateExpression='SET lastLineProcessed = :ln',
+        UpdateExpression='SET lastLineProcessed = :ln, byteOffset = :bo, prefixChecksum = :pc',
         ExpressionAttributeValues={
-            ':ln': line,
+            ':ln': cursor.line,
+            ':bo': cursor.byte_offset,
+            ':pc': cursor.checksum,
         },
     )
 
+@instrumented("query_question_embeddings")
 def query_question_embeddings(chain: str) -> List[List[float]]:
     response = table.query(
         KeyConditionExpression=Key('chain').eq(chain),
@@ -211,15 +244,40 @@ def query_question_embeddings(chain: str) -> List[List[float]]:
             results.append(embedding)
     return results
 
-def save_question_to_db(chain: str, question: str, embedding: str, topic_id: str):
-    table.put_item(Item={
-                'chain': chain,
-                'question': slugify(question),
-                'questionEdited': question,
-                'embedding': embedding,
-                'topicId': topic_id
-            }
+@instrumented("save_question_to_db")
+def save_question_to_db(chain: str, question: str, embedding: str, topic_id: str, document_id: Optional[str] = None):
+    item = {
+        'chain': chain,
+        'question': slugify(question),
+        'questionEdited': question,
+        'embedding': embedding,
+        'topicId': topic_id
+    }
+    # The document the question was extracted from, so that its questions can be removed with it
+    if document_id is not None:
+        item['documentId'] = document_id
+    table.put_item(Item=item)
+
+@instrumented("delete_document_questions")
+def delete_document_questions(chain: str, document_ids: List[str]) -> int:
+    """Delete the questions of a chain extracted from the given documents, returns how many were deleted."""
+    keys = []
+    # A filter takes at most 100 values
+    for i in range(0, len(document_ids), 100):
+        query = dict(
+            KeyConditionExpression=Key('chain').eq(chain),
+            FilterExpression=Attr('documentId').is_in(document_ids[i : i + 100]),
+            ProjectionExpression="chain,question",
         )
+        response = table.query(**query)
+        keys.extend(response['Items'])
+        while 'LastEvaluatedKey' in response:
+            response = table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query)
+            keys.extend(response['Items'])
+    with table.batch_writer() as batch:
+        for key in keys:
+            batch.delete_item(Key={'chain': key['chain'], 'question': key['question']})
+    return len(keys)
     
 def slugify(text):
     text = str(text)
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from models.models import DocumentMetadata
+from services.extract_metadata import extract_metadata_from_document
+from services.pii_detection import PII_PRESCREEN, prescreen_text_for_pii, screen_text_for_pii
+
+# Constants
+ENRICHMENT_CONCURRENCY = int(os.environ.get("ENRICHMENT_CONCURRENCY", 8))  # The number of completions at a time
+# The number of completions started per minute by the PII screening and metadata extraction together, 0 for no limit
+ENRICHMENT_REQUESTS_PER_MINUTE = float(os.environ.get("ENRICHMENT_REQUESTS_PER_MINUTE", 500))
+ENRICHMENT_CACHE_SIZE = int(os.environ.get("ENRICHMENT_CACHE_SIZE", 10000))  # The number of results kept in memory
+
+
+class RateLimiter:
+    """
+    Spaces out the requests of all the tasks sharing it to at most requests_per_minute, in the order they asked.
+    """
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60 / requests_per_minute if requests_per_minute > 0 else 0
+        self.next_at = 0.0
+
+    async def acquire(self):
+        # Reserve the next free slot before sleeping, so that tasks waiting together get successive slots
+        now = time.monotonic()
+        wait = self.next_at - now
+        self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class DocumentEnricher:
+    """
+    Screens documents for PII and extracts their metadata with concurrent completions, for the bulk import
+    scripts.
+
+    The blocking completions run in threads, at most concurrency at a time and no faster than the shared
+    rate limiter allows. Results are cached by the sha256 of the text sent, so duplicate documents cost
+    one completion, including when they are enriched at the same time.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = ENRICHMENT_CONCURRENCY,
+        requests_per_minute: float = ENRICHMENT_REQUESTS_PER_MINUTE,
+        cache_size: int = ENRICHMENT_CACHE_SIZE,
+    ):
+        self.slots = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.cache_size = cache_size
+        # Completions by step and text hash, in least recently used order
+        self.cache: "OrderedDict[Tuple[str, str], asyncio.Future]" = OrderedDict()
+
+    async def enrich(
+        self,
+        text: str,
+        metadata: DocumentMetadata,
+        screen_for_pii: bool,
+        extract_metadata: bool,
+    ) -> Optional[DocumentMetadata]:
+        """
+        Run the requested enrichment steps on a document.
+
+        Returns:
+            The metadata of the document, extracted from its text if requested, or None if PII was detected.
+        """
+        # Screen first, so that no metadata is extracted from documents that are skipped
+        if screen_for_pii and await self.screen_for_pii(text):
+            return None
+        if extract_metadata:
+            # extract metadata from the document text, and get a Metadata object from it
+            extracted_metadata = await self.extract_metadata(f"Text: {text}; Metadata: {str(metadata)}")
+            metadata = DocumentMetadata(**extracted_metadata)
+        return metadata
+
+    async def screen_for_pii(self, text: str) -> bool:
+        # Texts the local detectors are sure about don't wait for a completion slot
+        if PII_PRESCREEN:
+            pii_detected = prescreen_text_for_pii(text)
+            if pii_detected is not None:
+                return pii_detected
+        return await self._complete("pii", screen_text_for_pii, text)
+
+    async def extract_metadata(self, text: str) -> Dict[str, str]:
+        return await self._complete("metadata", extract_metadata_from_document, text)
+
+    async def _complete(self, step: str, function: Callable[[str], Any], text: str) -> Any:
+        key = (step, hashlib.sha256(text.encode("utf-8")).hexdigest())
+        future = self.cache.get(key)
+        if future is not None:
+            self.cache.move_to_end(key)
+        else:
+            future = asyncio.ensure_future(self._run(function, text))
+            self.cache[key] = future
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        try:
+            # Shielded, so that a caller being cancelled doesn't cancel the completion shared with others
+            return await asyncio.shield(future)
+        except Exception:
+            # Failures are not cached, the next document with the same text tries again
+            if self.cache.get(key) is future:
+                del self.cache[key]
+            raise
+
+    async def _run(self, function: Callable[[str], Any], text: str) -> Any:
+        async with self.slots:
+            await self.rate_limiter.acquire()
+            return await asyncio.to_thread(function, text)
@@ -1,8 +1,11 @@
 from models.models import Source
 from services.openai import get_chat_completion
 import json
+import logging
 from typing import Dict
 
+logger = logging.getLogger(__name__)
+
 def extract_metadata_from_document(text: str) -> Dict[str, str]:
     sources = Source.__members__.keys()
     sources_string = ", ".join(sources)
@@ -27,7 +30,7 @@ def extract_metadata_from_document(text: str) -> Dict[str, str]:
         messages, "gpt-4"
     )  # TODO: change to your preferred model name
 
-    print(f"completion: {completion}")
+    logger.debug("completion: %s", completion)
 
     try:
         metadata = json.loads(completion)
@@ -1,7 +1,10 @@
 from services.openai import get_chat_completion
 import json
+import logging
 from typing import Dict, List
 
+logger = logging.getLogger(__name__)
+
 def extract_topic_id(text: str, topic_names: List[str], topic_ids: List[str]) -> str:
     messages = [
         {
@@ -55,7 +58,7 @@ def extract_questions_from_text(text: str, question_count: int = 3) -> List[str]
         messages, "gpt-4"
     )  # TODO: change to your preferred model name
 
-    print(f"completion: {completion}")
+    logger.debug("completion: %s", completion)
 
     try:
         questions = [q.lstrip('0123456789.-) ').replace("Question: ", "", 1) for q in completion.splitlines()]
@@ -1,6 +1,12 @@
+import asyncio
+import codecs
+import logging
+import multiprocessing
 import os
-from io import BufferedReader
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from io import BufferedReader, BytesIO, IOBase, StringIO, TextIOWrapper
+from typing import Iterator, List, Optional, Tuple, Union
+from uuid import uuid4
 from fastapi import UploadFile
 import mimetypes
 from PyPDF2 import PdfReader
@@ -9,6 +15,31 @@ import csv
 import pptx
 
 from models.models import Document, DocumentMetadata
+from services.metrics import CACHE_REQUESTS
+from services.text_cache import TextCache, file_digest
+
+# Constants
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # The number of bytes read from an upload at a time
+TEXT_BLOCK_SIZE = 1024 * 1024  # The approximate number of characters yielded at a time by the text generators
+PAGE_BREAK = "\f"  # Separates the pages of extracted PDF text, so that chunks can cite their page numbers
+# The file types decoded incrementally, whose text can be chunked as it is extracted
+INCREMENTAL_MIMETYPES = {"text/plain", "text/markdown", "text/csv"}
+PAGED_MIMETYPES = {"application/pdf"}  # The file types extracted page by page, whose chunks cite their pages
+# The number of processes extracting the pages of a PDF, 1 extracts them in the calling process
+PDF_EXTRACTION_WORKERS = int(os.environ.get("PDF_EXTRACTION_WORKERS", os.cpu_count() or 1))
+# PDFs with fewer pages are extracted in the calling process, as starting the workers would cost more
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 32))
+# The PDF workers are started from a single-threaded server process rather than forked from the calling
+# process, whose other threads may hold locks that a forked child would inherit held
+PDF_WORKER_CONTEXT = multiprocessing.get_context("forkserver" if os.name == "posix" else "spawn")
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", 8))  # The number of pages a worker extracts at a time
+
+logger = logging.getLogger(__name__)
+
+# Extracted texts on local disk, by sha256 of the file bytes
+text_cache = TextCache()
+# The PDF opened by each extraction worker process
+_pdf_worker_reader: Optional[PdfReader] = None
 
 
 async def get_document_from_file(
@@ -16,13 +47,15 @@ async def get_document_from_file(
 ) -> Document:
     extracted_text = await extract_text_from_form_file(file)
 
-    doc = Document(text=extracted_text, metadata=metadata)
+    doc = Document(
+        text=extracted_text, metadata=metadata, mimetype=get_mimetype(file.filename or "", file.content_type)
+    )
 
     return doc
 
 
-def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> str:
-    """Return the text content of a file given its filepath."""
+def get_mimetype(filepath: str, mimetype: Optional[str] = None) -> str:
+    """Return the given mimetype, or guess it from the file extension."""
 
     if mimetype is None:
         # Get the mimetype of the file based on its extension
@@ -34,24 +67,175 @@ def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) ->
         else:
             raise Exception("Unsupported file type")
 
+    return mimetype
+
+
+def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> str:
+    """Return the text content of a file given its filepath."""
+
     try:
-        with open(filepath, "rb") as file:
-            extracted_text = extract_text_from_file(file, mimetype)
-    except Exception as e:
-        print(f"Error: {e}")
-        raise e
+        extracted_text = "".join(iter_text_from_filepath(filepath, mimetype))
+    except Exception:
+        logger.exception("Error extracting the text of %s", filepath)
+        raise
 
     return extracted_text
 
 
+def iter_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> Iterator[str]:
+    """Yield the text content of a file given its filepath, in blocks."""
+
+    mimetype = get_mimetype(filepath, mimetype)
+    with open(filepath, "rb") as file:
+        yield from iter_cached_text(file, mimetype)
+
+
+def iter_cached_text(file: BufferedReader, mimetype: str) -> Iterator[str]:
+    """
+    Yield the text content of a file in blocks like iter_text_from_file, but from the extracted text cache
+    when a file with the same bytes was extracted before, and cache it otherwise.
+    """
+    if not text_cache.enabled:
+        yield from iter_text_from_file(file, mimetype)
+        return
+
+    digest = file_digest(file)
+    cached = text_cache.get(digest, mimetype)
+    CACHE_REQUESTS.inc(cache="extracted_text", result="miss" if cached is None else "hit")
+    if cached is not None:
+        yield from cached
+    else:
+        yield from text_cache.put(digest, mimetype, iter_text_from_file(file, mimetype))
+
+
+def iter_text_from_file(file: BufferedReader, mimetype: str) -> Iterator[str]:
+    """
+    Yield the text content of a file in blocks of about TEXT_BLOCK_SIZE characters.
+
+    Plain text, markdown and csv files are decoded incrementally, so that only one block is held in memory
+    at a time. Presentations and PDFs are parsed whole, but their text is yielded by slides and pages.
+    Other formats are yielded in one block.
+    """
+    if mimetype == "text/plain" or mimetype == "text/markdown":
+        # The incremental decoder keeps multi-byte characters split between two blocks intact
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while block := file.read(TEXT_BLOCK_SIZE):
+            yield decoder.decode(block)
+        yield decoder.decode(b"", final=True)
+    elif mimetype == "text/csv":
+        yield from _iter_csv_text(file)
+    elif (
+        mimetype
+        == "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+    ):
+        yield from _iter_pptx_text(file)
+    elif mimetype == "application/pdf":
+        # One block per page, the pages after the first one start with a page break
+        for i, page_text in enumerate(iter_pdf_pages(file)):
+            yield page_text if i == 0 else PAGE_BREAK + page_text
+    else:
+        yield extract_text_from_file(file, mimetype)
+
+
+def _iter_csv_text(file: BufferedReader) -> Iterator[str]:
+    # Extract text from csv using csv module, one line per row
+    if isinstance(file, IOBase):
+        # Decode in large blocks in C, instead of decoding every line in Python
+        text_file = TextIOWrapper(file, encoding="utf-8", newline="")
+    else:
+        # e.g. the SpooledTemporaryFile of an upload before Python 3.11, which TextIOWrapper can't wrap
+        text_file = codecs.iterdecode(file, "utf-8")
+    try:
+        buffer = StringIO()
+        for row in csv.reader(text_file):
+            buffer.write(" ".join(row))
+            buffer.write("\n")
+            if buffer.tell() >= TEXT_BLOCK_SIZE:
+                yield buffer.getvalue()
+                buffer = StringIO()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        if isinstance(text_file, TextIOWrapper):
+            # Detach so that the wrapper doesn't close the file when it is collected
+            text_file.detach()
+
+
+def _iter_pptx_text(file: BufferedReader) -> Iterator[str]:
+    # Extract text from pptx using python-pptx, one line per shape, yielded every TEXT_BLOCK_SIZE characters
+    presentation = pptx.Presentation(file)
+    parts: List[str] = []
+    size = 0
+    for slide in presentation.slides:
+        for shape in slide.shapes:
+            if shape.has_text_frame:
+                for paragraph in shape.text_frame.paragraphs:
+                    for run in paragraph.runs:
+                        parts.append(run.text + " ")
+                        size += len(run.text) + 1
+                parts.append("\n")
+                size += 1
+        if size >= TEXT_BLOCK_SIZE:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield "".join(parts)
+
+
+def iter_pdf_pages(file: BufferedReader) -> Iterator[str]:
+    """
+    Yield the text of each page of a PDF, in order.
+
+    Large PDFs are split into ranges of PDF_PAGES_PER_TASK pages extracted by a pool of
+    PDF_EXTRACTION_WORKERS processes, and pages are yielded as soon as their range is extracted.
+    """
+    reader = PdfReader(file)
+    num_pages = len(reader.pages)
+    if PDF_EXTRACTION_WORKERS <= 1 or num_pages < PDF_PARALLEL_MIN_PAGES:
+        for page in reader.pages:
+            yield page.extract_text()
+    else:
+        # Workers open the file themselves, from its path if it has one, to avoid copying its bytes
+        name = getattr(file, "name", None)
+        if isinstance(name, str) and os.path.isfile(name):
+            source: Union[str, bytes] = name
+        else:
+            file.seek(0)
+            source = file.read()
+        page_ranges = [
+            (start, min(start + PDF_PAGES_PER_TASK, num_pages))
+            for start in range(0, num_pages, PDF_PAGES_PER_TASK)
+        ]
+        with ProcessPoolExecutor(
+            max_workers=min(PDF_EXTRACTION_WORKERS, len(page_ranges)),
+            initializer=_init_pdf_worker,
+            initargs=(source,),
+            mp_context=PDF_WORKER_CONTEXT,
+        ) as executor:
+            # map yields the ranges in order, each one as soon as it and the ones before it are done
+            for page_texts in executor.map(_extract_pdf_pages, page_ranges):
+                yield from page_texts
+
+
+def _init_pdf_worker(source: Union[str, bytes]):
+    # Each worker parses the document once, and then extracts all the page ranges it is given
+    global _pdf_worker_reader
+    _pdf_worker_reader = PdfReader(source if isinstance(source, str) else BytesIO(source))
+
+
+def _extract_pdf_pages(page_range: Tuple[int, int]) -> List[str]:
+    assert _pdf_worker_reader is not None
+    return [_pdf_worker_reader.pages[i].extract_text() for i in range(*page_range)]
+
+
 def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
     if mimetype == "application/pdf":
-        # Extract text from pdf using PyPDF2
-        reader = PdfReader(file)
-        extracted_text = " ".join([page.extract_text() for page in reader.pages])
+        # Extract text from pdf using PyPDF2, with a page break between pages
+        extracted_text = PAGE_BREAK.join(iter_pdf_pages(file))
     elif mimetype == "text/plain" or mimetype == "text/markdown":
         # Read text from plain text file
-        extracted_text = file.read().decode("utf-8")
+        extracted_text = "".join(iter_text_from_file(file, mimetype))
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
@@ -60,25 +244,13 @@ def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
         extracted_text = docx2txt.process(file)
     elif mimetype == "text/csv":
         # Extract text from csv using csv module
-        extracted_text = ""
-        decoded_buffer = (line.decode("utf-8") for line in file)
-        reader = csv.reader(decoded_buffer)
-        for row in reader:
-            extracted_text += " ".join(row) + "\n"
+        extracted_text = "".join(_iter_csv_text(file))
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.presentationml.presentation"
     ):
         # Extract text from pptx using python-pptx
-        extracted_text = ""
-        presentation = pptx.Presentation(file)
-        for slide in presentation.slides:
-            for shape in slide.shapes:
-                if shape.has_text_frame:
-                    for paragraph in shape.text_frame.paragraphs:
-                        for run in paragraph.runs:
-                            extracted_text += run.text + " "
-                    extracted_text += "\n"
+        extracted_text = "".join(_iter_pptx_text(file))
     else:
         # Unsupported file type
         raise ValueError("Unsupported file type: {}".format(mimetype))
@@ -86,31 +258,44 @@ def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
     return extracted_text
 
 
-# Extract text from a file based on its mimetype
-async def extract_text_from_form_file(file: UploadFile):
-    """Return the text content of a file."""
-    # get the file body from the upload file object
-    mimetype = file.content_type
-    print(f"mimetype: {mimetype}")
-    print(f"file.file: {file.file}")
-    print("file: ", file)
+async def save_form_file(file: UploadFile, directory: str) -> str:
+    """
+    Stream an uploaded file to a uniquely named file in a directory.
 
-    file_stream = await file.read()
+    Args:
+        file: The uploaded file.
+        directory: The directory to save the file in, created if needed.
 
-    temp_file_path = "/tmp/temp_file"
+    Returns:
+        The path of the saved file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    _, extension = os.path.splitext(file.filename or "")
+    file_path = os.path.join(directory, f"{uuid4().hex}{extension}")
 
-    # write the file to a temporary location
-    with open(temp_file_path, "wb") as f:
-        f.write(file_stream)
+    with open(file_path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
+
+    return file_path
+
+
+# Extract text from a file based on its mimetype
+async def extract_text_from_form_file(file: UploadFile):
+    """Return the text content of a file."""
+    mimetype = get_mimetype(file.filename or "", file.content_type)
+    logger.debug("mimetype: %s", mimetype)
 
+    # The upload is already spooled to a temporary file of its own in fixed-size chunks, so it is read
+    # in place instead of being loaded in memory and copied to a shared path
+    await file.seek(0)
     try:
-        extracted_text = extract_text_from_filepath(temp_file_path, mimetype)
-    except Exception as e:
-        print(f"Error: {e}")
-        os.remove(temp_file_path)
-        raise e
-
-    # remove file from temp location
-    os.remove(temp_file_path)
+        # Parsing is CPU bound, keep it off the event loop
+        extracted_text = await asyncio.to_thread(
+            lambda: "".join(iter_cached_text(file.file, mimetype))  # type: ignore
+        )
+    except Exception:
+        logger.exception("Error extracting the text of %s", file.filename)
+        raise
 
     return extracted_text
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+from datastore.datastore import DataStore
+from models.models import Document
+from services.dynamodb import delete_document_questions
+from services.text_cache import file_digest
+
+# Item statuses
+PENDING = "pending"
+DONE = "done"
+SKIPPED = "skipped"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    document_id TEXT,
+    batch_id TEXT,
+    reason TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS batches (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    num_items INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS items_batch_id ON items (batch_id);
+"""
+
+
+def get_dump_id(filepath: str) -> str:
+    """
+    Return the sha256 of the bytes of a dump, which the ids of its documents are derived from, so that
+    two dumps with the same name don't share ids.
+    """
+    with open(filepath, "rb") as f:
+        return file_digest(f)
+
+
+def stable_document_id(dump_id: str, item_key: str) -> str:
+    """
+    Return the id of a document without one, derived from its dump and its place in it, so that it is the
+    same every time the dump is imported.
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"{dump_id}#{item_key}"))
+
+
+def get_batch_id(document_ids: List[str]) -> str:
+    """Return an id derived from the documents of a batch, the same for every attempt at the batch."""
+    return hashlib.sha256("\n".join(document_ids).encode("utf-8")).hexdigest()
+
+
+class ImportJournal:
+    """
+    A checkpoint journal of a bulk import in a SQLite database, recording the items of the dump that were
+    upserted or skipped, and the batches they were upserted in.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        Args:
+            path: The path of the journal database, created if needed.
+            resume: Whether to keep the progress of a previous import, or start over.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        if not resume:
+            self.conn.executescript("DELETE FROM items; DELETE FROM batches;")
+
+    def is_finished(self, key: str) -> bool:
+        """Check whether an item was upserted or skipped by a previous run."""
+        row = self.conn.execute("SELECT status FROM items WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] in (DONE, SKIPPED)
+
+    def skip(self, key: str, reason: str):
+        """Record an item that doesn't need to be processed again, e.g. because it contains PII."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO items (key, status, reason, updated_at) VALUES (?, ?, ?, ?)",
+            (key, SKIPPED, reason, time.time()),
+        )
+
+    def start_batch(self, batch_id: str, items: List[Tuple[str, str]]):
+        """
+        Record a batch of (key, document_id) items before it is upserted.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute(
+                "INSERT INTO batches (id, status, num_items, started_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET status = excluded.status, attempts = attempts + 1, "
+                "started_at = excluded.started_at, finished_at = NULL",
+                (batch_id, PENDING, len(items), now),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO items (key, status, document_id, batch_id, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(key, PENDING, document_id, batch_id, now) for key, document_id in items],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def finish_batch(self, batch_id: str):
+        """Record that all the items of a batch were upserted."""
+        now = time.time()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute(
+                "UPDATE batches SET status = ?, finished_at = ? WHERE id = ?", (DONE, now, batch_id)
+            )
+            self.conn.execute(
+                "UPDATE items SET status = ?, updated_at = ? WHERE batch_id = ? AND status = ?",
+                (DONE, now, batch_id, PENDING),
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def unfinished_batches(self) -> List[Tuple[str, List[str]]]:
+        """Return the (batch_id, document_ids) of the batches that were started but not finished."""
+        batches = []
+        for (batch_id,) in self.conn.execute(
+            "SELECT id FROM batches WHERE status = ?", (PENDING,)
+        ).fetchall():
+            document_ids = [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT document_id FROM items WHERE batch_id = ? AND status = ?", (batch_id, PENDING)
+                )
+            ]
+            batches.append((batch_id, document_ids))
+        return batches
+
+    def abandon_batch(self, batch_id: str):
+        """Forget a batch whose documents were rolled back, so that they are batched again."""
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("DELETE FROM items WHERE batch_id = ? AND status = ?", (batch_id, PENDING))
+            self.conn.execute("DELETE FROM batches WHERE id = ?", (batch_id,))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def counts(self) -> dict:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+
+
+async def roll_back_unfinished_batches(datastore: DataStore, journal: ImportJournal, chain: str = ""):
+    """
+    Remove what an interrupted run upserted from the batches it didn't finish, before they are retried.
+
+    A batch may have been interrupted after some of its vectors or questions were saved, and the retry would
+    dedup its questions against those. Deleting the vectors and questions of its documents from the chain
+    makes the retry start from a clean slate.
+    """
+    for batch_id, document_ids in journal.unfinished_batches():
+        print(f"Rolling back unfinished batch {batch_id} of {len(document_ids)} documents")
+        if document_ids:
+            await datastore.delete(ids=document_ids, chain=chain)
+            await asyncio.to_thread(delete_document_questions, chain, document_ids)
+        journal.abandon_batch(batch_id)
+
+
+async def upsert_journaled_batch(
+    datastore: DataStore, journal: ImportJournal, items: List[Tuple[str, Document]], chain: str = ""
+) -> List[str]:
+    """
+    Upsert a batch of (key, document) items, recording it in the journal before and after.
+
+    Documents must have ids, so that an interrupted batch can be rolled back and retried with the same
+    batch id and chunk ids. They are processed whole, the ids are not those of synced sources.
+    """
+    document_ids = [document.id for _, document in items]
+    if any(document_id is None for document_id in document_ids):
+        raise ValueError("Journaled documents need an id")
+    batch_id = get_batch_id(document_ids)  # type: ignore
+    journal.start_batch(batch_id, [(key, document.id) for key, document in items])  # type: ignore
+    ids = await datastore.upsert([document for _, document in items], chain=chain, sync_sources=False)
+    journal.finish_batch(batch_id)
+    return ids
+
+
+async def upsert_batch(
+    datastore: DataStore, items: List[Tuple[str, Document]], journal: Optional[ImportJournal], chain: str = ""
+) -> List[str]:
+    """
+    Upsert a batch of (key, document) items of a dump, through the journal if the import has one.
+    """
+    print(f"Upserting batch of {len(items)} documents")
+    if journal is not None:
+        return await upsert_journaled_batch(datastore, journal, items, chain=chain)
+    return await datastore.upsert([document for _, document in items], chain=chain)
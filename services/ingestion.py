@@ -0,0 +1,240 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+# Constants
+INGESTION_DB_PATH = os.environ.get("INGESTION_DB_PATH", "/tmp/ingestion/jobs.sqlite")
+INGESTION_SPOOL_DIR = os.environ.get("INGESTION_SPOOL_DIR", "/tmp/ingestion/uploads")
+# A running job whose worker hasn't sent a heartbeat for this many seconds is picked up again
+INGESTION_STALE_AFTER = float(os.environ.get("INGESTION_STALE_AFTER", 900))
+# How often the worker of a running job sends a heartbeat, in seconds, well within INGESTION_STALE_AFTER
+INGESTION_HEARTBEAT_INTERVAL = float(os.environ.get("INGESTION_HEARTBEAT_INTERVAL", INGESTION_STALE_AFTER / 3))
+# The number of times a job is started before it is marked as failed
+INGESTION_MAX_ATTEMPTS = int(os.environ.get("INGESTION_MAX_ATTEMPTS", 3))
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Called with the stage name ("extracting", "chunking", "embedding", "deduplicating" or "upserting"),
+# the number of items done and the total number of items in the stage
+ProgressCallback = Callable[[str, int, int], None]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    chain TEXT NOT NULL DEFAULT '',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    stage TEXT,
+    stage_done INTEGER NOT NULL DEFAULT 0,
+    stage_total INTEGER NOT NULL DEFAULT 0,
+    stage_started_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """
+    A durable job queue in a SQLite database, shared by the API and the ingestion worker processes.
+    """
+
+    def __init__(self, db_path: str = INGESTION_DB_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # Autocommit mode, transactions are opened explicitly where needed
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets the API read job statuses while a worker writes progress
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if "chain" not in columns:
+            # Queues created before jobs were claimed one chain at a time
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN chain TEXT NOT NULL DEFAULT ''")
+            self.conn.execute("UPDATE jobs SET chain = COALESCE(json_extract(payload, '$.chain'), '')")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_chain_status ON jobs (chain, status)")
+
+    def enqueue(self, payload: Dict[str, Any]) -> str:
+        """
+        Add a job to the queue.
+
+        Args:
+            payload: The JSON serializable job arguments.
+
+        Returns:
+            The job id.
+        """
+        job_id = uuid.uuid4().hex
+        self.conn.execute(
+            "INSERT INTO jobs (id, status, payload, chain, created_at) VALUES (?, ?, ?, ?, ?)",
+            (job_id, QUEUED, json.dumps(payload), payload.get("chain") or "", time.time()),
+        )
+        return job_id
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Take the oldest queued job, or a running job whose worker went away, and mark it as running.
+
+        Jobs of a chain that already has a running job are left for later, as the question deduplication
+        and the source cursors of a chain are read and written without locks shared between the workers.
+
+        Returns:
+            The claimed job, or None if there is nothing to do.
+        """
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, so that two workers never claim the same job
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE (status = ? OR (status = ? AND heartbeat_at < ?)) "
+                "AND chain NOT IN (SELECT chain FROM jobs WHERE status = ? AND heartbeat_at >= ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now - INGESTION_STALE_AFTER, RUNNING, now - INGESTION_STALE_AFTER),
+            ).fetchone()
+            if row is None:
+                self.conn.execute("COMMIT")
+                return None
+
+            if row["attempts"] >= INGESTION_MAX_ATTEMPTS:
+                self.conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                    (FAILED, now, f"Gave up after {row['attempts']} attempts", row["id"]),
+                )
+                self.conn.execute("COMMIT")
+                # No worker will run the job again, so nothing else removes its uploads
+                remove_uploads(json.loads(row["payload"]))
+                return self.claim()
+
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?, heartbeat_at = ?, "
+                "stage = NULL, stage_done = 0, stage_total = 0, stage_started_at = NULL WHERE id = ?",
+                (RUNNING, now, now, row["id"]),
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return {"id": row["id"], "payload": json.loads(row["payload"])}
+
+    def heartbeat(self, job_id: str):
+        """
+        Record that the worker of a running job is still alive, so that the job isn't claimed again.
+        """
+        self.conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def progress(self, job_id: str, stage: str, done: int, total: int):
+        """
+        Record the progress of a running job, which also serves as its heartbeat.
+        """
+        now = time.time()
+        # The stage clock restarts whenever the job moves on to another stage
+        self.conn.execute(
+            "UPDATE jobs SET stage_started_at = CASE WHEN stage IS ? THEN stage_started_at ELSE ? END, "
+            "stage = ?, stage_done = ?, stage_total = ?, heartbeat_at = ? WHERE id = ?",
+            (stage, now, stage, done, total, now, job_id),
+        )
+
+    def progress_callback(self, job_id: str) -> ProgressCallback:
+        """
+        Bind the progress of a job to a callback for the ingestion pipeline.
+        """
+        return lambda stage, done, total: self.progress(job_id, stage, done, total)
+
+    def requeue(self, job_id: str):
+        """
+        Put a job that was interrupted back at its place in the queue.
+        """
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, stage = NULL, stage_done = 0, stage_total = 0, "
+            "stage_started_at = NULL WHERE id = ?",
+            (QUEUED, job_id),
+        )
+
+    def succeed(self, job_id: str, result: Any):
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, result = ? WHERE id = ?",
+            (SUCCEEDED, time.time(), json.dumps(result), job_id),
+        )
+
+    def fail(self, job_id: str, error: str):
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+            (FAILED, time.time(), error, job_id),
+        )
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of jobs by status."""
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the status of a job, with the throughput and the estimated remaining time of its current stage.
+
+        Returns:
+            The job status, or None if the job doesn't exist.
+        """
+        row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+
+        throughput: Optional[float] = None
+        eta_seconds: Optional[float] = None
+        queue_position: Optional[int] = None
+        if row["status"] == QUEUED:
+            queue_position = self.conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at < ?",
+                (QUEUED, row["created_at"]),
+            ).fetchone()[0]
+        elif row["status"] == RUNNING and row["stage_started_at"] is not None:
+            elapsed = time.time() - row["stage_started_at"]
+            if row["stage_done"] > 0 and elapsed > 0:
+                throughput = row["stage_done"] / elapsed
+                eta_seconds = max(row["stage_total"] - row["stage_done"], 0) / throughput
+
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "queue_position": queue_position,
+            "stage": row["stage"],
+            "stage_done": row["stage_done"],
+            "stage_total": row["stage_total"],
+            "throughput": throughput,
+            "eta_seconds": eta_seconds,
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+        }
+
+
+def upload_paths(payload: Dict[str, Any]) -> List[str]:
+    """Return the uploads of a job, one for a single file or a tail, or one per file of a batch."""
+    if "files" in payload:
+        return [file["file_path"] for file in payload["files"]]
+    if "file_path" in payload:
+        return [payload["file_path"]]
+    return []
+
+
+def remove_uploads(payload: Dict[str, Any]):
+    """Remove the uploads of a job that is done, whether it succeeded or not."""
+    for file_path in upload_paths(payload):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+# Constants
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")  # The level of all loggers without a level of their own
+# Levels of given loggers and their children, e.g. "services.chunks=DEBUG,datastore.providers=WARNING"
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json, one object per line, or text for reading in a terminal
+# The fraction of debug lines that are kept, the loops of the pipeline log one per chunk and per question
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1.0))
+
+# The id of the request or ingestion job being handled, copied to the threads it starts by asyncio.to_thread
+correlation_id: ContextVar[Optional[str]] = ContextVar("correlation_id", default=None)
+
+# The attributes every log record has, anything else was passed in extra and is logged as a field
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "correlation_id"}
+
+
+class ContextFilter(logging.Filter):
+    """Tags records with the correlation id of their context, and samples debug records."""
+
+    def __init__(self, debug_sample_rate: float = LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno <= logging.DEBUG and random.random() >= self.debug_sample_rate:
+            return False
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects, with the fields passed in extra next to the message."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+            + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None) is not None:
+            entry["correlation_id"] = record.correlation_id  # type: ignore
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """Parse logger levels given as comma separated logger=LEVEL pairs."""
+    parsed = {}
+    for pair in levels.split(","):
+        if pair.strip():
+            name, level = pair.split("=")
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging():
+    """
+    Send the logs of the process to stderr, as JSON lines unless LOG_FORMAT is text, at the configured levels.
+    Replaces the handlers of the root logger, so that calling it again is harmless.
+    """
+    handler = logging.StreamHandler(sys.stderr)
+    handler.addFilter(ContextFilter())
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(correlation_id)s] %(message)s")
+        )
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
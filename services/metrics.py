@@ -0,0 +1,231 @@
+import asyncio
+import functools
+from bisect import bisect_left
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Constants
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  # The Prometheus text exposition format
+# Upper bounds of the latency buckets in seconds, from cache hits to large uploads and slow completions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    """
+    A metric of the process, with a value per combination of label values, rendered in the Prometheus text
+    format. Metrics are updated from the event loop and from worker threads, so updates hold a lock.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} has labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: LabelValues, extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values, the count of each bucket (not cumulative, the last one is +Inf), and the sum
+        self.counts: Dict[LabelValues, List[int]] = {}
+        self.sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[index] += 1
+            self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe the duration of the block, whether it raises or not."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {self.sums[key]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        return "".join(line + "\n" for metric in self.metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+# Metrics of the API, the ingestion pipeline and the services they call
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Latency of the API requests", ["method", "route", "status"]
+)
+STAGE_DURATION = Histogram(
+    "stage_duration_seconds",
+    "Time spent in a stage of the ingestion and ask pipelines: embedding, completion, vector_query, "
+    "vector_upsert, chunking (which includes the embedding of the chunks) or deduplicating",
+    ["stage"],
+)
+DYNAMODB_DURATION = Histogram(
+    "dynamodb_call_duration_seconds", "Latency of the DynamoDB calls", ["operation"]
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total", "Tokens consumed by the OpenAI calls, by kind: prompt or completion", ["model", "kind"]
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Cache lookups, by cache and result: hit or miss", ["cache", "result"]
+)
+RETRIES = Counter("retries_total", "Calls retried after a failure, by operation", ["operation"])
+INGESTION_JOBS = Gauge("ingestion_jobs", "Ingestion jobs in the queue, by status", ["status"])
+ASK_SESSIONS = Gauge("ask_sessions", "Conversations of /gpt/ask kept in memory")
+DATASTORE_STATS = Gauge(
+    "datastore_stat", "Statistics reported by the datastore provider, e.g. Milvus partition loads", ["stat"]
+)
+
+
+def timed(histogram: Histogram, **labels: str) -> Callable:
+    """Decorate a function or a coroutine function to observe its duration in the histogram."""
+
+    def decorator(function: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_retry(operation: str) -> Callable:
+    """Return a tenacity before_sleep callback counting the retries of an operation."""
+    return lambda retry_state: RETRIES.inc(operation=operation)
+
+
+def count_tokens(model: str, usage: dict):
+    """Count the tokens of the usage of an OpenAI response."""
+    for kind in ("prompt", "completion"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            OPENAI_TOKENS.inc(tokens, model=model, kind=kind)
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serve the metrics of a process without an API, e.g. an ingestion worker, from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,12 +1,29 @@
+import logging
 import os
 from typing import List, Dict, Any, Tuple
 import openai
 
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from services.metrics import STAGE_DURATION, count_retry, count_tokens
+from services.tracing import span
+
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
-@retry(wait=wait_random_exponential(min=20, max=60), stop=stop_after_attempt(30))
+logger = logging.getLogger(__name__)
+
+
+def set_token_attributes(current, usage: Dict[str, int]):
+    """Set the token counts of the usage of an OpenAI response as attributes of a span."""
+    current.set_attribute("tokens.prompt", usage.get("prompt_tokens", 0))
+    current.set_attribute("tokens.completion", usage.get("completion_tokens", 0))
+
+
+@retry(
+    wait=wait_random_exponential(min=20, max=60),
+    stop=stop_after_attempt(30),
+    before_sleep=count_retry("embedding"),
+)
 def get_embeddings(texts: List[str]) -> List[List[float]]:
     """
     Embed texts using OpenAI's ada model.
@@ -24,7 +41,11 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
         return []
     
     # Call the OpenAI API to get the embeddings
-    response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+    with span("openai.get_embeddings", model="text-embedding-ada-002", batch_size=len(texts)) as current, \
+            STAGE_DURATION.time(stage="embedding"):
+        response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+        current.set_attribute("tokens.prompt", response["usage"]["prompt_tokens"])  # type: ignore
+    count_tokens("text-embedding-ada-002", response["usage"])  # type: ignore
 
     # Extract the embedding data from the response
     data = response["data"]  # type: ignore
@@ -33,7 +54,11 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
     return [result["embedding"] for result in data]
 
 
-@retry(wait=wait_random_exponential(min=20, max=60), stop=stop_after_attempt(30))
+@retry(
+    wait=wait_random_exponential(min=20, max=60),
+    stop=stop_after_attempt(30),
+    before_sleep=count_retry("completion"),
+)
 def get_chat_completion(
     messages,
     model="gpt-4",  # use "gpt-4" for better results
@@ -52,14 +77,18 @@ def get_chat_completion(
         Exception: If the OpenAI API call fails.
     """
     # call the OpenAI chat completion API with the given messages
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=messages,
-    )
+    with span("openai.get_chat_completion", model=model, messages=len(messages)) as current, \
+            STAGE_DURATION.time(stage="completion"):
+        response = openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+        )
+        set_token_attributes(current, response["usage"])  # type: ignore
+    count_tokens(model, response["usage"])  # type: ignore
 
     choices = response["choices"]  # type: ignore
     completion = choices[0].message.content.strip()
-    print(f"Completion: {completion}")
+    logger.debug("Completion: %s", completion)
     return completion
 
 
@@ -84,12 +113,16 @@ def ask_with_chunks(question: str, chunks: List[str], prev_messages: List[Any] =
             By considering above input, answer the question without copying any text or infringing copyright: {question}
         """
     messages.append({"role": "user", "content": prompt})
-    response = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
-        max_tokens=2000,
-        temperature=0.7,  # High temperature leads to a more creative response.
-    )
+    with span("openai.ask_with_chunks", model="gpt-4", chunks=len(chunks), messages=len(messages)) as current, \
+            STAGE_DURATION.time(stage="completion"):
+        response = openai.ChatCompletion.create(
+            model="gpt-4",
+            messages=messages,
+            max_tokens=2000,
+            temperature=0.7,  # High temperature leads to a more creative response.
+        )
+        set_token_attributes(current, response["usage"])
+    count_tokens("gpt-4", response["usage"])
     answer = response["choices"][0]["message"]["content"]
     messages.append({"role": "assistant", "content": answer})
     return (answer, messages)
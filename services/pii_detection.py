@@ -1,7 +1,112 @@
+import os
+import re
+from typing import Iterator, Optional
+
 from services.openai import get_chat_completion
 
+# Constants
+# Whether to screen texts with the local detectors first, and only ask the language model about ambiguous ones
+PII_PRESCREEN = os.environ.get("PII_PRESCREEN", "true").lower() == "true"
+
+# Email local-parts that name a role or a mailbox rather than a person
+ROLE_EMAIL_LOCAL_PARTS = set(
+    "admin billing careers contact feedback hello help hr info jobs marketing news newsletter no-reply noreply "
+    "office postmaster press privacy sales security support team webmaster".split()
+)
+
+# Words that make a text worth a closer look, e.g. notes about candidates, matched in lowercase text
+PII_KEYWORDS = (
+    "candidate|interview|hiring|applicant|offer letter|reference check|salary|social security|date of birth"
+    "|passport|home address|p.o. box|po box"
+).split("|")
+
+STREET_SUFFIXES = (
+    "Street|St|Avenue|Ave|Road|Rd|Boulevard|Blvd|Lane|Ln|Drive|Dr|Court|Ct|Place|Pl|Way|Terrace|Ter"
+    "|Parkway|Pkwy|Square|Sq|Highway|Hwy|Circle|Cir|Plaza"
+)
+
+# The detectors are only run around anchors that every match contains, and that are found much faster
+# than the detectors themselves, so a text is scanned at a few tens of MiB/s whatever its size
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[A-Za-z]{2,}")
+PHONE_PATTERN = re.compile(
+    r"(?<![\w+])(?:\+?1[ .-]?)?(?:\(\d{3}\) ?|\d{3}[ .-])\d{3}[ .-]\d{4}(?!\w)"  # North American
+    r"|(?<![\w+])\+[2-9]\d{0,2}(?:[ .-]?\d{2,4}){3,5}(?!\w)"  # International, with a country code
+)
+STREET_SUFFIX_PATTERN = re.compile(rf"(?:{STREET_SUFFIXES})\b")
+# A house number, up to four capitalized words and a suffix
+STREET_ADDRESS_PATTERN = re.compile(
+    rf"\b\d{{1,6}}[A-Za-z]? (?:[A-Z][A-Za-z'-]*\.? ){{1,4}}(?:{STREET_SUFFIXES})\b"
+)
+ZIP_CODE_PATTERN = re.compile(r"\b[A-Z]{2} \d{5}\b")  # A state and a ZIP code
+# Digits are replaced by 0 in a skeleton of the text, in which number shapes are found with str.find
+DIGITS_TO_ZERO = str.maketrans("123456789", "000000000")
+PHONE_ANCHORS = ["000-0000", "000.0000", "000 0000", "+0"]
+ZIP_CODE_ANCHOR = " 00000"
+
+
+def _find_all(text: str, anchor: str) -> Iterator[int]:
+    position = text.find(anchor)
+    while position != -1:
+        yield position
+        position = text.find(anchor, position + 1)
+
+
+def _matches_around(
+    pattern: re.Pattern, text: str, anchor: int, before: int, after: int
+) -> Iterator[re.Match]:
+    # The matches of the pattern in a window of the text that contain the anchor
+    for match in pattern.finditer(text, max(anchor - before, 0), anchor + after):
+        if match.start() <= anchor < match.end():
+            yield match
+
+
+def prescreen_text_for_pii(text: str) -> Optional[bool]:
+    """
+    Screen a text for PII with local detectors, without calling the language model.
+
+    Only personal email addresses are reliable enough to skip a document on their own. Phone numbers and
+    street addresses are often part numbers, venues or office addresses, so they are left to the model.
+
+    Returns:
+        True if the text contains a personal email address, False if nothing in it looks like PII, or None
+        if it is ambiguous, e.g. it contains a phone number, a street address or a role email address, or it
+        mentions candidates, and needs to be screened by the language model.
+    """
+    ambiguous = False
+
+    for at in _find_all(text, "@"):
+        emails = list(_matches_around(EMAIL_PATTERN, text, at, 64, 256))
+        if emails and emails[0].group().split("@", 1)[0].lower() not in ROLE_EMAIL_LOCAL_PARTS:
+            return True
+        # A role email address, or a mention or a handle rather than an email address
+        ambiguous = True
+    if ambiguous:
+        return None
+
+    skeleton = text.translate(DIGITS_TO_ZERO)
+    for anchor in PHONE_ANCHORS:
+        for position in _find_all(skeleton, anchor):
+            if any(_matches_around(PHONE_PATTERN, text, position, 12, 24)):
+                return None
+
+    for suffix in STREET_SUFFIX_PATTERN.finditer(text):
+        if any(_matches_around(STREET_ADDRESS_PATTERN, text, suffix.start(), 80, len(suffix.group()) + 1)):
+            return None
+
+    for position in _find_all(skeleton, ZIP_CODE_ANCHOR):
+        if any(_matches_around(ZIP_CODE_PATTERN, text, position, 2, 7)):
+            return None
+    lowered = text.lower()
+    if any(keyword in lowered for keyword in PII_KEYWORDS):
+        return None
+    return False
+
 
 def screen_text_for_pii(text: str) -> bool:
+    """
+    Ask the language model whether a text contains PII. The bulk import scripts call it through
+    DocumentEnricher.screen_for_pii, which pre-screens the text locally first.
+    """
     # This prompt is just an example, change it to fit your use case
     messages = [
         {
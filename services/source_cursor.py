@@ -0,0 +1,86 @@
+import hashlib
+import os
+from typing import Optional
+
+from models.models import SourceCursor
+
+# Constants
+MIN_NEW_LINES_TO_PROCESS = 100  # Sources with fewer new lines are left for a later sync
+
+
+class SourceCursorMismatch(Exception):
+    """
+    Raised when a tail upload doesn't start where the processed part of its source ends,
+    in which case the whole source has to be uploaded again.
+    """
+
+    def __init__(self, cursor: SourceCursor):
+        super().__init__(
+            f"The source was processed up to byte {cursor.byte_offset} with checksum {cursor.checksum}"
+        )
+        self.cursor = cursor
+
+
+def checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def resume_offset(data: bytes, cursor: SourceCursor) -> int:
+    """
+    Return the byte offset of the UTF-8 text of a whole source where processing resumes.
+
+    Returns:
+        The offset of the cursor, or 0 to process the source again from the start if the already
+        processed bytes changed.
+    """
+    if cursor.byte_offset is None:
+        # Legacy cursors only know how many lines were processed, and resume after the last one
+        offset = 0
+        for _ in range(cursor.line):
+            offset = data.find(b"\n", offset) + 1
+            if offset == 0:
+                return 0
+        return offset
+
+    if cursor.byte_offset > len(data) or checksum(data[: cursor.byte_offset]) != cursor.checksum:
+        return 0
+    return cursor.byte_offset
+
+
+def complete_lines_end(data: bytes, start: int) -> int:
+    """Return the offset after the last newline from start, or start if there is none."""
+    return max(data.rfind(b"\n", start) + 1, start)
+
+
+def processed_end(data: bytes, start: int, appending: bool) -> int:
+    """
+    Return the offset the UTF-8 text of a whole source is processed up to. A source synced by appending
+    to it holds back its partial last line, which is picked up once it is complete, other sources are
+    processed to the end.
+    """
+    return complete_lines_end(data, start) if appending else len(data)
+
+
+def has_enough_new_content(text: str, resumed: bool) -> bool:
+    """
+    Check whether the new text of a source is worth processing. New and changed sources are processed
+    right away, but small appends to a source wait until they have MIN_NEW_LINES_TO_PROCESS lines.
+    """
+    return bool(text.strip()) and (not resumed or text.count("\n") >= MIN_NEW_LINES_TO_PROCESS)
+
+
+def ends_with_newline(file_path: str) -> bool:
+    """Check that a tail upload is empty or ends with a complete line."""
+    with open(file_path, "rb") as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def accepts_tail(cursor: SourceCursor, offset: int, prefix_checksum: Optional[str]) -> bool:
+    """Check that a tail upload starts where the processed part of its source ends."""
+    if cursor.byte_offset is None:
+        # Only a source that was never processed can be sent as a tail without a byte cursor
+        return cursor.line == 0 and offset == 0
+    return offset == cursor.byte_offset and (cursor.checksum is None or prefix_checksum == cursor.checksum)
@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import os
+import re
+import threading
+from typing import BinaryIO, Iterable, Iterator, Optional, TextIO
+from uuid import uuid4
+
+# Constants
+TEXT_CACHE_DIR = os.environ.get("TEXT_CACHE_DIR", "/tmp/text_cache")
+# The total size of the compressed texts kept on disk, the least recently used ones are evicted beyond it.
+# 0 disables the cache
+TEXT_CACHE_MAX_BYTES = int(os.environ.get("TEXT_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+TEXT_CACHE_COMPRESSION_LEVEL = int(os.environ.get("TEXT_CACHE_COMPRESSION_LEVEL", 6))
+# Evictions free this fraction of max_bytes beyond what is needed, so that they don't run on every put once
+# the cache is full
+TEXT_CACHE_EVICT_MARGIN = 0.1
+# The number of puts after which the size of the cache is read from disk again, to count the texts cached
+# by the other processes sharing the directory
+TEXT_CACHE_RESCAN_PUTS = 100
+HASH_BLOCK_SIZE = 1024 * 1024  # The number of bytes hashed at a time
+READ_BLOCK_SIZE = 1024 * 1024  # The number of characters yielded at a time from a cached text
+
+CACHE_SUFFIX = ".txt.gz"
+
+
+def file_digest(file: BinaryIO) -> str:
+    """Return the sha256 of the bytes of a file, hashed in fixed-size blocks, and rewind the file."""
+    file.seek(0)
+    sha256 = hashlib.sha256()
+    while block := file.read(HASH_BLOCK_SIZE):
+        sha256.update(block)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+class TextCache:
+    """
+    A content-addressed cache of extracted texts on local disk, shared by all the processes using the directory.
+
+    Texts are keyed by the sha256 of the file bytes and the mimetype they were extracted as, and stored
+    gzip compressed. The modification time of a cached text is its last use, and the least recently used
+    texts are evicted once their total size exceeds max_bytes. The total size is counted as texts are put,
+    and read from disk again by the evictions and every TEXT_CACHE_RESCAN_PUTS puts.
+    """
+
+    def __init__(self, directory: str = TEXT_CACHE_DIR, max_bytes: int = TEXT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # The total size of the cached texts, None until it is read from disk
+        self._size: Optional[int] = None
+        self._puts_since_scan = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, digest: str, mimetype: str) -> Optional[Iterator[str]]:
+        """
+        Look up the text extracted from a file.
+
+        Returns:
+            A generator of the blocks of the cached text, or None on a cache miss.
+        """
+        path = self._path(digest, mimetype)
+        try:
+            # Mark the text as recently used, and open it right away so that an eviction can't remove it
+            # before it is read
+            os.utime(path)
+            file = gzip.open(path, "rt", encoding="utf-8", newline="")
+        except FileNotFoundError:
+            return None
+        return self._read(file)
+
+    def put(self, digest: str, mimetype: str, blocks: Iterable[str]) -> Iterator[str]:
+        """
+        Pass through the blocks of text extracted from a file, and cache the text once all of them were read.
+
+        The text is compressed to a temporary file as it goes, so it is never held in memory as a whole.
+        Nothing is cached if the extraction fails or the generator is not exhausted.
+        """
+        path = self._path(digest, mimetype)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # newline="" keeps carriage returns, e.g. those of quoted csv fields, as they were extracted
+            with gzip.open(
+                tmp_path, "wt", encoding="utf-8", newline="", compresslevel=TEXT_CACHE_COMPRESSION_LEVEL
+            ) as f:
+                for block in blocks:
+                    f.write(block)
+                    yield block
+            try:
+                replaced_size = os.path.getsize(path)
+            except FileNotFoundError:
+                replaced_size = 0
+            size = os.path.getsize(tmp_path)
+            # Concurrent extractions of the same file both complete, and the last one wins
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._puts_since_scan += 1
+            if self._size is not None:
+                self._size += size - replaced_size
+            scan = (
+                self._size is None
+                or self._size > self.max_bytes
+                or self._puts_since_scan >= TEXT_CACHE_RESCAN_PUTS
+            )
+        if scan:
+            self.evict()
+
+    def evict(self):
+        """
+        Read the size of the cache from disk, and if it exceeds max_bytes, remove the least recently used texts
+        until it is TEXT_CACHE_EVICT_MARGIN below it.
+        """
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(CACHE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total > self.max_bytes:
+            target = self.max_bytes * (1 - TEXT_CACHE_EVICT_MARGIN)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        with self._lock:
+            self._size = total
+            self._puts_since_scan = 0
+
+    def _path(self, digest: str, mimetype: str) -> str:
+        # Texts are spread over subdirectories by the first byte of their digest
+        mimetype_slug = re.sub(r"[^a-zA-Z0-9]+", "_", mimetype)
+        return os.path.join(self.directory, digest[:2], f"{digest}.{mimetype_slug}{CACHE_SUFFIX}")
+
+    @staticmethod
+    def _read(file: TextIO) -> Iterator[str]:
+        with file:
+            while block := file.read(READ_BLOCK_SIZE):
+                yield block
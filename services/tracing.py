@@ -0,0 +1,123 @@
+import asyncio
+import functools
+import inspect
+import os
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Sequence
+
+# Constants
+# Where spans are exported: console (stdout), file (one JSON span per line), otlp, or empty to disable tracing.
+# The otlp exporter is configured with the standard OTEL_EXPORTER_OTLP_* environment variables
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "")
+TRACING_FILE = os.environ.get("TRACING_FILE", "/tmp/traces.jsonl")  # The spans file of the file exporter
+TRACING_SERVICE_NAME = os.environ.get("TRACING_SERVICE_NAME", "retrieval-plugin")
+
+# OpenTelemetry is an optional dependency, spans are no-ops without it
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+
+class NoopSpan:
+    """Stands in for a span when tracing is not installed, so that callers don't have to check."""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: dict):
+        pass
+
+    def update_name(self, name: str):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+def _configure_tracer():
+    if not TRACING_EXPORTER:
+        # Without an exporter, spans go to the tracer provider set by the host, if any, e.g. opentelemetry-instrument
+        return trace.get_tracer(__name__) if trace is not None else None
+    if trace is None:
+        raise ImportError(
+            f"TRACING_EXPORTER is {TRACING_EXPORTER} but OpenTelemetry is not installed, "
+            "install opentelemetry-sdk (and opentelemetry-exporter-otlp-proto-http for otlp)"
+        )
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if TRACING_EXPORTER == "console":
+        exporter = ConsoleSpanExporter()
+    elif TRACING_EXPORTER == "file":
+        # Spans are appended one per line, so that the file can be shared by the API and the ingestion workers
+        exporter = ConsoleSpanExporter(
+            out=open(TRACING_FILE, "a"), formatter=lambda finished: finished.to_json(indent=None) + "\n"
+        )
+    elif TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        exporter = OTLPSpanExporter()
+    else:
+        raise ValueError(f"Unsupported TRACING_EXPORTER {TRACING_EXPORTER}, use console, file or otlp")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": TRACING_SERVICE_NAME}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer(__name__)
+
+
+tracer = _configure_tracer()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """
+    Trace the block as a child of the current span. Attributes that are None are left out, and the span
+    records the exception the block raises, if any.
+
+    Yields:
+        The span, to set attributes known once the block ran, e.g. token counts.
+    """
+    if tracer is None:
+        yield NOOP_SPAN
+        return
+    with tracer.start_as_current_span(
+        name, attributes={key: value for key, value in attributes.items() if value is not None}
+    ) as current:
+        yield current
+
+
+def traced(name: str, arguments: Sequence[str] = (), **attributes: Any) -> Callable:
+    """
+    Decorate a function or a coroutine function to trace its calls, with the values of the given arguments
+    as attributes of the span.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        signature = inspect.signature(function)
+
+        def span_attributes(args: tuple, kwargs: dict) -> dict:
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            return {**attributes, **{argument: bound.get(argument) for argument in arguments}}
+
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **span_attributes(args, kwargs)):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, **span_attributes(args, kwargs)):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
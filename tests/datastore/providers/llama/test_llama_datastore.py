@@ -1,7 +1,8 @@
+import os
 from typing import Dict, List
 import pytest
 from datastore.providers.llama_datastore import LlamaDataStore
-from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding
+from models.models import DocumentChunk, DocumentChunkMetadata, DocumentMetadataFilter, QueryWithEmbedding
 
 
 def create_embedding(non_zero_pos: int, size: int) -> List[float]:
@@ -93,3 +94,69 @@ async def test_delete(
     is_success = llama_datastore.delete(['first-doc'])
     assert is_success
 
+
+
+@pytest.mark.asyncio
+async def test_query_with_filter(
+    llama_datastore: LlamaDataStore,
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+) -> None:
+    second_doc_chunks = [
+        DocumentChunk(
+            id='second-doc-0',
+            text='Dolor sit amet',
+            metadata=DocumentChunkMetadata(document_id='second-doc'),
+            embedding=create_embedding(4, 5),
+        )
+    ]
+    await llama_datastore._upsert(initial_document_chunks)
+    await llama_datastore._upsert({'second-doc': second_doc_chunks})
+
+    query = QueryWithEmbedding(
+        query='Query',
+        top_k=3,
+        filter=DocumentMetadataFilter(document_id='second-doc'),
+        embedding=create_embedding(5, 5),
+    )
+    query_results = await llama_datastore._query([query])
+
+    # The only matching chunk is returned, even though others are closer
+    assert [result.id for result in query_results[0].results] == ['second-doc-0']
+
+
+@pytest.mark.asyncio
+async def test_delete_by_filter_and_all(
+    llama_datastore: LlamaDataStore,
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+    queries: List[QueryWithEmbedding],
+) -> None:
+    for doc_chunk in initial_document_chunks['first-doc']:
+        doc_chunk.metadata.document_id = 'first-doc'
+    await llama_datastore._upsert(initial_document_chunks)
+
+    assert await llama_datastore.delete(filter=DocumentMetadataFilter(document_id='first-doc'))
+    query_results = await llama_datastore._query(queries)
+    assert all(len(query_result.results) == 0 for query_result in query_results)
+
+    await llama_datastore._upsert(initial_document_chunks)
+    assert await llama_datastore.delete(delete_all=True)
+    query_results = await llama_datastore._query(queries)
+    assert all(len(query_result.results) == 0 for query_result in query_results)
+
+
+@pytest.mark.asyncio
+async def test_changes_are_replayed_from_log(
+    tmp_path,
+    initial_document_chunks: Dict[str, List[DocumentChunk]],
+    queries: List[QueryWithEmbedding],
+) -> None:
+    index_json_path = str(tmp_path / 'index.json')
+    datastore = LlamaDataStore(index_json_path=index_json_path)
+    await datastore._upsert(initial_document_chunks, chain='test')
+
+    # Nothing but the log was written
+    assert not os.path.exists(index_json_path)
+
+    reloaded_datastore = LlamaDataStore(index_json_path=index_json_path)
+    query_results = await reloaded_datastore._query(queries, chain='test')
+    assert query_results[0].results[0].id == 'first-doc-4'
@@ -11,9 +11,11 @@ from models.models import (
     QueryWithEmbedding,
     Source,
 )
+import datastore.providers.milvus_datastore as milvus_datastore_module
 from datastore.providers.milvus_datastore import (
     OUTPUT_DIM,
     MilvusDataStore,
+    _partition_name,
 )
 
 
@@ -255,6 +257,33 @@ async def test_query_filter(milvus_datastore, document_chunk_one):
     milvus_datastore.col.drop()
 
 
+@pytest.mark.asyncio
+async def test_batched_queries_keep_order(milvus_datastore, document_chunk_one):
+    await milvus_datastore.delete(delete_all=True)
+    res = await milvus_datastore._upsert(document_chunk_one, chain="test")
+    assert res == list(document_chunk_one.keys())
+    milvus_datastore.col.flush()
+    queries = [
+        QueryWithEmbedding(query="first", top_k=1, embedding=sample_embedding(0)),
+        QueryWithEmbedding(
+            query="filtered",
+            top_k=1,
+            embedding=sample_embedding(0),
+            filter=DocumentMetadataFilter(
+                start_date="2000-01-03T16:39:57-08:00", end_date="2010-01-03T16:39:57-08:00"
+            ),
+        ),
+        QueryWithEmbedding(query="second", top_k=1, embedding=sample_embedding(1)),
+    ]
+    query_results = await milvus_datastore._query(queries=queries, chain="test")
+
+    assert ["first", "filtered", "second"] == [result.query for result in query_results]
+    assert "abc_123" == query_results[0].results[0].id
+    assert "def_456" == query_results[1].results[0].id
+    assert "def_456" == query_results[2].results[0].id
+    milvus_datastore.col.drop()
+
+
 @pytest.mark.asyncio
 async def test_delete_with_date_filter(milvus_datastore, document_chunk_one):
     await milvus_datastore.delete(delete_all=True)
@@ -348,6 +377,89 @@ async def test_delete_with_document_id(milvus_datastore, document_chunk_one):
     milvus_datastore.col.drop()
 
 
+class FakePartition:
+    def __init__(self, collection, name):
+        self.collection = collection
+        self.name = name
+
+    def load(self):
+        self.collection.events.append(("load", self.name))
+
+    def release(self):
+        self.collection.events.append(("release", self.name))
+
+
+class FakeCollection:
+    """Records the partition loads and releases, without a Milvus server."""
+
+    def __init__(self):
+        self.partition_names = set()
+        self.events = []
+
+    def has_partition(self, name):
+        return name in self.partition_names
+
+    def create_partition(self, name):
+        self.partition_names.add(name)
+
+    def partition(self, name):
+        return FakePartition(self, name)
+
+
+@pytest.fixture
+def partitioned_datastore(monkeypatch):
+    monkeypatch.setattr(milvus_datastore_module, "MILVUS_MAX_LOADED_PARTITIONS", 2)
+    datastore = MilvusDataStore.__new__(MilvusDataStore)
+    datastore._init_partitions(load_on_demand=True)
+    datastore.col = FakeCollection()
+    return datastore
+
+
+async def search(datastore, *chains):
+    for chain in chains:
+        partition = _partition_name(chain)
+        await datastore._acquire_partition(partition)
+        await datastore._free_partition(partition)
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_partitions_are_released(partitioned_datastore):
+    await search(partitioned_datastore, "a", "b", "a", "c")
+
+    assert partitioned_datastore.col.events == [
+        ("load", _partition_name("a")),
+        ("load", _partition_name("b")),
+        ("load", _partition_name("c")),
+        ("release", _partition_name("b")),
+    ]
+    stats = partitioned_datastore.get_partition_stats()
+    assert stats["loads"] == 3 and stats["releases"] == 1
+    assert stats["loaded_partitions"] == [_partition_name("a"), _partition_name("c")]
+
+
+@pytest.mark.asyncio
+async def test_warm_and_in_use_partitions_are_never_released(partitioned_datastore):
+    partitioned_datastore._warm_up_partitions(["warm"])
+    # A search of chain a is still in flight while the others load
+    await partitioned_datastore._acquire_partition(_partition_name("a"))
+    await search(partitioned_datastore, "b", "c")
+
+    released = [name for event, name in partitioned_datastore.col.events if event == "release"]
+    assert released == [_partition_name("b")]
+    # Over budget until the search of chain a is done, and released next
+    assert partitioned_datastore.get_partition_stats()["loaded_partitions"] == [
+        _partition_name("warm"),
+        _partition_name("a"),
+        _partition_name("c"),
+    ]
+    await partitioned_datastore._free_partition(_partition_name("a"))
+    await search(partitioned_datastore, "d")
+    assert partitioned_datastore.get_partition_stats()["loaded_partitions"] == [
+        _partition_name("warm"),
+        _partition_name("d"),
+    ]
+
+
 # if __name__ == '__main__':
 #     import sys
 #     import pytest
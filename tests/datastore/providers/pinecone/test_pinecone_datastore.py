@@ -0,0 +1,167 @@
+import importlib
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+
+pinecone = pytest.importorskip("pinecone")
+
+import services.import_journal as import_journal_module
+from models.models import Document, DocumentChunk, DocumentChunkMetadata
+from services.import_journal import ImportJournal, roll_back_unfinished_batches, upsert_journaled_batch
+
+
+class FakeIndex:
+    """Keeps the metadata of the vectors of each namespace, and deletes with the filters the datastore uses."""
+
+    def __init__(self):
+        self.namespaces = defaultdict(dict)
+        self.stats_calls = 0
+
+    def upsert(self, vectors, namespace=""):
+        for id, embedding, metadata in vectors:
+            self.namespaces[namespace][id] = metadata
+
+    def delete(self, ids=None, delete_all=None, filter=None, namespace=""):
+        if delete_all:
+            self.namespaces.pop(namespace, None)
+            return
+        vectors = self.namespaces.get(namespace, {})
+        if ids is not None:
+            for id in ids:
+                vectors.pop(id, None)
+            return
+        for id in [id for id, metadata in vectors.items() if _matches(metadata, filter or {})]:
+            del vectors[id]
+
+    def describe_index_stats(self):
+        self.stats_calls += 1
+        return SimpleNamespace(namespaces={namespace: {} for namespace in self.namespaces}, dimension=2)
+
+    def query(self, namespace, vector, top_k, filter):
+        vectors = self.namespaces.get(namespace, {})
+        ids = [id for id, metadata in vectors.items() if _matches(metadata, filter)][:top_k]
+        return SimpleNamespace(matches=[SimpleNamespace(id=id) for id in ids])
+
+    def fetch(self, ids, namespace):
+        vectors = self.namespaces.get(namespace, {})
+        return SimpleNamespace(vectors={id: {} for id in ids if id in vectors})
+
+    def update(self, id, set_metadata, namespace):
+        self.namespaces[namespace][id].update(set_metadata)
+
+    def documents(self, namespace):
+        return sorted((metadata["document_id"], metadata["chain"]) for metadata in self.namespaces[namespace].values())
+
+
+def _matches(metadata, filter):
+    for field, condition in filter.items():
+        if isinstance(condition, dict) and "$exists" in condition:
+            if (field in metadata) != condition["$exists"]:
+                return False
+        elif isinstance(condition, dict):
+            if metadata.get(field) not in condition["$in"]:
+                return False
+        elif metadata.get(field) != condition:
+            return False
+    return True
+
+
+class InterruptedDataStore:
+    async def upsert(self, documents, chain="", sync_sources=True):
+        raise RuntimeError("interrupted")
+
+
+@pytest.fixture
+def pinecone_datastore(monkeypatch):
+    for name in ["PINECONE_API_KEY", "PINECONE_ENVIRONMENT", "PINECONE_INDEX"]:
+        monkeypatch.setenv(name, "test")
+    monkeypatch.setattr(pinecone, "init", lambda **kwargs: None)
+    pinecone_datastore_module = importlib.import_module("datastore.providers.pinecone_datastore")
+
+    datastore = pinecone_datastore_module.PineconeDataStore.__new__(pinecone_datastore_module.PineconeDataStore)
+    datastore.index = FakeIndex()
+    datastore._namespaces = set()
+    datastore._namespaces_listed_at = None
+    return datastore
+
+
+def create_chunks(document_id, topic_id):
+    return {
+        document_id: [
+            DocumentChunk(
+                id=f"{document_id}_0",
+                text="text",
+                metadata=DocumentChunkMetadata(),
+                embedding=[1.0, 0.0],
+                topic_id=topic_id,
+            )
+        ]
+    }
+
+
+@pytest.mark.asyncio
+async def test_rollback_deletes_the_vectors_of_its_chain(pinecone_datastore, monkeypatch, tmp_path):
+    monkeypatch.setattr(import_journal_module, "delete_document_questions", lambda chain, document_ids: None)
+    index = pinecone_datastore.index
+    # The same dump imported into two chains, and a batch of the import into chain x interrupted
+    for chain in ["x", "y"]:
+        await pinecone_datastore._upsert(create_chunks("doc-1", "t"), chain)
+    await pinecone_datastore._upsert(create_chunks("doc-2", "t"), "x")
+
+    journal = ImportJournal(str(tmp_path / "dump.journal.sqlite"))
+    with pytest.raises(RuntimeError):
+        await upsert_journaled_batch(
+            InterruptedDataStore(), journal, [("1", Document(id="doc-1", text="one"))], chain="x"
+        )
+    await roll_back_unfinished_batches(pinecone_datastore, journal, chain="x")
+
+    assert index.documents("chain_x") == [("doc-2", "x")]
+    assert index.documents("chain_y") == [("doc-1", "y")]
+    assert index.documents("topic_t") == [("doc-1", "y"), ("doc-2", "x")]
+
+
+@pytest.mark.asyncio
+async def test_delete_all_of_a_chain_keeps_the_other_chains(pinecone_datastore):
+    index = pinecone_datastore.index
+    await pinecone_datastore._upsert(create_chunks("doc-1", "t"), "x")
+    await pinecone_datastore._upsert(create_chunks("doc-2", "t"), "y")
+
+    await pinecone_datastore.delete(delete_all=True, chain="x")
+    assert "chain_x" not in index.namespaces
+    assert index.documents("chain_y") == [("doc-2", "y")]
+    assert index.documents("topic_t") == [("doc-2", "y")]
+
+    await pinecone_datastore.delete(ids=["doc-2"])
+    assert not any(index.namespaces.values())
+
+
+@pytest.mark.asyncio
+async def test_deletes_reuse_the_namespaces_listed(pinecone_datastore):
+    index = pinecone_datastore.index
+    await pinecone_datastore._upsert(create_chunks("doc-1", "t"), "x")
+    await pinecone_datastore.delete(ids=["doc-1"], chain="x")
+    await pinecone_datastore._upsert(create_chunks("doc-2", "u"), "x")
+    await pinecone_datastore.delete(ids=["doc-2"], chain="x")
+
+    assert index.stats_calls == 1
+    assert not any(index.namespaces.values())
+
+
+def test_backfill_tags_legacy_topic_vectors_with_their_chain(pinecone_datastore):
+    index = pinecone_datastore.index
+    index.upsert([("doc-1_0", [1.0, 0.0], {"document_id": "doc-1", "chain": "x"})], namespace="chain_x")
+    index.upsert([("doc-2_0", [1.0, 0.0], {"document_id": "doc-2", "chain": "y"})], namespace="chain_y")
+    # Topic vectors upserted without their chain, one of them of a document deleted since
+    index.upsert(
+        [
+            ("doc-1_0", [1.0, 0.0], {"document_id": "doc-1"}),
+            ("doc-2_0", [1.0, 0.0], {"document_id": "doc-2"}),
+            ("doc-3_0", [1.0, 0.0], {"document_id": "doc-3"}),
+        ],
+        namespace="topic_t",
+    )
+
+    assert pinecone_datastore.backfill_chains() == 2
+    assert index.documents("topic_t") == [("doc-1", "x"), ("doc-2", "y")]
+    assert pinecone_datastore.backfill_chains() == 0
@@ -1,9 +1,11 @@
+import asyncio
 from typing import Dict, List
 
 import pytest
 import qdrant_client
 from qdrant_client.http.models import PayloadSchemaType
 
+import datastore.providers.qdrant_datastore as qdrant_datastore_module
 from datastore.providers.qdrant_datastore import QdrantDataStore
 from models.models import (
     DocumentChunk,
@@ -85,13 +87,15 @@ async def test_datastore_creates_payload_indexes(
 ):
     collection_info = client.get_collection(collection_name="documents")
 
-    assert 2 == len(collection_info.payload_schema)
+    assert 6 == len(collection_info.payload_schema)
     assert "created_at" in collection_info.payload_schema
     created_at = collection_info.payload_schema["created_at"]
     assert PayloadSchemaType.INTEGER == created_at.data_type
     assert "metadata.document_id" in collection_info.payload_schema
     document_id = collection_info.payload_schema["metadata.document_id"]
     assert PayloadSchemaType.KEYWORD == document_id.data_type
+    for field_name in ["metadata.source", "metadata.source_id", "chain", "topic_id"]:
+        assert PayloadSchemaType.KEYWORD == collection_info.payload_schema[field_name].data_type
 
 
 @pytest.mark.asyncio
@@ -106,6 +110,32 @@ async def test_upsert_creates_all_points(
     assert 5 == client.count(collection_name="documents").count
 
 
+@pytest.mark.asyncio
+async def test_upsert_in_batches_without_wait(client, document_chunks, monkeypatch):
+    monkeypatch.setattr(qdrant_datastore_module, "QDRANT_UPSERT_BATCH_SIZE", 2)
+    datastore = QdrantDataStore(
+        collection_name="documents", vector_size=5, recreate_collection=True, upsert_wait=False
+    )
+    document_ids = await datastore._upsert(document_chunks, chain="test")
+    assert document_ids == list(document_chunks.keys())
+
+    # Points are acknowledged before indexing, give Qdrant a moment to apply them
+    for _ in range(50):
+        if 5 == client.count(collection_name="documents").count:
+            break
+        await asyncio.sleep(0.1)
+    assert 5 == client.count(collection_name="documents").count
+
+
+@pytest.mark.asyncio
+async def test_query_is_scoped_to_chain(qdrant_datastore, document_chunks):
+    await qdrant_datastore._upsert(document_chunks, chain="test")
+
+    query = QueryWithEmbedding(query="lorem", top_k=10, embedding=[0.5, 0.5, 0.5, 0.5, 0.5])
+    assert 5 == len((await qdrant_datastore._query([query], chain="test"))[0].results)
+    assert 0 == len((await qdrant_datastore._query([query], chain="other"))[0].results)
+
+
 @pytest.mark.asyncio
 async def test_upsert_does_not_remove_existing_documents_but_store_new(
     qdrant_datastore,
@@ -278,3 +308,27 @@ async def test_delete_removes_all(
     await qdrant_datastore.delete(delete_all=True)
 
     assert 0 == client.count(collection_name="documents").count
+
+
+@pytest.mark.asyncio
+async def test_scalar_quantization_with_on_disk_vectors(client, document_chunks):
+    datastore = QdrantDataStore(
+        collection_name="documents",
+        vector_size=5,
+        recreate_collection=True,
+        quantization="scalar",
+        on_disk_vectors=True,
+    )
+    collection_info = client.get_collection(collection_name="documents")
+    assert collection_info.config.quantization_config is not None
+
+    await datastore._upsert(document_chunks)
+
+    query = QueryWithEmbedding(query="ipsum", top_k=1, embedding=[0.0, 0.0, 0.5, 0.0, 0.0])
+    query_results = await datastore._query(queries=[query])
+    assert "first-doc" == query_results[0].results[0].metadata.document_id
+
+
+def test_unsupported_quantization_raises():
+    with pytest.raises(ValueError):
+        QdrantDataStore(collection_name="documents", vector_size=5, quantization="binary")
@@ -1,6 +1,6 @@
 from datastore.providers.redis_datastore import RedisDataStore
 import datastore.providers.redis_datastore as static_redis
-from models.models import DocumentChunk, DocumentChunkMetadata, QueryWithEmbedding, Source
+from models.models import DocumentChunk, DocumentChunkMetadata, DocumentMetadataFilter, QueryWithEmbedding, Source
 import pytest
 import redis.asyncio as redis
 import numpy as np
@@ -43,3 +43,69 @@ async def test_redis_upsert_query(redis_datastore):
     for i in range(5):
         assert f"Lorem ipsum {i}" == query_results[0].results[i].text
         assert f"doc-{i}" == query_results[0].results[i].id
+
+
+@pytest.mark.asyncio
+async def test_redis_multi_query(redis_datastore):
+    docs = create_document_chunks(10, 5)
+    await redis_datastore._upsert(docs)
+    queries = [
+        QueryWithEmbedding(
+            query=f"Lorem ipsum {i}",
+            top_k=3,
+            embedding=create_embedding(i, 5),
+        )
+        for i in range(3)
+    ]
+    query_results = await redis_datastore._query(queries=queries)
+    assert [result.query for result in query_results] == [query.query for query in queries]
+    for result in query_results:
+        assert 3 == len(result.results)
+        assert all(chunk.embedding is None for chunk in result.results)
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_by_ids(redis_datastore):
+    await redis_datastore.delete(delete_all=True)
+    redis_datastore = await RedisDataStore.init(dim=5)
+    docs = create_document_chunks(10, 5)
+    await redis_datastore._upsert(docs)
+    assert 10 == len(await redis_datastore._get_document_keys(["docs"]))
+
+    await redis_datastore.delete(ids=["docs"])
+    assert [] == await redis_datastore._get_document_keys(["docs"])
+    query = QueryWithEmbedding(query="Lorem ipsum 0", top_k=5, embedding=create_embedding(0, 5))
+    query_results = await redis_datastore._query(queries=[query])
+    assert 0 == len(query_results[0].results)
+
+
+@pytest.mark.asyncio
+async def test_redis_delete_by_filter(redis_datastore):
+    await redis_datastore.delete(delete_all=True)
+    redis_datastore = await RedisDataStore.init(dim=5)
+    docs = create_document_chunks(10, 5)
+    docs["docs"][0].metadata.source = Source.email
+    await redis_datastore._upsert(docs)
+
+    await redis_datastore.delete(filter=DocumentMetadataFilter(source=Source.email))
+    keys = await redis_datastore._get_document_keys(["docs"])
+    assert 9 == len(keys)
+    assert RedisDataStore._redis_key("docs", "first-doc_0") not in keys
+
+
+@pytest.mark.asyncio
+async def test_redis_init_backfills_document_key_sets(redis_datastore):
+    await redis_datastore.delete(delete_all=True)
+    redis_datastore = await RedisDataStore.init(dim=5)
+    docs = create_document_chunks(3, 5)
+    await redis_datastore._upsert(docs)
+    # Chunks written by a version that did not maintain the key sets
+    client = redis_datastore.client
+    await client.delete(RedisDataStore._redis_document_keys_key("docs"), static_redis._document_key_sets_key())
+
+    redis_datastore = await RedisDataStore.init(dim=5)
+    assert 3 == len(await redis_datastore._get_document_keys(["docs"]))
+    assert await client.exists(static_redis._document_key_sets_key())
+
+    await redis_datastore.delete(ids=["docs"])
+    assert [] == await redis_datastore._get_document_keys(["docs"])
@@ -11,8 +11,6 @@ from datastore.providers.weaviate_datastore import (
     extract_schema_properties,
 )
 import logging
-from loguru import logger
-from _pytest.logging import LogCaptureFixture
 
 BEARER_TOKEN = os.getenv("BEARER_TOKEN")
 
@@ -123,13 +121,6 @@ def mock_env_resource_owner_password_flow(monkeypatch):
     )
 
 
-@pytest.fixture
-def caplog(caplog: LogCaptureFixture):
-    handler_id = logger.add(caplog.handler, format="{message}")
-    yield caplog
-    logger.remove(handler_id)
-
-
 @pytest.mark.parametrize(
     "document_id", [("abc_123"), ("9a253e0b-d2df-5c2e-be6d-8e9b1f4ae345")]
 )
@@ -519,3 +510,17 @@ def test_upsert_same_docid(test_db, weaviate_client):
     # but it is None right now because an
     # update function is out of scope
     assert weaviate_doc[0]["source"] is None
+
+
+def test_build_batched_query(weaviate_client):
+    datastore = WeaviateDataStore()
+    builders = [
+        weaviate_client.query.get(SCHEMA["class"], ["text"]).with_limit(1),
+        weaviate_client.query.get(SCHEMA["class"], ["text"]).with_limit(2),
+    ]
+    batched_query = datastore._build_batched_query(builders)
+
+    assert batched_query.startswith("{Get{q0: " + SCHEMA["class"])
+    assert " q1: " + SCHEMA["class"] in batched_query
+    assert batched_query.count("{Get{") == 1
+    assert "errors" not in weaviate_client.query.raw(batched_query)
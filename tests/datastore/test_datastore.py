@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+import datastore.datastore as datastore_module
+from datastore.datastore import DataStore, QuestionIndex
+from models.models import Document, SourceCursor
+from services.file import PAGE_BREAK
+from services.source_cursor import MIN_NEW_LINES_TO_PROCESS, checksum
+
+
+class FakeDataStore(DataStore):
+    def __init__(self):
+        self.processed = []
+        self.documents = []
+        self.deleted = []
+
+    async def _upsert(self, chunks, chain=""):
+        return list(chunks)
+
+    async def _query(self, queries, chain):
+        return []
+
+    async def delete(self, ids=None, filter=None, delete_all=None, chain=""):
+        self.deleted.append((filter.document_id, chain))
+        return True
+
+
+@pytest.fixture
+def cursors(monkeypatch):
+    saved = {}
+    monkeypatch.setattr(
+        datastore_module, "get_source_cursor", lambda chain, source_id: saved.get(source_id, SourceCursor())
+    )
+    monkeypatch.setattr(
+        datastore_module, "edit_source_cursor", lambda chain, source_id, cursor: saved.__setitem__(source_id, cursor)
+    )
+    monkeypatch.setattr(datastore_module, "scan_topics", lambda: [])
+    monkeypatch.setattr(datastore_module, "query_question_embeddings", lambda chain: [])
+    return saved
+
+
+@pytest.fixture
+def datastore(monkeypatch) -> FakeDataStore:
+    datastore = FakeDataStore()
+
+    def get_document_chunks(documents, chunk_token_size, chain, progress):
+        datastore.processed.extend(document.text for document in documents)
+        datastore.documents.extend(documents)
+        return {document.id: [] for document in documents}
+
+    monkeypatch.setattr(datastore_module, "get_document_chunks", get_document_chunks)
+    return datastore
+
+
+@pytest.mark.asyncio
+async def test_one_line_document_is_processed(datastore, cursors):
+    assert await datastore.upsert([Document(id="doc", text="single line")]) == ["doc"]
+    assert datastore.processed == ["single line"]
+    assert cursors["doc"] == SourceCursor(byte_offset=11, checksum=checksum(b"single line"), line=0)
+
+
+@pytest.mark.asyncio
+async def test_appended_sources_hold_back_their_partial_last_line(datastore, cursors):
+    text = "".join(f"line {i}\n" for i in range(3)) + "partial"
+    await datastore.upsert([Document(id="doc", text=text)], appending=True)
+    assert datastore.processed == ["line 0\nline 1\nline 2\n"]
+    assert cursors["doc"].line == 3
+
+    # The partial line is processed once complete, with enough new lines after it
+    text += " line\n" + "new line\n" * MIN_NEW_LINES_TO_PROCESS
+    await datastore.upsert([Document(id="doc", text=text)], appending=True)
+    assert datastore.processed[-1].startswith("partial line\nnew line\n")
+    assert cursors["doc"].byte_offset == len(text)
+
+
+@pytest.mark.asyncio
+async def test_small_appends_wait_on_both_paths(datastore, cursors):
+    text = "line\n" * 3
+    await datastore.upsert([Document(id="doc", text=text)])
+    cursor = cursors["doc"]
+
+    assert await datastore.upsert([Document(id="doc", text=text + "more\n")]) == []
+    tail = Document(id="doc", text="more\n")
+    assert await datastore.upsert_tail(tail, len(text), cursor.checksum, "new checksum") == []
+    assert cursors["doc"] == cursor
+
+
+@pytest.mark.asyncio
+async def test_first_tail_of_a_new_source_is_processed_right_away(datastore, cursors):
+    tail = Document(id="doc", text="line\n" * 3)
+    assert await datastore.upsert_tail(tail, 0, None, checksum(b"line\n" * 3)) == ["doc"]
+    assert cursors["doc"] == SourceCursor(byte_offset=15, checksum=checksum(b"line\n" * 3), line=3)
+
+    with pytest.raises(ValueError):
+        await datastore.upsert_tail(Document(id="doc", text="partial"), 15, cursors["doc"].checksum, "")
+
+
+@pytest.mark.asyncio
+async def test_changed_sources_are_deleted_from_their_chain_only(datastore, cursors):
+    await datastore.upsert([Document(id="doc", text="line\n" * 3)], chain="x")
+    assert datastore.deleted == []
+
+    await datastore.upsert([Document(id="doc", text="changed\n" * 3)], chain="x")
+    assert datastore.deleted == [("doc", "x")]
+    assert datastore.processed[-1] == "changed\n" * 3
+
+
+@pytest.mark.asyncio
+async def test_resumed_pdfs_start_on_the_page_they_were_resumed_at(datastore, cursors):
+    pages = ["line\n" * 3, "line\n" * 3]
+    await datastore.upsert([Document(id="doc", text=PAGE_BREAK.join(pages), mimetype="application/pdf")])
+    assert datastore.documents[-1].first_page == 1
+
+    pages[-1] += "new line\n" * MIN_NEW_LINES_TO_PROCESS
+    pages.append("last page\n")
+    await datastore.upsert([Document(id="doc", text=PAGE_BREAK.join(pages), mimetype="application/pdf")])
+    resumed = datastore.documents[-1]
+    assert resumed.text.startswith("new line\n")
+    assert resumed.first_page == 2
+    assert resumed.mimetype == "application/pdf"
+
+
+@pytest.mark.asyncio
+async def test_imported_documents_are_processed_whole_without_cursors(datastore, cursors):
+    text = "line\n" * 3
+    await datastore.upsert([Document(id="doc", text=text)], sync_sources=False)
+    await datastore.upsert([Document(id="doc", text=text + "more\n")], sync_sources=False)
+
+    assert datastore.processed == [text, text + "more\n"]
+    assert datastore.deleted == []
+    assert cursors == {}
+
+
+def test_question_index_deduplicates_new_questions_across_batches(monkeypatch):
+    monkeypatch.setattr(datastore_module, "QUESTION_INDEX_BATCH_SIZE", 4)
+    rng = np.random.default_rng(0)
+    old_questions = rng.normal(size=(200, 16)).tolist()
+    new_questions = rng.normal(size=(10, 16)).tolist()
+    index = QuestionIndex(old_questions)
+
+    assert index.is_duplicate(old_questions[3])
+    for question in new_questions:
+        assert not index.is_duplicate(question)
+        index.add(question)
+        # Both the questions quantized into the index and the pending ones are found
+        assert index.is_duplicate(new_questions[0])
+        assert index.is_duplicate(question)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+from collections import deque
+
+import pytest
+
+from scripts.process_jsonl import process_jsonl as process_jsonl_module
+from scripts.process_jsonl.process_jsonl import DOCUMENT_UPSERT_BATCH_SIZE, process_jsonl_dump
+
+
+class SlowDataStore:
+    """Upserts one batch at a time, slower than the lines are parsed."""
+
+    def __init__(self, lines_read):
+        self.lines_read = lines_read
+        self.batches = []
+        self.lines_read_after_first_upsert = None
+
+    async def upsert(self, documents, chain="", sync_sources=True):
+        await asyncio.sleep(0.02)
+        if self.lines_read_after_first_upsert is None:
+            self.lines_read_after_first_upsert = len(self.lines_read)
+        self.batches.append([document.id for document in documents])
+        return [document.id for document in documents]
+
+
+class RecordingDeque(deque):
+    max_length = 0
+
+    def append(self, item):
+        super().append(item)
+        RecordingDeque.max_length = max(RecordingDeque.max_length, len(self))
+
+
+@pytest.mark.asyncio
+async def test_reading_waits_for_slow_upserts_and_batches_keep_file_order(monkeypatch, tmp_path):
+    path = tmp_path / "dump.jsonl"
+    with open(path, "w") as dump:
+        for i in range(500):
+            dump.write(json.dumps({"id": f"doc-{i}", "text": f"text {i}"}) + "\n")
+
+    lines_read = []
+    read_lines = process_jsonl_module.read_lines
+
+    def recording_read_lines(filepath):
+        for entry in read_lines(filepath):
+            lines_read.append(entry[0])
+            yield entry
+
+    monkeypatch.setattr(process_jsonl_module, "read_lines", recording_read_lines)
+    monkeypatch.setattr(process_jsonl_module, "deque", RecordingDeque)
+    datastore = SlowDataStore(lines_read)
+
+    await process_jsonl_dump(str(path), datastore, {}, False, False, workers=4, max_in_flight=20)
+
+    assert 0 < RecordingDeque.max_length <= 20
+    # Reading paused while the first batch was upserted, with the next batch waiting and the window full
+    assert datastore.lines_read_after_first_upsert <= 2 * DOCUMENT_UPSERT_BATCH_SIZE + 20
+    assert [id for batch in datastore.batches for id in batch] == [f"doc-{i}" for i in range(500)]
+    assert all(len(batch) == DOCUMENT_UPSERT_BATCH_SIZE for batch in datastore.batches)
@@ -0,0 +1,65 @@
+import zipfile
+
+import pytest
+
+from scripts.process_zip import process_zip as process_zip_module
+from scripts.process_zip.process_zip import process_file_dump
+from services.import_journal import ImportJournal
+
+
+class RecordingDataStore:
+    def __init__(self):
+        self.batches = []
+
+    async def upsert(self, documents, chain="", sync_sources=True):
+        self.batches.append([(document.metadata.source_id, document.text) for document in documents])
+        return [document.id for document in documents]
+
+
+@pytest.fixture
+def dump(tmp_path):
+    path = tmp_path / "dump.zip"
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("docs/", "")
+        for name in ["a", "b", "c", "d", "e"]:
+            zip_file.writestr(f"docs/{name}.txt", f"text of {name}")
+    return path
+
+
+@pytest.mark.asyncio
+async def test_members_are_read_in_place_and_batched_in_archive_order(monkeypatch, tmp_path, dump):
+    monkeypatch.setattr(process_zip_module, "DOCUMENT_UPSERT_BATCH_SIZE", 2)
+    datastore = RecordingDataStore()
+
+    await process_file_dump(str(dump), datastore, {}, False, False, workers=1, max_in_flight=2)
+
+    assert datastore.batches == [
+        [("a.txt", "text of a"), ("b.txt", "text of b")],
+        [("c.txt", "text of c"), ("d.txt", "text of d")],
+        [("e.txt", "text of e")],
+    ]
+    # Nothing was extracted next to the archive
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["dump.zip"]
+
+
+@pytest.mark.asyncio
+async def test_journal_skips_the_members_finished_before(monkeypatch, tmp_path, dump):
+    monkeypatch.setattr(process_zip_module, "DOCUMENT_UPSERT_BATCH_SIZE", 2)
+    journal_path = str(tmp_path / "dump.journal.sqlite")
+    journal = ImportJournal(journal_path)
+    journal.skip("docs/b.txt", "PII detected")
+    datastore = RecordingDataStore()
+
+    await process_file_dump(str(dump), datastore, {}, False, False, journal=journal, workers=1)
+    assert [source_id for batch in datastore.batches for source_id, _ in batch] == [
+        "a.txt",
+        "c.txt",
+        "d.txt",
+        "e.txt",
+    ]
+
+    resumed = RecordingDataStore()
+    await process_file_dump(
+        str(dump), resumed, {}, False, False, journal=ImportJournal(journal_path, resume=True), workers=1
+    )
+    assert resumed.batches == []
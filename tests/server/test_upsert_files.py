@@ -0,0 +1,73 @@
+import importlib
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from server.ingestion_worker import run_job
+from services.ingestion import JobQueue
+
+
+class RecordingDataStore:
+    def __init__(self):
+        self.upserts = []
+
+    async def upsert(self, documents, chain="", progress=None):
+        self.upserts.append((chain, [(document.id, document.text) for document in documents]))
+        return [document.id for document in documents]
+
+
+@pytest.fixture
+def main(monkeypatch, tmp_path):
+    monkeypatch.setenv("BEARER_TOKEN", os.environ.get("BEARER_TOKEN", "test"))
+    main = importlib.import_module("server.main")
+    monkeypatch.setattr(main, "INGESTION_SPOOL_DIR", str(tmp_path / "spool"))
+    monkeypatch.setattr(main, "ingestion_queue", JobQueue(str(tmp_path / "jobs.sqlite")), raising=False)
+    return main
+
+
+@pytest.fixture
+def client(main):
+    client = TestClient(main.app)
+    client.headers["Authorization"] = f"Bearer {main.BEARER_TOKEN}"
+    return client
+
+
+def text_files(count):
+    return [("files", (f"file-{i}.txt", f"text {i}\n".encode(), "text/plain")) for i in range(count)]
+
+
+@pytest.mark.parametrize(
+    "ids",
+    [
+        ["a", "b"],  # One id short
+        ["a", "b", "a"],  # The same source twice
+    ],
+)
+def test_batches_with_invalid_ids_are_rejected(main, client, tmp_path, ids):
+    response = client.post("/gpt/upsert-files", files=text_files(3), data={"ids": ids})
+    assert response.status_code == 400
+    assert main.ingestion_queue.claim() is None
+    # Nothing was saved for a job that will never run
+    assert not (tmp_path / "spool").exists() or not os.listdir(tmp_path / "spool")
+
+
+def test_batches_over_the_file_limit_are_rejected(main, client, monkeypatch):
+    monkeypatch.setattr(main, "UPSERT_BATCH_MAX_FILES", 2)
+    response = client.post("/gpt/upsert-files", files=text_files(3))
+    assert response.status_code == 413
+    assert main.ingestion_queue.claim() is None
+
+
+@pytest.mark.asyncio
+async def test_a_batch_is_upserted_at_once_by_the_worker(main, client):
+    response = client.post(
+        "/gpt/upsert-files", params={"chain": "c"}, files=text_files(3), data={"ids": ["a", "b", "c"]}
+    )
+    assert response.status_code == 200
+    job = main.ingestion_queue.claim()
+    assert job["id"] == response.json()["job_id"]
+
+    datastore = RecordingDataStore()
+    assert await run_job(datastore, main.ingestion_queue, job) == ["a", "b", "c"]
+    assert datastore.upserts == [("c", [("a", "text 0\n"), ("b", "text 1\n"), ("c", "text 2\n")])]
@@ -0,0 +1,88 @@
+import services.chunks as chunks_module
+from models.models import Document, FileDocument
+from services.chunks import create_document_chunks, get_text_chunks, iter_text_chunks, iter_text_chunks_with_pages
+from services.file import PAGE_BREAK
+
+
+def make_text(num_lines: int) -> str:
+    return "".join(f"Message number {i} in the discussion. Is it a question? Yes!\n" for i in range(num_lines))
+
+
+def test_blocks_give_the_same_chunks_as_the_whole_text():
+    text = make_text(500)
+    lines = text.splitlines(keepends=True)
+    blocks = ["".join(lines[i : i + 37]) for i in range(0, len(lines), 37)]
+
+    assert list(iter_text_chunks(blocks, 100, "", None)) == get_text_chunks(text, 100, "", None)
+
+
+def test_chunks_cover_the_text_once():
+    text = make_text(300)
+    chunks = get_text_chunks(text, 100, "", None)
+
+    assert len(chunks) > 1
+    assert "".join("".join(chunks).split()) == "".join(text.split())
+
+
+def test_chain_prefix_does_not_drop_text():
+    text = make_text(300)
+    prefix = "Discussion excerpt regarding cosmos."
+    chunks = get_text_chunks(text, 100, "cosmos", None)
+
+    assert all(chunk.startswith(prefix) for chunk in chunks[:-1])
+    body = "".join(chunk[len(prefix) :] if chunk.startswith(prefix) else chunk for chunk in chunks)
+    assert "".join(body.split()) == "".join(text.split())
+
+
+def test_empty_text():
+    assert get_text_chunks("", None, "", None) == []
+    assert get_text_chunks(" \n ", None, "", None) == []
+
+
+def test_chunks_cite_their_pages():
+    pages = [make_text(20) for _ in range(5)]
+    chunks = list(iter_text_chunks_with_pages([PAGE_BREAK.join(pages)], 100, "", None))
+
+    assert chunks[0][1] == 1 and chunks[-1][2] == 5
+    for (_, _, previous_end), (_, start, end) in zip(chunks, chunks[1:]):
+        assert previous_end <= start <= end
+    text = "".join(chunk for chunk, _, _ in chunks)
+    assert PAGE_BREAK not in text
+    assert "".join(text.split()) == "".join("".join(pages).split())
+
+
+def test_file_documents_are_chunked_as_they_are_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunks_module, "extract_questions_from_text", lambda text, n: [])
+    monkeypatch.setattr(chunks_module, "get_embeddings", lambda texts: [])
+    monkeypatch.setattr("services.file.TEXT_BLOCK_SIZE", 1000)
+    text = make_text(100) + "[2023-05-01] [tagged] " + make_text(100)
+    path = tmp_path / "discussion.txt"
+    path.write_text(text)
+
+    file_chunks, _ = create_document_chunks(
+        FileDocument(id="doc", file_path=str(path), mimetype="text/plain"), 100, "cosmos"
+    )
+    text_chunks, _ = create_document_chunks(Document(id="doc", text=text), 100, "cosmos")
+
+    assert len(file_chunks) > 1
+    assert file_chunks == text_chunks
+    assert file_chunks[0].text.startswith("[2023-05-01]. Discussion excerpt regarding cosmos.")
+
+
+def test_pages_are_cited_by_paged_files_only(monkeypatch):
+    monkeypatch.setattr(chunks_module, "extract_questions_from_text", lambda text, n: [])
+    monkeypatch.setattr(chunks_module, "get_embeddings", lambda texts: [])
+    text = make_text(50)
+
+    single_page, _ = create_document_chunks(Document(text=text, mimetype="application/pdf"), 100, "")
+    assert {(chunk.metadata.page_start, chunk.metadata.page_end) for chunk in single_page} == {(1, 1)}
+
+    form_feeds, _ = create_document_chunks(
+        Document(text=PAGE_BREAK.join([text, text]), mimetype="text/plain"), 100, ""
+    )
+    assert all(chunk.metadata.page_start is None for chunk in form_feeds)
+
+    resumed, _ = create_document_chunks(
+        Document(text=PAGE_BREAK.join([text, text]), mimetype="application/pdf", first_page=3), 100, ""
+    )
+    assert resumed[0].metadata.page_start == 3 and resumed[-1].metadata.page_end == 4
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import services.enrichment as enrichment_module
+from models.models import DocumentMetadata, Source
+from services.enrichment import DocumentEnricher, RateLimiter
+
+
+@pytest.fixture
+def completions(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+    running = [0, 0]  # current, max
+
+    def screen_text_for_pii(text):
+        with lock:
+            calls.append(("pii", text))
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return "@" in text
+
+    def extract_metadata_from_document(text):
+        calls.append(("metadata", text))
+        return {"source": "email", "author": "alice"}
+
+    monkeypatch.setattr(enrichment_module, "PII_PRESCREEN", False)
+    monkeypatch.setattr(enrichment_module, "screen_text_for_pii", screen_text_for_pii)
+    monkeypatch.setattr(enrichment_module, "extract_metadata_from_document", extract_metadata_from_document)
+    return calls, running
+
+
+@pytest.mark.asyncio
+async def test_documents_are_enriched_concurrently_in_order(completions):
+    calls, running = completions
+    enricher = DocumentEnricher(concurrency=4, requests_per_minute=0)
+    texts = [f"document {i}" for i in range(8)] + ["mail alice@example.com"]
+
+    results = await asyncio.gather(
+        *(enricher.enrich(text, DocumentMetadata(), True, True) for text in texts)
+    )
+
+    assert running[1] == 4
+    assert [result is None for result in results] == [False] * 8 + [True]
+    assert results[0].source == Source.email and results[0].author == "alice"
+    # No metadata is extracted from the document with PII
+    assert len([call for call in calls if call[0] == "metadata"]) == 8
+
+
+@pytest.mark.asyncio
+async def test_results_are_cached_by_text(completions):
+    calls, _ = completions
+    enricher = DocumentEnricher(concurrency=2, requests_per_minute=0)
+
+    # The duplicates enriched at the same time share the completion
+    await asyncio.gather(*(enricher.screen_for_pii("same text") for _ in range(3)))
+    assert await enricher.screen_for_pii("same text") is False
+    assert calls == [("pii", "same text")]
+
+
+@pytest.mark.asyncio
+async def test_only_ambiguous_texts_are_sent_to_the_model(completions, monkeypatch):
+    calls, _ = completions
+    monkeypatch.setattr(enrichment_module, "PII_PRESCREEN", True)
+    enricher = DocumentEnricher(requests_per_minute=0)
+
+    assert await enricher.screen_for_pii("Reach me at jane.doe@gmail.com") is True
+    assert await enricher.screen_for_pii("The build takes 12 minutes") is False
+    assert await enricher.screen_for_pii("Call me back at (555) 123-4567") is False
+    assert calls == [("pii", "Call me back at (555) 123-4567")]
+
+
+@pytest.mark.asyncio
+async def test_failures_are_not_cached(monkeypatch):
+    attempts = []
+
+    def screen_text_for_pii(text):
+        attempts.append(text)
+        if len(attempts) == 1:
+            raise RuntimeError("rate limited")
+        return False
+
+    monkeypatch.setattr(enrichment_module, "PII_PRESCREEN", False)
+    monkeypatch.setattr(enrichment_module, "screen_text_for_pii", screen_text_for_pii)
+    enricher = DocumentEnricher(requests_per_minute=0)
+    with pytest.raises(RuntimeError):
+        await enricher.screen_for_pii("text")
+    assert await enricher.screen_for_pii("text") is False
+    assert len(attempts) == 2
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spaces_out_requests():
+    rate_limiter = RateLimiter(requests_per_minute=60 * 20)  # one every 50ms
+    started_at = time.monotonic()
+    await asyncio.gather(*(rate_limiter.acquire() for _ in range(5)))
+    assert time.monotonic() - started_at >= 0.19
@@ -0,0 +1,88 @@
+import io
+from typing import List
+
+import pptx
+
+import services.file as file_module
+from services.file import PAGE_BREAK, TEXT_BLOCK_SIZE, extract_text_from_file, iter_text_from_file
+
+
+def make_pdf(page_texts: List[str]) -> bytes:
+    # A minimal PDF with one line of Helvetica text per page
+    num_pages = len(page_texts)
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [%s] /Count %d >>"
+        % (" ".join(f"{4 + 2 * i} 0 R" for i in range(num_pages)), num_pages),
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(page_texts):
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return pdf
+
+
+def test_plain_text_is_decoded_in_blocks():
+    # A multi-byte character straddles the first block boundary
+    text = "a" * (TEXT_BLOCK_SIZE - 1) + "é\n" + "line two\n"
+    blocks = list(iter_text_from_file(io.BytesIO(text.encode("utf-8")), "text/plain"))
+
+    assert len(blocks) > 1
+    assert "".join(blocks) == text
+
+
+def test_csv_rows_become_lines():
+    data = 'name,quote\nalice,"hello, world"\nbob,"multi\nline"\n'
+    text = extract_text_from_file(io.BytesIO(data.encode("utf-8")), "text/csv")
+
+    assert text == "name quote\nalice hello, world\nbob multi\nline\n"
+
+
+def test_csv_is_yielded_in_blocks():
+    row = "x" * 100 + "\n"
+    data = row * (2 * TEXT_BLOCK_SIZE // len(row) + 1)
+    blocks = list(iter_text_from_file(io.BytesIO(data.encode("utf-8")), "text/csv"))
+
+    assert len(blocks) > 1
+    assert "".join(blocks) == data
+
+
+def test_pdf_pages_are_extracted_in_parallel_and_in_order(monkeypatch):
+    monkeypatch.setattr(file_module, "PDF_EXTRACTION_WORKERS", 2)
+    monkeypatch.setattr(file_module, "PDF_PARALLEL_MIN_PAGES", 2)
+    monkeypatch.setattr(file_module, "PDF_PAGES_PER_TASK", 3)
+    pdf = make_pdf([f"Page number {i}" for i in range(1, 11)])
+
+    blocks = list(iter_text_from_file(io.BytesIO(pdf), "application/pdf"))
+
+    assert len(blocks) == 10
+    text = "".join(blocks)
+    assert text.split(PAGE_BREAK) == [f"Page number {i}" for i in range(1, 11)]
+    assert extract_text_from_file(io.BytesIO(pdf), "application/pdf") == text
+
+
+def test_pptx_text_has_one_line_per_shape():
+    presentation = pptx.Presentation()
+    for title in ["First slide", "Second slide"]:
+        slide = presentation.slides.add_slide(presentation.slide_layouts[5])
+        slide.shapes.title.text = title
+    data = io.BytesIO()
+    presentation.save(data)
+    data.seek(0)
+
+    mimetype = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+    assert extract_text_from_file(data, mimetype) == "First slide \nSecond slide \n"
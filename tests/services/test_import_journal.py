@@ -0,0 +1,100 @@
+import pytest
+
+import services.import_journal as import_journal_module
+from models.models import Document
+from services.import_journal import (
+    ImportJournal,
+    get_batch_id,
+    get_dump_id,
+    roll_back_unfinished_batches,
+    stable_document_id,
+    upsert_journaled_batch,
+)
+
+
+class FakeDataStore:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.upserted = []
+        self.deleted = []
+
+    async def upsert(self, documents, chain="", sync_sources=True):
+        assert not sync_sources
+        if self.fail:
+            raise RuntimeError("interrupted")
+        self.upserted.extend(document.id for document in documents)
+        return [document.id for document in documents]
+
+    async def delete(self, ids=None, filter=None, delete_all=None, chain=""):
+        self.deleted.extend((id, chain) for id in ids)
+        return True
+
+
+@pytest.fixture
+def journal_path(tmp_path) -> str:
+    return str(tmp_path / "dump.journal.sqlite")
+
+
+@pytest.fixture(autouse=True)
+def questions(monkeypatch):
+    deleted = []
+    monkeypatch.setattr(
+        import_journal_module,
+        "delete_document_questions",
+        lambda chain, document_ids: deleted.extend((id, chain) for id in document_ids),
+    )
+    return deleted
+
+
+def test_ids_are_stable():
+    assert stable_document_id("dump", "3") == stable_document_id("dump", "3")
+    assert stable_document_id("dump", "3") != stable_document_id("dump", "4")
+    assert get_batch_id(["a", "b"]) == get_batch_id(["a", "b"])
+
+
+def test_dumps_with_the_same_name_have_different_ids(tmp_path):
+    for folder, content in [("a", "one\n"), ("b", "two\n")]:
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "export.jsonl").write_text(content)
+
+    first = get_dump_id(str(tmp_path / "a" / "export.jsonl"))
+    second = get_dump_id(str(tmp_path / "b" / "export.jsonl"))
+    assert first != second
+    assert stable_document_id(first, "1") != stable_document_id(second, "1")
+
+
+@pytest.mark.asyncio
+async def test_resume_skips_finished_items(journal_path):
+    journal = ImportJournal(journal_path)
+    await upsert_journaled_batch(FakeDataStore(), journal, [("1", Document(id="doc-1", text="one"))])
+    journal.skip("2", "PII detected")
+
+    resumed = ImportJournal(journal_path, resume=True)
+    assert resumed.is_finished("1")
+    assert resumed.is_finished("2")
+    assert not resumed.is_finished("3")
+
+    # Without resume the import starts over
+    assert not ImportJournal(journal_path).is_finished("1")
+
+
+@pytest.mark.asyncio
+async def test_interrupted_batch_is_rolled_back_and_retried(journal_path, questions):
+    items = [("1", Document(id="doc-1", text="one")), ("2", Document(id="doc-2", text="two"))]
+    journal = ImportJournal(journal_path)
+    with pytest.raises(RuntimeError):
+        await upsert_journaled_batch(FakeDataStore(fail=True), journal, items)
+
+    resumed = ImportJournal(journal_path, resume=True)
+    assert not resumed.is_finished("1")
+    datastore = FakeDataStore()
+    await roll_back_unfinished_batches(datastore, resumed, chain="x")
+
+    assert datastore.deleted == [("doc-1", "x"), ("doc-2", "x")]
+    assert questions == [("doc-1", "x"), ("doc-2", "x")]
+    assert resumed.unfinished_batches() == []
+
+    await upsert_journaled_batch(datastore, resumed, items)
+    assert datastore.upserted == ["doc-1", "doc-2"]
+    assert resumed.is_finished("1") and resumed.is_finished("2")
+    assert resumed.counts() == {"done": 2}
@@ -0,0 +1,151 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+import services.ingestion as ingestion
+from services.ingestion import FAILED, QUEUED, RUNNING, SUCCEEDED, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path) -> JobQueue:
+    return JobQueue(str(tmp_path / "jobs.sqlite"))
+
+
+def test_jobs_are_claimed_in_order(queue):
+    first_id = queue.enqueue({"chain": "a"})
+    second_id = queue.enqueue({"chain": "b"})
+    assert queue.get(second_id)["queue_position"] == 1
+
+    job = queue.claim()
+    assert job == {"id": first_id, "payload": {"chain": "a"}}
+    assert queue.get(first_id)["status"] == RUNNING
+    assert queue.claim()["id"] == second_id
+    assert queue.claim() is None
+
+
+def test_one_job_per_chain_runs_at_a_time_across_workers(tmp_path, monkeypatch):
+    # Two workers sharing the queue database
+    worker_1 = JobQueue(str(tmp_path / "jobs.sqlite"))
+    worker_2 = JobQueue(str(tmp_path / "jobs.sqlite"))
+    first_id = worker_1.enqueue({"chain": "a"})
+    second_id = worker_1.enqueue({"chain": "a"})
+    other_id = worker_1.enqueue({"chain": "b"})
+
+    assert worker_1.claim()["id"] == first_id
+    # The second job of chain a waits for the first one, the job of chain b doesn't
+    assert worker_2.claim()["id"] == other_id
+    assert worker_2.claim() is None
+
+    worker_1.succeed(first_id, [])
+    assert worker_2.claim()["id"] == second_id
+
+    # A running job whose worker went away no longer holds its chain
+    third_id = worker_1.enqueue({"chain": "a"})
+    monkeypatch.setattr(ingestion, "INGESTION_STALE_AFTER", 0.5)
+    worker_1.conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time() - 1, second_id))
+    assert worker_1.claim()["id"] == second_id
+    assert worker_2.claim() is None
+    worker_1.succeed(second_id, [])
+    assert worker_2.claim()["id"] == third_id
+
+
+def test_progress_reports_throughput_and_eta(queue):
+    job_id = queue.enqueue({})
+    queue.claim()
+
+    stage_started_at = time.time()
+    queue.progress(job_id, "chunking", 0, 10)
+    queue.progress(job_id, "chunking", 5, 10)
+    status = queue.get(job_id)
+    assert status["stage"] == "chunking"
+    assert status["stage_done"] == 5 and status["stage_total"] == 10
+    assert status["throughput"] > 0
+    # Half of the stage is done, so about as much time is left as was spent
+    assert 0 < status["eta_seconds"] <= time.time() - stage_started_at + 1
+
+    queue.succeed(job_id, ["doc"])
+    status = queue.get(job_id)
+    assert status["status"] == SUCCEEDED
+    assert status["result"] == ["doc"]
+    assert status["eta_seconds"] is None
+
+
+def test_stale_jobs_are_claimed_again_until_max_attempts(queue, monkeypatch):
+    monkeypatch.setattr(ingestion, "INGESTION_STALE_AFTER", -1)
+    monkeypatch.setattr(ingestion, "INGESTION_MAX_ATTEMPTS", 2)
+    job_id = queue.enqueue({})
+
+    assert queue.claim()["id"] == job_id
+    assert queue.claim()["id"] == job_id
+    assert queue.claim() is None
+    status = queue.get(job_id)
+    assert status["status"] == FAILED
+    assert status["attempts"] == 2
+
+
+def test_uploads_are_removed_when_giving_up(queue, monkeypatch, tmp_path):
+    monkeypatch.setattr(ingestion, "INGESTION_STALE_AFTER", -1)
+    monkeypatch.setattr(ingestion, "INGESTION_MAX_ATTEMPTS", 1)
+    upload = tmp_path / "upload"
+    upload.write_text("text")
+    job_id = queue.enqueue({"files": [{"file_path": str(upload)}]})
+
+    queue.claim()
+    assert upload.exists()
+    assert queue.claim() is None
+    assert queue.get(job_id)["status"] == FAILED
+    assert not upload.exists()
+
+
+def test_heartbeat_keeps_a_running_job_claimed(queue, monkeypatch):
+    job_id = queue.enqueue({})
+    queue.claim()
+    monkeypatch.setattr(ingestion, "INGESTION_STALE_AFTER", 0.5)
+    queue.conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time() - 1, job_id))
+
+    queue.heartbeat(job_id)
+    assert queue.claim() is None
+    assert queue.get(job_id)["attempts"] == 1
+
+
+def test_requeue_and_fail(queue):
+    job_id = queue.enqueue({})
+    queue.claim()
+    queue.progress(job_id, "embedding", 1, 2)
+
+    queue.requeue(job_id)
+    status = queue.get(job_id)
+    assert status["status"] == QUEUED
+    assert status["stage"] is None
+
+    queue.claim()
+    queue.fail(job_id, "boom")
+    assert queue.get(job_id)["error"] == "boom"
+
+
+def test_get_unknown_job(queue):
+    assert queue.get("missing") is None
+
+
+def test_queues_without_chains_are_migrated(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, payload TEXT NOT NULL, "
+        "attempts INTEGER NOT NULL DEFAULT 0, stage TEXT, stage_done INTEGER NOT NULL DEFAULT 0, "
+        "stage_total INTEGER NOT NULL DEFAULT 0, stage_started_at REAL, created_at REAL NOT NULL, "
+        "started_at REAL, heartbeat_at REAL, finished_at REAL, result TEXT, error TEXT)"
+    )
+    conn.execute(
+        "INSERT INTO jobs (id, status, payload, created_at) VALUES ('old', ?, ?, ?)",
+        (QUEUED, json.dumps({"chain": "a"}), time.time()),
+    )
+    conn.commit()
+    conn.close()
+
+    queue = JobQueue(path)
+    queue.enqueue({"chain": "a"})
+    assert queue.claim()["id"] == "old"
+    assert queue.claim() is None
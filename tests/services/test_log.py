@@ -0,0 +1,67 @@
+import json
+import logging
+
+import pytest
+
+from services.log import ContextFilter, JsonFormatter, correlation_id, parse_levels
+
+
+@pytest.fixture
+def log_lines():
+    lines = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            lines.append(json.loads(self.format(record)))
+
+    handler = Handler()
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(ContextFilter())
+    logger = logging.getLogger("tests.services.log")
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    yield logger, lines, handler
+    logger.removeHandler(handler)
+
+
+def test_lines_are_json_with_fields_and_correlation_id(log_lines):
+    logger, lines, _ = log_lines
+    token = correlation_id.set("request-1")
+    try:
+        logger.info("Upserted %d chunks", 3, extra={"chain": "ethereum"})
+    finally:
+        correlation_id.reset(token)
+    logger.warning("No request")
+
+    assert lines[0]["message"] == "Upserted 3 chunks"
+    assert lines[0]["level"] == "INFO"
+    assert lines[0]["logger"] == "tests.services.log"
+    assert lines[0]["correlation_id"] == "request-1"
+    assert lines[0]["chain"] == "ethereum"
+    assert "correlation_id" not in lines[1]
+
+
+def test_exceptions_are_logged_with_their_traceback(log_lines):
+    logger, lines, _ = log_lines
+    try:
+        raise ValueError("bad chunk")
+    except ValueError:
+        logger.exception("Error: %s", "bad chunk")
+    assert "ValueError: bad chunk" in lines[0]["exception"]
+
+
+def test_debug_lines_are_sampled(log_lines):
+    logger, lines, handler = log_lines
+    handler.filters = [ContextFilter(debug_sample_rate=0)]
+    for i in range(100):
+        logger.debug("text_chunk: %s", i)
+    logger.info("kept")
+    assert [line["message"] for line in lines] == ["kept"]
+
+
+def test_parse_levels():
+    assert parse_levels("services.chunks=debug, datastore.providers=WARNING") == {
+        "services.chunks": "DEBUG",
+        "datastore.providers": "WARNING",
+    }
+    assert parse_levels("") == {}
@@ -0,0 +1,64 @@
+import pytest
+
+from services.metrics import REGISTRY, Counter, Histogram, Registry, timed
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr("services.metrics.REGISTRY", registry)
+    return registry
+
+
+def test_counter_renders_in_text_format(registry):
+    counter = Counter("test_requests_total", "Test requests", ["cache", "result"])
+    counter.inc(cache="text", result="hit")
+    counter.inc(2, cache="text", result="hit")
+    counter.inc(cache='a "b"', result="miss")
+
+    assert registry.render().splitlines() == [
+        "# HELP test_requests_total Test requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{cache="text",result="hit"} 3',
+        'test_requests_total{cache="a \\"b\\"",result="miss"} 1',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(cache="text")
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = Histogram("test_seconds", "Test durations", ["stage"], buckets=[0.1, 1])
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, stage="embedding")
+
+    assert registry.render().splitlines()[2:] == [
+        'test_seconds_bucket{stage="embedding",le="0.1"} 2',
+        'test_seconds_bucket{stage="embedding",le="1.0"} 3',
+        'test_seconds_bucket{stage="embedding",le="+Inf"} 4',
+        'test_seconds_sum{stage="embedding"} 3.65',
+        'test_seconds_count{stage="embedding"} 4',
+    ]
+
+
+@pytest.mark.asyncio
+async def test_timed_observes_functions_and_coroutines(registry):
+    histogram = Histogram("test_call_seconds", "Test calls", ["operation"])
+
+    @timed(histogram, operation="sync")
+    def sync_call():
+        raise RuntimeError("failed")
+
+    @timed(histogram, operation="async")
+    async def async_call():
+        return 1
+
+    with pytest.raises(RuntimeError):
+        sync_call()
+    assert await async_call() == 1
+    assert histogram.counts[("sync",)][0] == 1
+    assert histogram.counts[("async",)][0] == 1
+
+
+def test_metric_names_are_unique():
+    names = [metric.name for metric in REGISTRY.metrics]
+    assert len(names) == len(set(names))
@@ -0,0 +1,25 @@
+import pytest
+
+from services.pii_detection import prescreen_text_for_pii
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("Forwarded by jane.doe@gmail.com on Monday", True),
+        ("Questions go to support@example.com, or jane.doe@gmail.com", True),
+        # Phone numbers and street addresses are left to the model, as many of them are not PII
+        ("Call me back at (555) 123-4567 after lunch", None),
+        ("Our London number is +44 20 7946 0958", None),
+        ("The package goes to 221B Baker Street", None),
+        ("The booth is at 12 Expo Hall Way", None),
+        ("Questions go to support@example.com", None),
+        ("We interviewed two candidates for the role", None),
+        ("Send it to Springfield, IL 62704", None),
+        ("Revenue grew 12% to $3,400,000 in Q3, see release 1.2.3 of 2023-03-04", False),
+        ("", False),
+    ],
+)
+def test_prescreen(text, expected):
+    assert prescreen_text_for_pii(text) is expected
+
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+from services.quantization import (
+    ProductQuantizer,
+    QuantizedIndex,
+    ScalarQuantizer,
+    normalize,
+)
+
+
+@pytest.fixture
+def vectors() -> np.ndarray:
+    rng = np.random.default_rng(42)
+    return normalize(rng.normal(size=(500, 32)))
+
+
+def test_scalar_quantizer_round_trip(vectors):
+    quantizer = ScalarQuantizer().fit(vectors)
+    codes = quantizer.encode(vectors)
+    assert codes.dtype == np.int8
+    assert codes.nbytes * 4 == vectors.astype(np.float32).nbytes
+    # Reconstruction error is bounded by half a quantization step per dimension
+    assert np.all(np.abs(quantizer.decode(codes) - vectors) <= quantizer.scale / 2 + 1e-6)
+
+
+def test_scalar_quantizer_asymmetric_scores(vectors):
+    quantizer = ScalarQuantizer().fit(vectors)
+    codes = quantizer.encode(vectors)
+    query = vectors[0]
+    expected = quantizer.decode(codes) @ query
+    assert np.allclose(quantizer.inner_products(query, codes), expected, atol=1e-4)
+
+
+def test_product_quantizer_asymmetric_scores(vectors):
+    quantizer = ProductQuantizer(num_subvectors=8, num_centroids=16).fit(vectors)
+    codes = quantizer.encode(vectors)
+    assert codes.shape == (len(vectors), 8)
+    query = vectors[0]
+    expected = quantizer.decode(codes) @ query
+    assert np.allclose(quantizer.inner_products(query, codes), expected, atol=1e-4)
+
+
+def test_product_quantizer_rejects_indivisible_dimension(vectors):
+    with pytest.raises(ValueError):
+        ProductQuantizer(num_subvectors=5).fit(vectors)
+
+
+def test_quantized_index_exact_rerank(vectors):
+    index = QuantizedIndex(ProductQuantizer(num_subvectors=8, num_centroids=16).fit(vectors))
+    index.add(vectors[:250])
+    index.add(vectors[250:])
+    assert len(index) == len(vectors)
+
+    query = vectors[123]
+    results = index.search(query, top_k=5, rerank_factor=20)
+    assert results[0][0] == 123
+    assert results[0][1] == pytest.approx(1.0, abs=1e-5)
+    # Reranked scores are exact inner products
+    for position, score in results:
+        assert score == pytest.approx(float(vectors[position] @ query), abs=1e-5)
+
+
+def test_quantized_index_empty():
+    index = QuantizedIndex(ScalarQuantizer())
+    assert index.search(np.ones(4), top_k=3) == []
+
+
+def test_quantized_index_adds_one_vector_at_a_time(vectors):
+    index = QuantizedIndex(ScalarQuantizer().fit(vectors), keep_vectors=False)
+    for vector in vectors:
+        index.add(vector)
+    assert len(index) == len(vectors)
+    assert index.nbytes == len(vectors) * vectors.shape[1]
+
+    results = index.search(vectors[321], top_k=1, rerank=False)
+    assert results[0][0] == 321
+    assert results[0][1] == pytest.approx(1.0, abs=1e-2)
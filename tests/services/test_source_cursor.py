@@ -0,0 +1,78 @@
+from models.models import SourceCursor
+from services.source_cursor import (
+    MIN_NEW_LINES_TO_PROCESS,
+    accepts_tail,
+    checksum,
+    complete_lines_end,
+    ends_with_newline,
+    has_enough_new_content,
+    processed_end,
+    resume_offset,
+)
+
+
+def test_resume_after_unchanged_prefix():
+    data = b"line one\nline two\n"
+    cursor = SourceCursor(byte_offset=9, checksum=checksum(data[:9]), line=1)
+
+    assert resume_offset(data + b"line three\n", cursor) == 9
+
+
+def test_changed_prefix_is_processed_again():
+    cursor = SourceCursor(byte_offset=9, checksum=checksum(b"line one\n"), line=1)
+
+    assert resume_offset(b"line 1!!\nline two\n", cursor) == 0
+    # A source that shrank below its cursor changed as well
+    assert resume_offset(b"line", cursor) == 0
+
+
+def test_legacy_line_cursor_resumes_after_its_lines():
+    data = "première\nline two\nline three".encode("utf-8")
+
+    assert resume_offset(data, SourceCursor(line=2)) == len("première\nline two\n".encode("utf-8"))
+    assert resume_offset(data, SourceCursor(line=5)) == 0
+    assert resume_offset(data, SourceCursor()) == 0
+
+
+def test_partial_last_line_is_left_for_later():
+    data = b"line one\nline two\npartial"
+
+    assert complete_lines_end(data, 0) == 18
+    assert complete_lines_end(data, 18) == 18
+    assert processed_end(data, 0, appending=True) == 18
+
+
+def test_one_line_document_is_processed_whole():
+    data = b"single line"
+
+    assert processed_end(data, 0, appending=False) == len(data)
+    assert has_enough_new_content(data.decode(), resumed=False)
+    # A source synced by appending waits for the line to be complete
+    assert processed_end(data, 0, appending=True) == 0
+
+
+def test_small_appends_wait_but_new_sources_do_not():
+    text = "line\n" * (MIN_NEW_LINES_TO_PROCESS - 1)
+
+    assert has_enough_new_content(text, resumed=False)
+    assert not has_enough_new_content(text, resumed=True)
+    assert has_enough_new_content(text + "line\n", resumed=True)
+    assert not has_enough_new_content("\n\n", resumed=False)
+
+
+def test_tail_must_end_with_a_newline(tmp_path):
+    tail = tmp_path / "tail"
+    for data, expected in [(b"", True), (b"line\n", True), (b"line\npartial", False)]:
+        tail.write_bytes(data)
+        assert ends_with_newline(str(tail)) is expected
+
+
+def test_tail_must_start_at_the_cursor():
+    cursor = SourceCursor(byte_offset=9, checksum="abc", line=1)
+
+    assert accepts_tail(cursor, 9, "abc")
+    assert not accepts_tail(cursor, 10, "abc")
+    assert not accepts_tail(cursor, 9, "def")
+    # New sources can be sent as a tail from the start, legacy sources have to be uploaded whole first
+    assert accepts_tail(SourceCursor(), 0, None)
+    assert not accepts_tail(SourceCursor(line=3), 0, None)
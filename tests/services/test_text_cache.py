@@ -0,0 +1,93 @@
+import io
+import os
+
+import pytest
+
+import services.file as file_module
+import services.text_cache as text_cache_module
+from services.file import extract_text_from_filepath
+from services.text_cache import TextCache, file_digest
+
+
+@pytest.fixture
+def cache(tmp_path) -> TextCache:
+    return TextCache(directory=str(tmp_path / "cache"), max_bytes=1024 * 1024)
+
+
+def test_text_is_cached_as_it_is_read(cache):
+    digest = file_digest(io.BytesIO(b"some bytes"))
+    assert cache.get(digest, "text/csv") is None
+
+    blocks = ["quoted\r\nfield ", "second block\n"]
+    assert list(cache.put(digest, "text/csv", blocks)) == blocks
+
+    assert "".join(cache.get(digest, "text/csv")) == "".join(blocks)  # type: ignore
+    # The same bytes extracted as another type are another entry
+    assert cache.get(digest, "text/plain") is None
+
+
+def test_failed_extraction_is_not_cached(cache):
+    def blocks():
+        yield "partial text"
+        raise ValueError("corrupt file")
+
+    with pytest.raises(ValueError):
+        list(cache.put("0" * 64, "application/pdf", blocks()))
+
+    assert cache.get("0" * 64, "application/pdf") is None
+    assert not any(files for _, _, files in os.walk(cache.directory))
+
+
+def test_least_recently_used_texts_are_evicted(cache):
+    digests = ["a" * 64, "b" * 64, "c" * 64]
+    for i, digest in enumerate(digests):
+        list(cache.put(digest, "text/plain", [os.urandom(512).hex()]))
+        # Make the order of the entries unambiguous despite the timestamp resolution of the filesystem
+        os.utime(cache._path(digest, "text/plain"), (i, i))
+    # Reading a marks it as the most recently used
+    "".join(cache.get("a" * 64, "text/plain"))  # type: ignore
+
+    # Random text compresses about the same, so there is room for about two and a half entries
+    cache.max_bytes = int(os.path.getsize(cache._path("a" * 64, "text/plain")) * 2.5)
+    cache.evict()
+
+    assert cache.get("b" * 64, "text/plain") is None
+    assert cache.get("c" * 64, "text/plain") is not None
+    assert cache.get("a" * 64, "text/plain") is not None
+
+
+def test_cache_is_scanned_only_when_full_or_every_few_puts(cache, monkeypatch):
+    monkeypatch.setattr(text_cache_module, "TEXT_CACHE_RESCAN_PUTS", 5)
+    scans = []
+    evict = cache.evict
+    monkeypatch.setattr(cache, "evict", lambda: scans.append(cache._puts_since_scan) or evict())
+
+    for i in range(11):
+        list(cache.put(f"{i:064x}", "text/plain", [os.urandom(512).hex()]))
+    # Once to read the size of the cache, then every 5 puts
+    assert scans == [1, 5, 5]
+
+    # The 13th entry goes over the budget, and the eviction makes room for the 14th as well
+    entry_size = os.path.getsize(cache._path(f"{0:064x}", "text/plain"))
+    cache.max_bytes = int(entry_size * 12.5)
+    for i in range(11, 14):
+        list(cache.put(f"{i:064x}", "text/plain", [os.urandom(512).hex()]))
+    assert scans == [1, 5, 5, 2]
+    sizes = [
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(cache.directory) for name in names
+    ]
+    assert len(sizes) == 12
+    assert cache._size == sum(sizes)
+
+
+def test_cached_files_are_not_parsed_again(tmp_path, monkeypatch, cache):
+    monkeypatch.setattr(file_module, "text_cache", cache)
+    path = tmp_path / "export.csv"
+    path.write_text("author,message\nalice,hello\n")
+    assert extract_text_from_filepath(str(path)) == "author message\nalice hello\n"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the file was parsed again")
+
+    monkeypatch.setattr(file_module, "iter_text_from_file", fail)
+    assert extract_text_from_filepath(str(path)) == "author message\nalice hello\n"
@@ -0,0 +1,54 @@
+import pytest
+
+import services.tracing as tracing_module
+from services.tracing import NOOP_SPAN, span, traced
+
+
+@pytest.fixture
+def exported_spans(monkeypatch):
+    sdk_trace = pytest.importorskip("opentelemetry.sdk.trace")
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing_module, "tracer", provider.get_tracer(__name__))
+    return exporter.get_finished_spans
+
+
+def test_spans_are_noops_without_a_tracer(monkeypatch):
+    monkeypatch.setattr(tracing_module, "tracer", None)
+    with span("query", chain="ethereum") as current:
+        current.set_attribute("tokens.prompt", 3)
+    assert current is NOOP_SPAN
+
+
+@pytest.mark.asyncio
+async def test_traced_calls_are_nested_with_their_arguments(exported_spans):
+    @traced("dynamodb.get_question", arguments=("chain",), **{"db.system": "dynamodb"})
+    def get_question(chain: str, question: str):
+        return question
+
+    @traced("query")
+    async def query():
+        with span("embedding", batch_size=2, model=None) as current:
+            current.set_attribute("tokens.prompt", 12)
+        return get_question("ethereum", question="what is gas?")
+
+    assert await query() == "what is gas?"
+
+    embedding, get_question_span, query_span = exported_spans()
+    assert dict(embedding.attributes) == {"batch_size": 2, "tokens.prompt": 12}
+    assert dict(get_question_span.attributes) == {"db.system": "dynamodb", "chain": "ethereum"}
+    assert embedding.parent.span_id == query_span.context.span_id
+    assert get_question_span.parent.span_id == query_span.context.span_id
+
+
+def test_spans_record_exceptions(exported_spans):
+    with pytest.raises(RuntimeError):
+        with span("upsert"):
+            raise RuntimeError("rate limited")
+    (upsert,) = exported_spans()
+    assert not upsert.status.is_ok
+    assert upsert.events[0].name == "exception"